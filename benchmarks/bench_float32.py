@@ -0,0 +1,75 @@
+'''
+Accuracy and speed of float32 versus float64 truncated PC bases.
+
+Uses a synthetic atlas of the given size so that no model files are needed.
+Reports basis memory, reconstruction and projection time, and the maximum
+nodal error of float32 reconstruction relative to float64.
+
+Usage:
+    python benchmarks/bench_float32.py --nodes 20000 --modes 50 --npcs 10
+'''
+import time
+import argparse
+
+import numpy as np
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep.pcbasis import TruncatedPCBasis
+
+
+class SyntheticPC(object):
+    '''
+    Minimal stand-in for a gias3 PrincipalComponents with orthonormal modes.
+    '''
+
+    def __init__(self, nParams, nModes, rng):
+        self.mean = rng.normal(0.0, 100.0, nParams)
+        self.modes = np.linalg.qr(rng.normal(size=(nParams, nModes)))[0]
+        self.weights = np.sort(rng.uniform(1.0, 1e4, nModes))[::-1]
+
+    def getMean(self):
+        return self.mean
+
+    def getWeightsBySD(self, modes, sds):
+        return np.sqrt(self.weights[modes]) * np.asarray(sds)
+
+    def reconstruct(self, weights, modes):
+        return self.mean + self.modes[:, modes].dot(weights)
+
+
+def _time(func, repeats):
+    t0 = time.perf_counter()
+    for i in range(repeats):
+        func()
+    return (time.perf_counter() - t0) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=20000)
+    parser.add_argument('--modes', type=int, default=50)
+    parser.add_argument('--npcs', type=int, default=10)
+    parser.add_argument('--repeats', type=int, default=200)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    pc = SyntheticPC(3 * args.nodes, args.modes, rng)
+    weights = rng.normal(0.0, 1.0, (args.repeats, args.npcs))
+
+    bases = dict((dtype, TruncatedPCBasis(pc, args.npcs, dtype)) for dtype in (np.float64, np.float32))
+    reference = [bases[np.float64].reconstruct(w) for w in weights[:10]]
+
+    print('{} nodes, {} PCs'.format(args.nodes, args.npcs))
+    for dtype, basis in bases.items():
+        ws = iter(weights)
+        tRecon = _time(lambda: basis.reconstruct(next(ws)), args.repeats)
+        P = basis.reconstruct(weights[0])
+        tProj = _time(lambda: basis.project(P), args.repeats)
+        err = max(np.abs(basis.reconstruct(w).astype(float) - r).max() for w, r in zip(weights[:10], reference))
+        wErr = np.abs(basis.project(P) - weights[0]).max()
+        print('{:8s} basis {:8.2f} MB  reconstruct {:8.3f} ms  project {:8.3f} ms  '
+              'max nodal error {:.2e}  max weight error {:.2e}'.format(
+                np.dtype(dtype).name, basis.nbytes() / 1e6, tRecon * 1e3, tProj * 1e3, err, wErr))
+
+
+if __name__ == '__main__':
+    main()
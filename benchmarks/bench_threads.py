@@ -0,0 +1,82 @@
+'''
+Registration throughput against the split of cores into processes x BLAS
+threads.
+
+Each task mimics the linear algebra of one PC registration on a synthetic
+atlas: a truncated basis is built, then each iteration reconstructs the
+nodal parameters, takes a Kabsch SVD on the node cloud and projects back
+onto the modes. Tasks run in a spawn process pool with the thread limits
+of threadlimits, for every split with processes x threads = cores (or the
+given splits).
+
+Usage:
+    python benchmarks/bench_threads.py --nodes 20000 --modes 50 --npcs 10 --tasks 32
+    python benchmarks/bench_threads.py --splits 1x8 2x4 4x2 8x1
+'''
+import os
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import threadlimits
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep.pcbasis import TruncatedPCBasis
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep.rotations import kabsch
+
+from bench_float32 import SyntheticPC
+
+
+def _task(seed, nodes, modes, npcs, iterations):
+    rng = np.random.default_rng(seed)
+    pc = SyntheticPC(3 * nodes, modes, rng)
+    basis = TruncatedPCBasis(pc, npcs)
+    target = basis.reconstruct(rng.normal(0.0, 1.0, npcs)).reshape((3, -1)).T
+    w = np.zeros(npcs)
+    for it in range(iterations):
+        X = basis.reconstruct(w).reshape((3, -1)).T
+        R, t = kabsch(X, target)
+        w = basis.project(((target - t).dot(R)).T.ravel())
+    return w
+
+
+def _splits(cores):
+    return [(p, cores // p) for p in range(1, cores + 1) if cores % p == 0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=20000)
+    parser.add_argument('--modes', type=int, default=50)
+    parser.add_argument('--npcs', type=int, default=10)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--tasks', type=int, default=32)
+    parser.add_argument('--splits', nargs='+', default=None, help='processes x threads, e.g. 2x4')
+    args = parser.parse_args()
+
+    if args.splits:
+        splits = [tuple(int(n) for n in s.lower().split('x')) for s in args.splits]
+    else:
+        splits = _splits(os.cpu_count() or 1)
+
+    if threadlimits.threadpool_limits is None:
+        print('threadpoolctl not installed, limits are applied through the environment only')
+
+    ctx = multiprocessing.get_context('spawn')
+    taskArgs = [(seed, args.nodes, args.modes, args.npcs, args.iterations) for seed in range(args.tasks)]
+    print('{:>9s} {:>7s} {:>10s} {:>10s}'.format('processes', 'threads', 'time (s)', 'tasks/s'))
+    for processes, threads in splits:
+        with threadlimits.threadEnvironment(threads), \
+                ProcessPoolExecutor(max_workers=processes, mp_context=ctx,
+                                    initializer=threadlimits.workerInitializer(threads)) as executor:
+            # start the workers before timing
+            list(executor.map(int, range(processes)))
+            t0 = time.perf_counter()
+            list(executor.map(_task, *zip(*taskArgs)))
+            elapsed = time.perf_counter() - t0
+        print('{:9d} {:7d} {:10.3f} {:10.2f}'.format(processes, threads, elapsed, args.tasks / elapsed))
+
+
+if __name__ == '__main__':
+    main()
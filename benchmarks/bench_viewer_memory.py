@@ -0,0 +1,106 @@
+'''
+Memory growth over repeated opening and closing of the registration
+viewer.
+
+Each cycle builds a MayaviPCRegViewerWidget for the same landmarks and
+template, shows it, and closes it with accept or abort. After every cycle
+the resident set size of the process and the Python heap (tracemalloc) are
+measured and the number of viewers still alive is counted through weak
+references. tracemalloc does not see VTK and Qt allocations, the resident
+set size does. A leak shows as memory growth proportional to the cycle
+count or as closed viewers that are never collected. Needs a display (or a
+virtual one such as xvfb). tests/test_viewer_memory.py asserts the same
+bounds on a small mesh.
+
+Usage:
+    python benchmarks/bench_viewer_memory.py --landmarks subject.json --gf pelvis.geof \\
+        --ens pelvis.ens --mesh pelvis.mesh --cycles 50
+'''
+import gc
+import os
+import weakref
+import argparse
+import tracemalloc
+
+from PySide6.QtWidgets import QApplication
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import dataio
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep.step import FieldworkPCRegPelvis2LandmarksStep
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep.pcregviewerwidget import MayaviPCRegViewerWidget
+
+
+def _rss():
+    '''
+    Resident set size of this process in bytes (Linux), None elsewhere.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def _cycle(app, landmarks, model, config, abort):
+    widget = MayaviPCRegViewerWidget(landmarks, model, config, lambda callbackSignal=None: None)
+    widget.show()
+    app.processEvents()
+    if abort:
+        widget._ui.abortButton.click()
+    else:
+        widget._ui.acceptButton.click()
+    widget.close()
+    widget.deleteLater()
+    app.processEvents()
+    return weakref.ref(widget)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--landmarks', required=True)
+    parser.add_argument('--gf', required=True)
+    parser.add_argument('--ens', default=None)
+    parser.add_argument('--mesh', default=None)
+    parser.add_argument('--config', default=None, help='step JSON config, step defaults if not given')
+    parser.add_argument('--cycles', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=3, help='cycles before the baseline is taken')
+    args = parser.parse_args()
+
+    app = QApplication.instance() or QApplication([])
+    landmarks = dataio.loadLandmarks(args.landmarks)
+    model = dataio.loadModel(args.gf, args.ens, args.mesh)
+    if args.config is None:
+        config = FieldworkPCRegPelvis2LandmarksStep('')._config
+    else:
+        config = dataio.loadConfig(args.config)
+    config['speculative'] = False
+
+    for i in range(args.warmup):
+        _cycle(app, landmarks, model, config, abort=bool(i % 2))
+    gc.collect()
+
+    tracemalloc.start()
+    baseline = tracemalloc.take_snapshot()
+    start = tracemalloc.get_traced_memory()[0]
+    startRSS = _rss() or 0
+    viewers = []
+    print('{:>6s} {:>12s} {:>12s} {:>8s}'.format('cycle', 'rss (MB)', 'heap (MB)', 'alive'))
+    for i in range(args.cycles):
+        viewers.append(_cycle(app, landmarks, model, config, abort=bool(i % 2)))
+        gc.collect()
+        current = tracemalloc.get_traced_memory()[0]
+        rss = (_rss() or 0) - startRSS
+        alive = sum(1 for v in viewers if v() is not None)
+        print('{:6d} {:12.2f} {:12.2f} {:8d}'.format(i + 1, rss / 1e6, (current - start) / 1e6, alive))
+
+    snapshot = tracemalloc.take_snapshot()
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print('\nrss growth per cycle: {:.1f} kB'.format(((_rss() or 0) - startRSS) / 1e3 / args.cycles))
+    print('heap growth per cycle: {:.1f} kB'.format((current - start) / 1e3 / args.cycles))
+    print('\ntop allocation sites since baseline:')
+    for stat in snapshot.compare_to(baseline, 'lineno')[:15]:
+        print(stat)
+
+
+if __name__ == '__main__':
+    main()
@@ -22,5 +22,9 @@ __author__ = 'Ju Zhang'
 __stepname__ = 'Fieldwork PC-Reg Pelvis 2 Landmarks'
 __location__ = 'https://github.com/mapclient-plugins/fieldworkpcregpelvis2landmarksstep/archive/v0.1.0.zip'
 
+# MAP Client registers the step when this package is imported. The step
+# imports Qt and its dialogs only when it is used, and does without MAP
+# Client when that is not installed, so the registration modules and the
+# headless tools (batch, server, tuning, watch) and their worker processes
+# import without the GUI stack.
 from mapclientplugins.fieldworkpcregpelvis2landmarksstep import step
-import mapclientplugins.fieldworkpcregpelvis2landmarksstep.resources_rc
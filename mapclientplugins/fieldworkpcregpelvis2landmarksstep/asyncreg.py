@@ -0,0 +1,106 @@
+'''
+asyncio interface to the registration.
+
+The optimiser runs in an executor thread. Intermediate nodal parameter
+vectors from the gf_params callback are streamed to the event loop and can be
+consumed with async for, in place of the Qt callbackSignal used by the
+viewer. Many registrations can be awaited and cancelled from one event loop.
+
+    handle = registerAsync(landmarks, pc, model, config)
+    async for params in handle:
+        ...
+    outputModel, rmse, T, transform = await handle
+'''
+import asyncio
+import threading
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import registration
+
+
+class RegistrationCancelled(registration.FitCancelled):
+    pass
+
+
+class _LoopSignal(object):
+    '''
+    Stand-in for a Qt signal: emit() forwards to the event loop thread.
+    '''
+
+    def __init__(self, emit):
+        self.emit = emit
+
+
+class AsyncRegistration(object):
+    '''
+    Handle to a registration running in an executor. Iterate asynchronously
+    for intermediate parameters, await for the final result, and cancel()
+    to stop the optimiser at its next iteration.
+
+    Only the latest maxPending intermediate updates are kept if the consumer
+    falls behind.
+    '''
+
+    _done = object()
+
+    def __init__(self, func, executor=None, maxPending=16):
+        self._loop = asyncio.get_running_loop()
+        self._updates = asyncio.Queue(maxsize=maxPending)
+        self._cancelled = threading.Event()
+        self._future = self._loop.run_in_executor(executor, self._run, func)
+
+    def _run(self, func):
+        try:
+            return func(_LoopSignal(self._emit))
+        finally:
+            self._loop.call_soon_threadsafe(self._push, self._done)
+
+    def _emit(self, params):
+        if self._cancelled.is_set():
+            raise RegistrationCancelled()
+        self._loop.call_soon_threadsafe(self._push, params.copy())
+
+    def _push(self, item):
+        if self._updates.full():
+            self._updates.get_nowait()
+        self._updates.put_nowait(item)
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self._updates.get()
+        if item is self._done:
+            raise StopAsyncIteration
+        return item
+
+    async def result(self):
+        try:
+            return await asyncio.shield(self._future)
+        except RegistrationCancelled:
+            raise asyncio.CancelledError()
+        except asyncio.CancelledError:
+            # the awaiting task was cancelled, stop the optimiser too
+            self.cancel()
+            raise
+
+    def __await__(self):
+        return self.result().__await__()
+
+
+def registerAsync(landmarks, pc, model, config, executor=None, maxPending=16):
+    '''
+    Start registerPelvis in executor (the loop's default executor if None)
+    and return an AsyncRegistration. Must be called from a running event
+    loop. The result is (outputModel, rmse, T, transform).
+    '''
+
+    def func(signal):
+        return registration.registerPelvis(landmarks, pc, model, config, callback=signal.emit)
+
+    return AsyncRegistration(func, executor=executor, maxPending=maxPending)
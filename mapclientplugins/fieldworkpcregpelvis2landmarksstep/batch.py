@@ -0,0 +1,225 @@
+'''
+Checkpointed, resumable cohort registration.
+
+A job spec is a JSON file:
+
+    {
+        "config": "step.json",
+        "pc": "pelvis.pc",
+        "gf": "pelvis.geof",
+        "ens": "pelvis.ens",
+        "mesh": "pelvis.mesh",
+        "results": "results.jsonl",
+        "subjects": {"subject01": "subject01_landmarks.json", ...}
+    }
+
+"config" may also be an inline step config dict. Relative paths are relative
+to the job spec file. Every finished subject is appended to the results
+store, one JSON record per line, and flushed to disk straight away.
+Rerunning the same job spec skips subjects that already have a successful
+record, so an interrupted run continues from where it stopped, and subjects
+added to the spec are registered without refitting the others. Set
+PELVISREG_PROFILE to a directory to profile every subject, see profiling.
+
+Usage:
+    python -m mapclientplugins.fieldworkpcregpelvis2landmarksstep.batch job.json
+'''
+import os
+import json
+import copy
+import hashlib
+import argparse
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import registration
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import dataio
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import profiling
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import metrics
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import threadlimits
+
+# the files and step config keys that change the fit of a subject
+MODELFILES = ('pc', 'gf', 'ens', 'mesh')
+FITSETTINGS = ('regMode', 'npcs', 'pcSolver', 'pcfitmw0', 'pcfitmwn', 'pointCloudWeight', 'float32', 'jit',
+               'xtol', 'ftol', 'maxIterations') + registration.PELVISLANDMARKS
+
+_worker = {}
+
+
+class ResultsStore(object):
+    '''
+    Append-only JSON-lines store of per-subject registration results. The
+    first record identifies the job spec the store belongs to.
+    '''
+
+    def __init__(self, filename, jobDigest):
+        self.filename = filename
+        self.jobDigest = jobDigest
+        self.completed = set()
+        if os.path.exists(filename):
+            self._load()
+        else:
+            self._append({'job': jobDigest})
+
+    def _load(self):
+        with open(self.filename, 'rb+') as f:
+            data = f.read()
+            end = data.rfind(b'\n') + 1
+            if end < len(data):
+                # drop a partial record left by a run killed mid-write
+                f.truncate(end)
+
+        records = [json.loads(line) for line in data[:end].decode('utf-8').splitlines()]
+        if not records:
+            # killed before the header was complete
+            self._append({'job': self.jobDigest})
+            return
+        if records[0].get('job') != self.jobDigest:
+            raise ValueError('{} belongs to a different job spec'.format(self.filename))
+
+        for record in records[1:]:
+            if record.get('status') == 'ok':
+                self.completed.add(record['subject'])
+
+    def _append(self, record):
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def add(self, record):
+        self._append(record)
+        if record.get('status') == 'ok':
+            self.completed.add(record['subject'])
+
+    def records(self):
+        with open(self.filename, 'r') as f:
+            return [json.loads(line) for line in f][1:]
+
+
+def jobDigest(spec, config):
+    '''
+    Digest of the model files of a job spec and the fit settings of its
+    step config. Subjects are left out, so a results store stays valid when
+    subjects are added to the job.
+    '''
+    settings = dict((key, spec.get(key)) for key in MODELFILES)
+    settings['config'] = dict((key, config.get(key)) for key in FITSETTINGS)
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def loadJobSpec(filename):
+    with open(filename, 'r') as f:
+        spec = json.load(f)
+
+    root = os.path.dirname(os.path.abspath(filename))
+
+    def path(p):
+        return None if p is None else os.path.join(root, p)
+
+    resolved = dict(spec)
+    for key in ('pc', 'gf', 'ens', 'mesh', 'results'):
+        resolved[key] = path(spec.get(key))
+    if not isinstance(spec['config'], dict):
+        resolved['config'] = dataio.loadConfig(path(spec['config']))
+    resolved['subjects'] = dict((s, path(l)) for s, l in spec['subjects'].items())
+    return spec, resolved
+
+
+def _initWorker(pc, model, config):
+    model = copy.deepcopy(model)
+    registration.prepareInputModel(model, pc, config)
+    _worker['pc'] = pc
+    _worker['model'] = model
+    _worker['config'] = config
+
+
+def _registerSubject(subject, landmarksFilename):
+    config = _worker['config']
+    with metrics.collectFits() as fits:
+        try:
+            landmarks = dataio.loadLandmarks(landmarksFilename)
+            with profiling.RegistrationProfile(profiling.profileDir(config), config.get('identifier') or 'batch',
+                                               subject):
+                outputModel, rmse, T, transform = registration.registerPelvis(landmarks,
+                                                                              _worker['pc'],
+                                                                              _worker['model'],
+                                                                              config)
+        except Exception:
+            return {'subject': subject, 'status': 'failed', 'error': traceback.format_exc(), 'fits': fits}
+
+    return {'subject': subject,
+            'status': 'ok',
+            'rmse': float(rmse),
+            'T': np.asarray(T, dtype=float).tolist(),
+            'params': np.asarray(outputModel.get_field_parameters(), dtype=float).ravel().tolist(),
+            'fits': fits,
+            }
+
+
+def _addResult(store, result):
+    # fits in worker processes are recorded here, in the parent
+    metrics.recordFits(result.pop('fits'))
+    store.add(result)
+
+
+def runCohort(jobSpecFilename, processes=1, threads=None):
+    '''
+    Register every subject in the job spec that does not yet have a
+    successful record in the results store. Results are recorded as soon
+    as each subject finishes. threads is the BLAS thread budget per
+    process, by default the cores shared evenly between processes. Returns
+    the results store.
+    '''
+    spec, job = loadJobSpec(jobSpecFilename)
+    store = ResultsStore(job['results'], jobDigest(spec, job['config']))
+    todo = [(s, l) for s, l in sorted(job['subjects'].items()) if s not in store.completed]
+    if not todo:
+        return store
+
+    pc = dataio.loadPC(job['pc'])
+    model = dataio.loadModel(job['gf'], job['ens'], job['mesh'])
+    config = job['config']
+    if threads is None:
+        threads = threadlimits.threadsPerProcess(processes)
+
+    if processes == 1:
+        _initWorker(pc, model, config)
+        with threadlimits.limitThreads(threads):
+            for subject, landmarksFilename in todo:
+                _addResult(store, _registerSubject(subject, landmarksFilename))
+        return store
+
+    ctx = multiprocessing.get_context('spawn')
+    with threadlimits.threadEnvironment(threads), \
+            ProcessPoolExecutor(max_workers=processes, mp_context=ctx,
+                                initializer=threadlimits.workerInitializer(threads, _initWorker),
+                                initargs=(pc, model, config)) as executor:
+        futures = [executor.submit(_registerSubject, s, l) for s, l in todo]
+        for future in as_completed(futures):
+            _addResult(store, future.result())
+
+    return store
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Resumable cohort pelvis registration.')
+    parser.add_argument('jobspec', help='job spec JSON file')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=None,
+                        help='BLAS threads per process, 0 for no limit, default cores / processes')
+    args = parser.parse_args(args)
+
+    store = runCohort(args.jobspec, args.processes, args.threads)
+    records = store.records()
+    failed = sorted(set(r['subject'] for r in records if r['status'] == 'failed') - store.completed)
+    print('{} subjects completed, {} failed'.format(len(store.completed), len(failed)))
+    for subject in failed:
+        print('failed: {}'.format(subject))
+
+
+if __name__ == '__main__':
+    main()
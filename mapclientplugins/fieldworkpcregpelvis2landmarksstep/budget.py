@@ -0,0 +1,84 @@
+'''
+Time and iteration budgets for the registration solvers.
+
+Every solver takes a fitCallback that it calls with its current transform
+parameters T and landmark SSE after each iteration: each fmin iteration of
+the PC optimiser and Linear Scaling stages, each iteration of the
+alternating and point cloud solvers, and each residual evaluation of the
+leastsq solver. A FitBudget is that callback. It keeps the T with the lowest
+landmark SSE seen so far and raises BudgetExhausted once the wall-clock time
+or number of iterations runs out, or once the landmark RMSE reaches a
+target, which stops the solver. registration.align then builds the output
+from the best T.
+'''
+import time
+
+import numpy as np
+
+
+class BudgetExhausted(Exception):
+    pass
+
+
+class FitBudget(object):
+    '''
+    seconds and iterations of None or 0 mean unlimited, targetRMSE of None
+    or 0 means no target. exhausted is set if the fit was cut off by the
+    budget, targetReached if it was stopped at the target RMSE.
+    '''
+
+    def __init__(self, seconds=None, iterations=None, targetRMSE=None):
+        self.seconds = seconds or None
+        self.iterations = iterations or None
+        self.targetRMSE = targetRMSE or None
+        self.exhausted = False
+        self.targetReached = False
+        self.nIterations = 0
+        self.bestT = None
+        self.bestSSE = np.inf
+        self._start = None
+        self._targetSSE = None
+
+    @classmethod
+    def fromConfig(cls, config):
+        return cls(config.get('timeBudget'), config.get('iterationBudget'), config.get('targetRMSE'))
+
+    def limited(self):
+        return (self.seconds is not None) or (self.iterations is not None) or (self.targetRMSE is not None)
+
+    def status(self):
+        '''
+        The diagnostics keys converged (False if the fit was cut off by the
+        time or iteration budget) and targetReached.
+        '''
+        return {'converged': not self.exhausted, 'targetReached': self.targetReached}
+
+    def elapsed(self):
+        return 0.0 if self._start is None else time.perf_counter() - self._start
+
+    def start(self, nLandmarks):
+        '''
+        Start the clock for a fit to nLandmarks landmarks.
+        '''
+        self._start = time.perf_counter()
+        self._targetSSE = None if self.targetRMSE is None else nLandmarks * self.targetRMSE ** 2.0
+
+    def __call__(self, T, sse):
+        '''
+        The solver fit callback. Records T if its landmark SSE is the best so
+        far, then raises BudgetExhausted if the budget has run out or the
+        landmark RMSE has reached the target.
+        '''
+        if sse < self.bestSSE:
+            self.bestSSE = float(sse)
+            self.bestT = np.array(T, dtype=float)
+        self.nIterations += 1
+
+        if (self._targetSSE is not None) and (self.bestSSE <= self._targetSSE):
+            self.targetReached = True
+            raise BudgetExhausted()
+
+        if ((self.iterations is not None) and (self.nIterations >= self.iterations)) or \
+                ((self.seconds is not None) and (self.elapsed() >= self.seconds)):
+            self.exhausted = True
+            raise BudgetExhausted()
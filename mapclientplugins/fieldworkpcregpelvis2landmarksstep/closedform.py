@@ -0,0 +1,405 @@
+'''
+Closed-form solvers for landmark registration.
+
+The ASIS, PSIS and sacral landmarks and the model centre of mass are affine
+functions of the nodal parameters, which are in turn affine in the PC
+weights. With the pose fixed, fitting the PC weights is a ridge regression,
+and with the shape fixed, fitting the pose is an orthogonal Procrustes
+(Kabsch) problem. Alternating between the two converges in a few cheap
+iterations. The hip joint centres are sphere fits to the acetabulum and are
+not affine; with them the landmark model is re-linearised about the current
+weights every iteration and landmark errors are evaluated on the shape
+itself (see LandmarkModeModel).
+
+The objective is that of the final stage of model_alignment.alignModelLandmarksPC:
+landmark SSE + mwn * ||w||, the Mahalanobis distance of the SD-scaled PC
+weights scaled by mwn. Each ridge solve uses the quadratic majoriser of the
+prior at the current weights (see priorPenalty), so every step decreases
+that objective. mw0 only weights gias3's intermediate first-mode stage and
+is not used here.
+
+Rigid parameters follow the gias3 convention used by RigidPCModesTransform:
+T = [tx, ty, tz, rx, ry, rz, w0, w1, ...] with rotations applied about the
+model centre of mass as R = Rx.Ry.Rz (see rotations) and PC weights in
+units of mode SD.
+Rigid-scale parameters follow RigidScaleTransformAboutPoint:
+T = [tx, ty, tz, rx, ry, rz, s] about a point P.
+'''
+import copy
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from gias3.common import transform3D
+from gias3.musculoskeletal import fw_model_landmarks as fml
+from gias3.mapclientpluginutilities.datatypes import transformations
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import pcbasis
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep.rotations import kabsch, eulerFromMatrix, matrixFromEuler
+
+
+def _evaluateLandmarks(evaluators, P):
+    # gias3 landmark evaluators index nodal parameters as (3, n_nodes)
+    P = np.asarray(P).reshape((3, -1))
+    return np.array([e(P) for e in evaluators], dtype=float)
+
+
+def evaluateModelLandmarks(gf, landmarkNames):
+    '''
+    Coordinates (n_landmarks, 3) of the named landmarks on gf as it is.
+    '''
+    evaluators = [fml.makeLandmarkEvaluator(n, gf) for n in landmarkNames]
+    return _evaluateLandmarks(evaluators, gf.get_field_parameters())
+
+
+def priorObjective(w, mwn):
+    '''
+    The gias3 PC shape prior, mwn times the Mahalanobis distance of the
+    SD-scaled weights w.
+    '''
+    return mwn * np.linalg.norm(w)
+
+
+def priorPenalty(w, mwn):
+    '''
+    Ridge penalty per PC weight that majorises priorObjective at w, since
+    ||v|| <= (||v||^2 + ||w||^2) / (2 ||w||). A ridge solve with it does not
+    increase the prior objective. Zero weights (a cold start) are treated
+    as ||w|| = 1.
+    '''
+    norm = np.linalg.norm(w)
+    if norm == 0.0:
+        norm = 1.0
+    return np.full(len(w), 0.5 * mwn / max(norm, 1e-12))
+
+
+# landmarks gias3 evaluates as sphere fits to the acetabulum, which are not
+# affine in the nodal parameters
+NONLINEARLANDMARKS = ('pelvis-LHJC', 'pelvis-RHJC')
+
+
+class LandmarkModeModel(object):
+    '''
+    Linear model of the landmark positions relative to the model centre of
+    mass as a function of the first npcs SD-scaled PC weights, by finite
+    differences of one SD about the weights w it was last linearised at.
+    The nodal parameters are reconstructed from a truncated basis stored in
+    dtype; the landmark model itself is always float64.
+
+    The model is exact for landmarks on nodes or means of nodes. If any of
+    landmarkNames is in NONLINEARLANDMARKS, nonlinear is True and the
+    solvers call linearise at their current weights every iteration and
+    take landmark errors from exactCentred.
+    '''
+
+    def __init__(self, gf, landmarkNames, pc, npcs, dtype=np.float64):
+        self.pc = pc
+        self.npcs = npcs
+        self.basis = pcbasis.TruncatedPCBasis(pc, npcs, dtype)
+        self.nonlinear = any(n in NONLINEARLANDMARKS for n in landmarkNames)
+        self._evaluators = [fml.makeLandmarkEvaluator(n, gf) for n in landmarkNames]
+
+        self.c0 = self.basis.mean.astype(float).reshape((3, -1)).mean(1)
+        self.dc = np.array([self.basis.modes[:, m].astype(float).reshape((3, -1)).mean(1)
+                            for m in range(npcs)]).reshape((npcs, 3))
+        self._linearise(np.zeros(npcs))
+
+    def linearise(self, w):
+        '''
+        Re-linearise a nonlinear model about weights w. Linear models do not
+        change.
+        '''
+        if self.nonlinear and not np.array_equal(w, self.w):
+            self._linearise(w)
+
+    def _linearise(self, w):
+        self.w = np.array(w, dtype=float)
+        P = self.nodalParams(self.w).astype(float)
+        L = _evaluateLandmarks(self._evaluators, P)
+        dL = [_evaluateLandmarks(self._evaluators, P + self.basis.modes[:, m]) - L for m in range(self.npcs)]
+        self.D = np.array(dL).reshape((self.npcs, -1, 3)) - self.dc[:, np.newaxis, :]
+        self.Lc0 = L - self.centre(self.w) - np.tensordot(self.w, self.D, axes=1)
+        # design matrix, one column per mode, rows are flattened (x, y, z) per landmark
+        self.A = self.D.reshape((self.npcs, -1)).T
+
+    def exactCentred(self, w):
+        '''
+        Landmarks relative to the centre of mass evaluated on the shape with
+        weights w, rather than from the linear model.
+        '''
+        if not self.nonlinear:
+            return self.centred(w)
+        return _evaluateLandmarks(self._evaluators, self.nodalParams(w).astype(float)) - self.centre(w)
+
+    def posedLandmarks(self, T):
+        '''
+        Exact landmarks (n, 3) of RigidPCModesTransform parameters T.
+        '''
+        w = T[6:]
+        return self.exactCentred(w).dot(matrixFromEuler(T[3:6]).T) + T[:3] + self.centre(w)
+
+    def centred(self, w):
+        return self.Lc0 + np.tensordot(w, self.D, axes=1)
+
+    def centre(self, w):
+        return self.c0 + np.dot(w, self.dc)
+
+    def nodalParams(self, w):
+        return self.basis.reconstruct(w)
+
+    def transformedParams(self, w, R, tau):
+        '''
+        Flattened nodal parameters of the shape with weights w rotated by R
+        about its centre of mass, which is then moved to tau.
+        '''
+        X = self.nodalParams(w).reshape((3, -1)).T
+        X = (X - X.mean(0)).dot(R.T.astype(X.dtype)) + tau.astype(X.dtype)
+        return X.T.ravel()
+
+
+def ridgePCWeights(model, R, tau, target, penalty):
+    '''
+    PC weights minimising ||target - (R.centred(w) + tau)||^2 + sum(penalty * w^2)
+    for fixed pose (R, tau).
+    '''
+    return _ridgeSolve(model.Lc0, model.D, R, tau, target, penalty)
+
+
+def _ridgeSolve(Lc0, D, R, tau, target, penalty, weights=None):
+    '''
+    Weighted ridge solve for points Lc0 + D.w (centred on the model centre
+    of mass) posed by (R, tau) onto target.
+    '''
+    b = (target - tau).dot(R) - Lc0
+    A = D.reshape((len(D), -1)).T
+    if weights is None:
+        AtW = A.T
+    else:
+        AtW = A.T * np.repeat(weights, 3)
+    return np.linalg.solve(AtW.dot(A) + np.diag(penalty), AtW.dot(b.ravel()))
+
+
+def alignModelLandmarksPCAlternating(gf, landmarks, pc, npcs, gf_params_callback=None, mw0=1.0, mwn=1.0,
+                                     w0=None, maxIterations=20, ftol=1e-6, xtol=0.0, float32=False,
+                                     fitCallback=None):
+    '''
+    Drop-in alternative to model_alignment.alignModelLandmarksPC that
+    alternates a Kabsch pose step with a ridge solve for the PC weights,
+    minimising the same objective.
+
+    landmarks is a list of (landmark name, coordinates). w0 optionally
+    warm-starts the PC weights. Iteration stops after maxIterations, when
+    the relative change in the objective is at most ftol, or when the
+    relative change in the pose and weights is at most xtol. If float32, the
+    truncated PC basis is stored and reconstructed in float32; the fit, SSE
+    and T stay float64. fitCallback(T, sse) is called after every iteration
+    with the current T and landmark SSE. Returns the registered copy of gf,
+    the landmark SSE after each iteration, and T.
+    '''
+    names, targets = zip(*landmarks)
+    X = np.array(targets, dtype=float)
+    model = LandmarkModeModel(gf, names, pc, npcs, np.float32 if float32 else np.float64)
+
+    w = np.zeros(npcs) if w0 is None else np.array(w0, dtype=float)[:npcs]
+    sseHistory = []
+    prevObj = None
+    prevX = None
+    for it in range(maxIterations):
+        model.linearise(w)
+        R, tau = kabsch(model.centred(w), X)
+        w = ridgePCWeights(model, R, tau, X, priorPenalty(w, mwn))
+        x = np.hstack([tau, R.ravel(), w])
+        sse = ((X - model.exactCentred(w).dot(R.T) - tau) ** 2.0).sum()
+        sseHistory.append(sse)
+        if gf_params_callback is not None:
+            gf_params_callback(model.transformedParams(w, R, tau))
+        if fitCallback is not None:
+            fitCallback(np.hstack([tau - model.centre(w), eulerFromMatrix(R), w]), sse)
+
+        obj = sse + priorObjective(w, mwn)
+        if (prevObj is not None) and (abs(prevObj - obj) <= ftol * max(prevObj, 1e-12)):
+            break
+        if (prevX is not None) and (np.linalg.norm(x - prevX) <= xtol * (np.linalg.norm(x) + xtol)):
+            break
+        prevObj = obj
+        prevX = x
+
+    T = np.hstack([tau - model.centre(w), eulerFromMatrix(R), w])
+    outputModel = copy.deepcopy(gf)
+    outputModel.set_field_parameters(model.transformedParams(w, R, tau).astype(float).reshape((3, -1, 1)))
+    return outputModel, sseHistory, T
+
+
+def alignModelLandmarksPCPointCloud(gf, landmarks, pc, npcs, pointCloud, gf_params_callback=None, mw0=1.0,
+                                    mwn=1.0, w0=None, pointWeight=1.0, schedule=(0.1, 0.3, 1.0),
+                                    iterationsPerStage=10, maxCloudPoints=200000, rejectFactor=3.0, ftol=0.0,
+                                    xtol=0.0, fitCallback=None):
+    '''
+    Fit the PC model to landmarks plus a surface point cloud (N, 3).
+
+    Mesh nodes serve as model surface samples. A KD-tree is built once on the
+    point cloud, randomly decimated to at most maxCloudPoints points. Each
+    iteration matches the current nodes to their closest cloud points and
+    then takes one weighted Kabsch pose step and one ridge shape step on
+    landmarks and matches together. Nodes further than rejectFactor times
+    the median match distance are ignored. The fraction of nodes matched
+    per iteration follows schedule, one stage of iterationsPerStage
+    iterations each, so early iterations stay cheap on large meshes. A
+    stage ends early when the relative change in its objective is at most
+    ftol or the relative change in the pose and weights is at most xtol.
+    pointWeight is the total weight of the cloud term relative to one
+    landmark per point. The shape prior is that of
+    alignModelLandmarksPCAlternating. fitCallback(T, sse) is called after
+    every iteration, including those of the landmark-only start.
+
+    Returns the registered copy of gf, the landmark SSE after each
+    iteration, and T as alignModelLandmarksPCAlternating.
+    '''
+    names, targets = zip(*landmarks)
+    X = np.array(targets, dtype=float)
+    nl = len(X)
+    model = LandmarkModeModel(gf, names, pc, npcs)
+
+    rng = np.random.default_rng(0)
+    pointCloud = np.asarray(pointCloud, dtype=float)
+    if len(pointCloud) > maxCloudPoints:
+        pointCloud = pointCloud[rng.choice(len(pointCloud), maxCloudPoints, replace=False)]
+    tree = cKDTree(pointCloud)
+
+    # nodes relative to the model centre of mass, affine in w like the landmarks
+    nodes0 = model.basis.mean.reshape((3, -1)).T.astype(float)
+    nodeModes = model.basis.modes.T.reshape((npcs, 3, -1)).transpose((0, 2, 1)).astype(float)
+    Nc0 = nodes0 - model.c0
+    DN = nodeModes - model.dc[:, np.newaxis, :]
+    nodeOrder = rng.permutation(len(nodes0))
+
+    # start from the landmark-only fit
+    w = np.zeros(npcs) if w0 is None else np.array(w0, dtype=float)[:npcs]
+    for it in range(iterationsPerStage):
+        model.linearise(w)
+        R, tau = kabsch(model.centred(w), X)
+        w = ridgePCWeights(model, R, tau, X, priorPenalty(w, mwn))
+        if fitCallback is not None:
+            fitCallback(np.hstack([tau - model.centre(w), eulerFromMatrix(R), w]),
+                        ((X - model.exactCentred(w).dot(R.T) - tau) ** 2.0).sum())
+
+    sseHistory = []
+    for fraction in schedule:
+        sel = nodeOrder[:max(1, int(fraction * len(nodeOrder)))]
+        prevObj = None
+        prevX = None
+        for it in range(iterationsPerStage):
+            model.linearise(w)
+            nodes = (Nc0[sel] + np.tensordot(w, DN[:, sel], axes=1)).dot(R.T) + tau
+            dist, idx = tree.query(nodes)
+            keep = dist <= rejectFactor * max(np.median(dist), 1e-12)
+            matched = sel[keep]
+
+            source0 = np.vstack([model.Lc0, Nc0[matched]])
+            sourceD = np.concatenate([model.D, DN[:, matched]], axis=1)
+            target = np.vstack([X, pointCloud[idx[keep]]])
+            weights = np.hstack([np.ones(nl), np.full(len(matched), pointWeight / max(len(matched), 1))])
+
+            R, tau = kabsch(source0 + np.tensordot(w, sourceD, axes=1), target, weights)
+            w = _ridgeSolve(source0, sourceD, R, tau, target, priorPenalty(w, mwn), weights)
+
+            sseHistory.append(((X - model.exactCentred(w).dot(R.T) - tau) ** 2.0).sum())
+            if gf_params_callback is not None:
+                gf_params_callback(model.transformedParams(w, R, tau))
+            if fitCallback is not None:
+                fitCallback(np.hstack([tau - model.centre(w), eulerFromMatrix(R), w]), sseHistory[-1])
+
+            fitted = (source0 + np.tensordot(w, sourceD, axes=1)).dot(R.T) + tau
+            obj = (weights * ((fitted - target) ** 2.0).sum(1)).sum() + priorObjective(w, mwn)
+            x = np.hstack([tau, R.ravel(), w])
+            if (prevObj is not None) and (abs(prevObj - obj) <= ftol * max(prevObj, 1e-12)):
+                break
+            if (prevX is not None) and (np.linalg.norm(x - prevX) <= xtol * (np.linalg.norm(x) + xtol)):
+                break
+            prevObj = obj
+            prevX = x
+
+    T = np.hstack([tau - model.centre(w), eulerFromMatrix(R), w])
+    outputModel = copy.deepcopy(gf)
+    outputModel.set_field_parameters(model.transformedParams(w, R, tau).astype(float).reshape((3, -1, 1)))
+    return outputModel, sseHistory, T
+
+
+def similarityBatch(source, targets):
+    '''
+    Least-squares similarity transforms (Umeyama) for a stack of subjects.
+
+    source is (n_landmarks, 3) or (n_subjects, n_landmarks, 3), targets is
+    (n_subjects, n_landmarks, 3). Returns scales (n_subjects,), rotations
+    (n_subjects, 3, 3) and translations (n_subjects, 3) such that
+    targets ~= s.R.source + b, all from one batched SVD.
+    '''
+    targets = np.asarray(targets, dtype=float)
+    source = np.broadcast_to(np.asarray(source, dtype=float), targets.shape)
+    ms = source.mean(1)
+    mt = targets.mean(1)
+    A = source - ms[:, np.newaxis, :]
+    B = targets - mt[:, np.newaxis, :]
+
+    U, S, Vt = np.linalg.svd(np.einsum('nli,nlj->nij', A, B))
+    V = Vt.transpose((0, 2, 1))
+    d = np.ones_like(S)
+    d[:, 2] = np.sign(np.linalg.det(np.matmul(V, U.transpose((0, 2, 1)))))
+    R = np.matmul(V * d[:, np.newaxis, :], U.transpose((0, 2, 1)))
+    s = (S * d).sum(1) / (A ** 2.0).sum((1, 2))
+    b = mt - s[:, np.newaxis] * np.einsum('nij,nj->ni', R, ms)
+    return s, R, b
+
+
+def alignLandmarksLinScaleBatch(modelLandmarks, targetLandmarks, P):
+    '''
+    Vectorised equivalent of running model_alignment.alignModelLandmarksLinScale
+    on many subjects.
+
+    modelLandmarks is (n_landmarks, 3) evaluated on the template,
+    targetLandmarks is (n_subjects, n_landmarks, 3) and P is the point the
+    transforms scale and rotate about (the template centre of mass in the
+    step). Returns a list of RigidScaleTransformAboutPoint and an array of
+    per-subject landmark RMSEs.
+    '''
+    targetLandmarks = np.asarray(targetLandmarks, dtype=float)
+    s, R, b = similarityBatch(modelLandmarks, targetLandmarks)
+    fitted = s[:, np.newaxis, np.newaxis] * np.einsum('nij,lj->nli', R, modelLandmarks) + b[:, np.newaxis, :]
+    rmses = np.sqrt(((targetLandmarks - fitted) ** 2.0).sum(2).mean(1))
+
+    P = np.asarray(P, dtype=float)
+    # x' = sR(x - P) + P + t
+    t = b + s[:, np.newaxis] * np.einsum('nij,j->ni', R, P) - P
+    transforms = []
+    for i in range(len(s)):
+        T = np.hstack([t[i], eulerFromMatrix(R[i]), s[i]])
+        transforms.append(transformations.RigidScaleTransformAboutPoint(T, P=P))
+
+    return transforms, rmses
+
+
+def alignModelLandmarksLinScaleBatch(gf, landmarkNames, targetLandmarks):
+    '''
+    Evaluate landmarkNames on gf and register it to every subject in
+    targetLandmarks (n_subjects, n_landmarks, 3) in one batched solve.
+    '''
+    return alignLandmarksLinScaleBatch(evaluateModelLandmarks(gf, landmarkNames), targetLandmarks, gf.calc_CoM())
+
+
+def pcParams(pc, T):
+    '''
+    Flattened nodal parameters of RigidPCModesTransform parameters T applied
+    to the mean shape of pc, as gias3 applies them.
+    '''
+    modes = list(range(len(T) - 6))
+    P = pc.reconstruct(pc.getWeightsBySD(modes, T[6:]), modes)
+    return transform3D.transformRigid3DAboutCoM(P.reshape((3, -1)).T, T[:6]).T.ravel()
+
+
+def linScaleParams(gf, T):
+    '''
+    Flattened nodal parameters of RigidScaleTransformAboutPoint parameters T
+    about the centre of mass of gf applied to gf.
+    '''
+    P = np.asarray(gf.get_field_parameters(), dtype=float).reshape((3, -1)).T
+    return transform3D.transformRigidScale3DAboutP(P, T, gf.calc_CoM()).T.ravel()
@@ -0,0 +1,262 @@
+'''
+Chunked store of per-subject registration results.
+
+Results are written to a directory of .npz shards of at most chunkSize
+subjects each. Each shard holds the subject names, transform parameters T
+(NaN-padded), landmark RMSE, regMode, npcs and atlas identity. Only the
+shard holding the subject is rewritten on each add, so an add costs
+O(chunkSize) and every result is on disk as soon as add returns. Adding a
+subject again replaces its result.
+
+Running statistics are updated with Welford's algorithm and saved next to
+the shards. They hold the mean and covariance of the PC weights (one group
+per npcs and atlas), of the scale factor of linear scaling fits (one group
+per atlas), and of the RMSE, so cohort summaries need no reloading of the
+subjects. A replaced result is removed from them by reversing its update.
+Shards and statistics record the number of adds so far. If the statistics
+are behind the shards after a crash, they are rebuilt from the shards on
+open.
+'''
+import os
+import glob
+import hashlib
+
+import numpy as np
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import registration
+
+
+def atlasIdentity(pc):
+    '''
+    Short digest of the mean, modes and weights of the PC model pc, to tell
+    results fitted with different atlases apart.
+    '''
+    digest = hashlib.sha1()
+    for a in (pc.mean, pc.weights, pc.modes):
+        digest.update(np.ascontiguousarray(a, dtype=float).tobytes())
+    return digest.hexdigest()[:12]
+
+
+class RunningStats(object):
+    '''
+    Welford running mean and covariance of vectors of a fixed length.
+    '''
+
+    def __init__(self, dim):
+        self.n = 0
+        self.mean = np.zeros(dim)
+        self.M2 = np.zeros((dim, dim))
+
+    def update(self, x):
+        x = np.asarray(x, dtype=float)
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.M2 += np.outer(delta, x - self.mean)
+
+    def remove(self, x):
+        '''
+        Reverse an earlier update with x.
+        '''
+        x = np.asarray(x, dtype=float)
+        if self.n <= 1:
+            self.n = 0
+            self.mean = np.zeros_like(self.mean)
+            self.M2 = np.zeros_like(self.M2)
+            return
+        mean = (self.n * self.mean - x) / (self.n - 1)
+        self.M2 -= np.outer(x - mean, x - self.mean)
+        self.mean = mean
+        self.n -= 1
+
+    def covariance(self, ddof=1):
+        if self.n <= ddof:
+            return np.full(self.M2.shape, np.nan)
+        return self.M2 / (self.n - ddof)
+
+    def summary(self):
+        return {'n': self.n, 'mean': self.mean.copy(), 'covariance': self.covariance()}
+
+
+def _statsGroups(record):
+    T = np.asarray(record['T'], dtype=float)
+    suffix = '@' + record['atlas'] if record['atlas'] else ''
+    groups = {'rmse': [record['rmse']]}
+    if record['regMode'] in registration.PCMODES:
+        groups['pc{}{}'.format(record['npcs'], suffix)] = T[6:6 + record['npcs']]
+    elif len(T) > 6:
+        groups['scale' + suffix] = T[6:7]
+    return groups
+
+
+class CohortStore(object):
+
+    def __init__(self, directory, chunkSize=256):
+        self.directory = directory
+        self.chunkSize = chunkSize
+        self.stats = {}
+        self.revision = 0
+        self._statsRevision = None
+        self._subjects = {}
+        os.makedirs(directory, exist_ok=True)
+
+        self._shards = sorted(glob.glob(os.path.join(directory, 'shard_*.npz')))
+        for i, filename in enumerate(self._shards):
+            with np.load(filename) as data:
+                for subject in data['subject']:
+                    self._subjects[str(subject)] = i
+                if 'revision' in data.files:
+                    self.revision = max(self.revision, int(data['revision']))
+
+        self._current = self._emptyChunk()
+        if self._shards:
+            last = self._loadShard(self._shards[-1])
+            if len(last['subject']) < chunkSize:
+                self._current = last
+            else:
+                self._shards.append(self._shardName(len(self._shards)))
+        else:
+            self._shards.append(self._shardName(0))
+        # stores written before revisions were kept
+        self.revision = max(self.revision, len(self))
+
+        self._loadStats()
+        if self._statsRevision != self.revision:
+            self._rebuildStats()
+
+    def __len__(self):
+        return (len(self._shards) - 1) * self.chunkSize + len(self._current['subject'])
+
+    def __contains__(self, subject):
+        return subject in self._subjects
+
+    def _shardName(self, i):
+        return os.path.join(self.directory, 'shard_{:05d}.npz'.format(i))
+
+    def _emptyChunk(self):
+        return {'subject': [], 'T': [], 'rmse': [], 'regMode': [], 'npcs': [], 'atlas': []}
+
+    def _loadShard(self, filename):
+        with np.load(filename) as data:
+            n = len(data['subject'])
+            return {'subject': [str(subject) for subject in data['subject']],
+                    'T': [t[~np.isnan(t)] for t in data['T']],
+                    'rmse': list(data['rmse']),
+                    'regMode': list(data['regMode']),
+                    'npcs': list(data['npcs']),
+                    'atlas': [str(atlas) for atlas in data['atlas']] if 'atlas' in data.files else [''] * n,
+                    }
+
+    def _saveNpz(self, filename, **arrays):
+        # the temporary name must not match the shard pattern
+        tmp = os.path.join(self.directory, '.tmp_' + os.path.basename(filename))
+        np.savez(tmp, **arrays)
+        os.replace(tmp, filename)
+
+    def _saveChunk(self, shardIndex, c):
+        width = max(len(t) for t in c['T'])
+        T = np.full((len(c['T']), width), np.nan)
+        for i, t in enumerate(c['T']):
+            T[i, :len(t)] = t
+        self._saveNpz(self._shards[shardIndex],
+                      subject=np.array(c['subject'], dtype=str),
+                      T=T,
+                      rmse=np.array(c['rmse'], dtype=float),
+                      regMode=np.array(c['regMode'], dtype=int),
+                      npcs=np.array(c['npcs'], dtype=int),
+                      atlas=np.array(c['atlas'], dtype=str),
+                      revision=self.revision)
+
+    def _loadStats(self):
+        filename = os.path.join(self.directory, 'stats.npz')
+        if not os.path.exists(filename):
+            return
+        with np.load(filename) as data:
+            if 'revision' not in data.files:
+                return
+            self._statsRevision = int(data['revision'])
+            for group in data['groups']:
+                stats = RunningStats(len(data[group + '_mean']))
+                stats.n = int(data[group + '_n'])
+                stats.mean = data[group + '_mean']
+                stats.M2 = data[group + '_M2']
+                self.stats[str(group)] = stats
+
+    def _saveStats(self):
+        arrays = {'revision': self.revision, 'groups': np.array(sorted(self.stats), dtype=str)}
+        for group, stats in self.stats.items():
+            arrays[group + '_n'] = stats.n
+            arrays[group + '_mean'] = stats.mean
+            arrays[group + '_M2'] = stats.M2
+        self._saveNpz(os.path.join(self.directory, 'stats.npz'), **arrays)
+        self._statsRevision = self.revision
+
+    def _updateStats(self, record):
+        for group, x in _statsGroups(record).items():
+            if group not in self.stats:
+                self.stats[group] = RunningStats(len(x))
+            self.stats[group].update(x)
+
+    def _removeStats(self, record):
+        for group, x in _statsGroups(record).items():
+            self.stats[group].remove(x)
+            if self.stats[group].n == 0:
+                del self.stats[group]
+
+    def _rebuildStats(self):
+        self.stats = {}
+        for r in self.records():
+            self._updateStats(r)
+        self._saveStats()
+
+    def add(self, subject, T, rmse, regMode, npcs, atlas=''):
+        '''
+        Store one subject's result and update the running statistics. A
+        result for a subject that is already stored replaces the old one.
+        atlas identifies the atlas fitted, see atlasIdentity.
+        '''
+        record = {'subject': subject, 'T': np.asarray(T, dtype=float), 'rmse': float(rmse),
+                  'regMode': int(regMode), 'npcs': int(npcs), 'atlas': atlas}
+        self.revision += 1
+
+        shardIndex = self._subjects.get(subject)
+        if shardIndex is None:
+            if len(self._current['subject']) >= self.chunkSize:
+                self._shards.append(self._shardName(len(self._shards)))
+                self._current = self._emptyChunk()
+            shardIndex = len(self._shards) - 1
+            chunk = self._current
+            for key, value in record.items():
+                chunk[key].append(value)
+            self._subjects[subject] = shardIndex
+        else:
+            if shardIndex == len(self._shards) - 1:
+                chunk = self._current
+            else:
+                chunk = self._loadShard(self._shards[shardIndex])
+            i = chunk['subject'].index(subject)
+            self._removeStats(dict((key, values[i]) for key, values in chunk.items()))
+            for key, value in record.items():
+                chunk[key][i] = value
+        self._saveChunk(shardIndex, chunk)
+
+        self._updateStats(record)
+        self._saveStats()
+
+    def records(self):
+        '''
+        Iterate over all stored results, one shard in memory at a time.
+        '''
+        for filename in self._shards:
+            if not os.path.exists(filename):
+                continue
+            shard = self._loadShard(filename)
+            for i in range(len(shard['subject'])):
+                yield dict((key, values[i]) for key, values in shard.items())
+
+    def summary(self):
+        '''
+        Dict of group: {n, mean, covariance} for the groups 'rmse',
+        'scale@<atlas>' and 'pc<npcs>@<atlas>'.
+        '''
+        return dict((group, stats.summary()) for group, stats in self.stats.items())
@@ -6,6 +6,7 @@ DEFAULT_STYLE_SHEET = ''
 
 REGMODES = {'PC': 1,
             'Linear Scaling': 2,
+            'PC + Point Cloud': 3,
             }
 
 
@@ -14,9 +15,9 @@ class ConfigureDialog(QtWidgets.QDialog):
     Configure dialog to present the user with the options to configure this step.
     '''
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, regModes=(1, 2, 3)):
         '''
-        Constructor
+        Constructor. Only the registration modes in regModes are offered.
         '''
         QtWidgets.QDialog.__init__(self, parent)
 
@@ -30,14 +31,36 @@ class ConfigureDialog(QtWidgets.QDialog):
         # Set a place holder for a callable that will get set from the step.
         # We will use this method to decide whether the identifier is unique.
         self.identifierOccursCount = None
+        self._regModes = regModes
 
         self._setupDialog()
         self._makeConnections()
 
     def _setupDialog(self):
-        self._ui.comboBoxRegMode.addItem('PC')
-        self._ui.comboBoxRegMode.addItem('Linear Scaling')
+        for name in sorted(REGMODES, key=REGMODES.get):
+            if REGMODES[name] in self._regModes:
+                self._ui.comboBoxRegMode.addItem(name)
         self._ui.spinBoxNPCs.setSingleStep(1)
+        # see registration.align
+        self._ui.doubleSpinBoxXtol.setToolTip('PC optimiser and Linear Scaling: fmin xtol of each stage.\n'
+                                              'Alternating and PC + Point Cloud: relative change in pose and '
+                                              'weights.\nLeastsq: least_squares xtol.')
+        self._ui.doubleSpinBoxFtol.setToolTip('PC optimiser and Linear Scaling: fmin ftol of each stage.\n'
+                                              'Alternating and PC + Point Cloud: relative change in the '
+                                              'objective.\nLeastsq: least_squares ftol.')
+        self._ui.spinBoxMaxIterations.setToolTip('PC optimiser and Linear Scaling: fmin iterations per stage.\n'
+                                                 'Alternating: iterations.\n'
+                                                 'PC + Point Cloud: iterations per matching stage.\n'
+                                                 'Leastsq: residual evaluations.')
+        # see budget
+        self._ui.spinBoxIterationBudget.setToolTip('Iterations over all stages of the fit.\n'
+                                                   'PC optimiser and Linear Scaling: fmin iterations.\n'
+                                                   'Alternating and PC + Point Cloud: iterations.\n'
+                                                   'Leastsq: residual evaluations.')
+        self._ui.doubleSpinBoxTimeBudget.setToolTip('Wall-clock time of the fit, checked after every '
+                                                    'iteration.')
+        self._ui.doubleSpinBoxTargetRMSE.setToolTip('Stop as soon as the landmark RMSE reaches this, checked '
+                                                    'after every iteration.')
 
     def _makeConnections(self):
         self._ui.lineEdit0.textChanged.connect(self.validate)
@@ -93,6 +116,12 @@ class ConfigureDialog(QtWidgets.QDialog):
         config['LHJC'] = self._ui.lineEditLHJC.text()
         config['RHJC'] = self._ui.lineEditRHJC.text()
         config['GUI'] = self._ui.checkBoxGUI.isChecked()
+        config['timeBudget'] = self._ui.doubleSpinBoxTimeBudget.value()
+        config['iterationBudget'] = self._ui.spinBoxIterationBudget.value()
+        config['xtol'] = self._ui.doubleSpinBoxXtol.value()
+        config['ftol'] = self._ui.doubleSpinBoxFtol.value()
+        config['maxIterations'] = self._ui.spinBoxMaxIterations.value()
+        config['targetRMSE'] = self._ui.doubleSpinBoxTargetRMSE.value()
         return config
 
     def setConfig(self, config):
@@ -103,7 +132,10 @@ class ConfigureDialog(QtWidgets.QDialog):
         '''
         self._previousIdentifier = config['identifier']
         self._ui.lineEdit0.setText(config['identifier'])
-        self._ui.comboBoxRegMode.setCurrentIndex(config['regMode'] - 1)
+        if config['regMode'] in self._regModes:
+            self._ui.comboBoxRegMode.setCurrentIndex(sorted(self._regModes).index(config['regMode']))
+        else:
+            self._ui.comboBoxRegMode.setCurrentIndex(0)
         self._ui.spinBoxNPCs.setValue(config['npcs'])
         self._ui.lineEditLASIS.setText(config['LASIS'])
         self._ui.lineEditRASIS.setText(config['RASIS'])
@@ -113,3 +145,9 @@ class ConfigureDialog(QtWidgets.QDialog):
         self._ui.lineEditLHJC.setText(config['LHJC'])
         self._ui.lineEditRHJC.setText(config['RHJC'])
         self._ui.checkBoxGUI.setChecked(bool(config['GUI']))
+        self._ui.doubleSpinBoxTimeBudget.setValue(config['timeBudget'])
+        self._ui.spinBoxIterationBudget.setValue(config['iterationBudget'])
+        self._ui.doubleSpinBoxXtol.setValue(config['xtol'])
+        self._ui.doubleSpinBoxFtol.setValue(config['ftol'])
+        self._ui.spinBoxMaxIterations.setValue(config['maxIterations'])
+        self._ui.doubleSpinBoxTargetRMSE.setValue(config['targetRMSE'])
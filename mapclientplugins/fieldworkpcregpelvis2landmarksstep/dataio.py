@@ -0,0 +1,64 @@
+'''
+Loading of step inputs and configs from disk for the batch tools.
+'''
+import os
+import json
+
+import numpy as np
+
+from gias3.learning import PCA
+from gias3.fieldwork.field import geometric_field
+
+
+def loadPC(filename):
+    '''
+    Load a gias3 principal components model (ju#principalcomponents).
+    '''
+    return PCA.loadPrincipalComponents(filename)
+
+
+def loadModel(gfFilename, ensFilename=None, meshFilename=None):
+    '''
+    Load a fieldwork geometric field (ju#fieldworkmodel).
+    '''
+    return geometric_field.load_geometric_field(gfFilename, ensFilename, meshFilename)
+
+
+def loadLandmarks(filename):
+    '''
+    Load a landmarks file into the ju#landmarks dict of name: coordinates.
+
+    JSON files must contain an object of name: [x, y, z]. Other files are
+    read as one landmark per line, "name x y z", separated by whitespace or
+    commas. Blank lines and lines starting with # are ignored.
+    '''
+    if os.path.splitext(filename)[1].lower() == '.json':
+        with open(filename, 'r') as f:
+            data = json.load(f)
+        return dict((name, np.array(coords, dtype=float)) for name, coords in data.items())
+
+    landmarks = {}
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if (not line) or line.startswith('#'):
+                continue
+            fields = line.replace(',', ' ').split()
+            if len(fields) != 4:
+                raise ValueError('Invalid landmark line in {}: {}'.format(filename, line))
+            landmarks[fields[0]] = np.array(fields[1:], dtype=float)
+
+    return landmarks
+
+
+def loadConfig(filename):
+    '''
+    Load a step config as written by the step's serialize.
+    '''
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def saveConfig(filename, config):
+    with open(filename, 'w') as f:
+        f.write(json.dumps(config, default=lambda o: o.__dict__, sort_keys=True, indent=4))
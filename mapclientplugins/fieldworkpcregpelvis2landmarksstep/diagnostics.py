@@ -0,0 +1,129 @@
+'''
+Per-landmark fit diagnostics.
+
+The in-sample landmark RMSE is optimistic when only 5-7 landmarks are fitted.
+The leave-one-landmark-out (LOLO) errors here are computed analytically from
+the fit linearised at its solution (including the hip joint centres, see
+closedform.LandmarkModeModel): for a penalised linear least-squares fit
+with hat matrix H, the residual of landmark i when it is left out of the fit
+is (I - H_ii)^-1 r_i, where r_i is its in-sample residual and H_ii its 3x3
+diagonal block. No refitting is needed.
+'''
+import numpy as np
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import closedform
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import rotations
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import registration
+
+
+def _skew(v):
+    return np.array([[0.0, -v[2], v[1]],
+                     [v[2], 0.0, -v[0]],
+                     [-v[1], v[0], 0.0]])
+
+
+def _poseJacobian(X):
+    '''
+    Jacobian of points X (n, 3) with respect to a translation and a small
+    rotation about the origin applied after the current transform,
+    (3n, 6).
+    '''
+    J = np.zeros((3 * len(X), 6))
+    for i, x in enumerate(X):
+        J[3 * i:3 * i + 3, :3] = np.eye(3)
+        J[3 * i:3 * i + 3, 3:] = -_skew(x)
+    return J
+
+
+def looResiduals(J, residuals, penalty=None):
+    '''
+    Leave-one-landmark-out residuals (n, 3) of a linear fit with Jacobian J
+    (3n, p), in-sample residuals (n, 3) and an optional quadratic penalty on
+    the parameters, either diagonal (p,) or a full (p, p) matrix.
+    '''
+    A = J.T.dot(J)
+    if penalty is not None:
+        penalty = np.asarray(penalty, dtype=float)
+        A = A + (np.diag(penalty) if penalty.ndim == 1 else penalty)
+    H = J.dot(np.linalg.pinv(A)).dot(J.T)
+
+    loo = np.empty_like(residuals)
+    for i, r in enumerate(residuals):
+        Hii = H[3 * i:3 * i + 3, 3 * i:3 * i + 3]
+        loo[i] = np.linalg.pinv(np.eye(3) - Hii).dot(r)
+    return loo
+
+
+def _priorCurvature(w, mwn):
+    '''
+    Half the Hessian of the shape prior mwn * ||w|| at w.
+    '''
+    norm = np.linalg.norm(w)
+    if norm == 0.0:
+        return np.zeros((len(w), len(w)))
+    u = w / norm
+    return 0.5 * mwn / norm * (np.eye(len(w)) - np.outer(u, u))
+
+
+def _pcJacobian(model, inputLandmarks, pc, config, T):
+    names, targets = zip(*inputLandmarks)
+    targets = np.array(targets, dtype=float)
+    npcs = config['npcs']
+    lm = closedform.LandmarkModeModel(model, names, pc, npcs)
+
+    w = T[6:6 + npcs]
+    lm.linearise(w)
+    R = rotations.matrixFromEuler(T[3:6])
+    tau = T[:3] + lm.centre(w)
+    fitted = lm.centred(w).dot(R.T) + tau
+
+    # shape part: d fitted_i / d w = R.D_i
+    Jw = np.einsum('ij,klj->lik', R, lm.D).reshape((-1, npcs))
+    J = np.hstack([_poseJacobian(fitted - tau), Jw])
+    penalty = np.zeros((6 + npcs, 6 + npcs))
+    penalty[6:, 6:] = _priorCurvature(w, config.get('pcfitmwn', registration.PCFITMWN))
+    return J, targets - fitted, penalty
+
+
+def _linScaleJacobian(model, inputLandmarks, T):
+    names, targets = zip(*inputLandmarks)
+    targets = np.array(targets, dtype=float)
+    X = closedform.evaluateModelLandmarks(model, names)
+
+    P = np.asarray(model.calc_CoM(), dtype=float)
+    R = rotations.matrixFromEuler(T[3:6])
+    s = T[6]
+    rotated = (X - P).dot(R.T)
+    fitted = s * rotated + P + T[:3]
+
+    J = np.hstack([_poseJacobian(fitted - P - T[:3]), rotated.reshape((-1, 1))])
+    return J, targets - fitted, None
+
+
+def landmarkDiagnostics(model, inputLandmarks, pc, config, T):
+    '''
+    Per-landmark residuals and analytic LOLO errors of a registration.
+
+    model is the input (template) model, inputLandmarks the list of
+    (model landmark name, target coordinates) that was fitted and T the fitted
+    transform parameters. Returns a dict with the landmark names, residual
+    vectors and norms, LOLO residual vectors and norms, and in-sample and
+    LOLO RMSEs.
+    '''
+    T = np.asarray(T, dtype=float)
+    if config['regMode'] in registration.PCMODES:
+        J, residuals, penalty = _pcJacobian(model, inputLandmarks, pc, config, T)
+    else:
+        J, residuals, penalty = _linScaleJacobian(model, inputLandmarks, T)
+
+    loo = looResiduals(J, residuals, penalty)
+    residualNorms = np.linalg.norm(residuals, axis=1)
+    looNorms = np.linalg.norm(loo, axis=1)
+    return {'landmarks': [n for n, x in inputLandmarks],
+            'residuals': residuals.tolist(),
+            'residualErrors': residualNorms.tolist(),
+            'looResiduals': loo.tolist(),
+            'looErrors': looNorms.tolist(),
+            'rmse': float(np.sqrt((residualNorms ** 2.0).mean())),
+            'looRMSE': float(np.sqrt((looNorms ** 2.0).mean())),
+            }
@@ -0,0 +1,176 @@
+'''
+Rigid + PC landmark residual kernel and a least-squares PC solver using it.
+
+For the 5-7 landmark problem the cost of each objective evaluation is
+dominated by Python and NumPy call overhead. If Numba is installed the
+residual kernel is JIT compiled; otherwise an equivalent vectorised NumPy
+implementation is used.
+
+Parameters x follow T of RigidPCModesTransform: [tx, ty, tz, rx, ry, rz,
+w0, w1, ...], see rotations.
+'''
+import copy
+
+import numpy as np
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import rotations
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _residualsLoop(x, Lc0, D, dc, c0, targets, mwn, out):
+    npcs = D.shape[0]
+    nl = Lc0.shape[0]
+    cx = np.cos(x[3])
+    sx = np.sin(x[3])
+    cy = np.cos(x[4])
+    sy = np.sin(x[4])
+    cz = np.cos(x[5])
+    sz = np.sin(x[5])
+    # R = Rx.Ry.Rz
+    r00 = cy * cz
+    r01 = -cy * sz
+    r02 = sy
+    r10 = cx * sz + sx * sy * cz
+    r11 = cx * cz - sx * sy * sz
+    r12 = -sx * cy
+    r20 = sx * sz - cx * sy * cz
+    r21 = sx * cz + cx * sy * sz
+    r22 = cx * cy
+
+    t0 = c0[0] + x[0]
+    t1 = c0[1] + x[1]
+    t2 = c0[2] + x[2]
+    for k in range(npcs):
+        t0 += x[6 + k] * dc[k, 0]
+        t1 += x[6 + k] * dc[k, 1]
+        t2 += x[6 + k] * dc[k, 2]
+
+    for i in range(nl):
+        p0 = Lc0[i, 0]
+        p1 = Lc0[i, 1]
+        p2 = Lc0[i, 2]
+        for k in range(npcs):
+            p0 += x[6 + k] * D[k, i, 0]
+            p1 += x[6 + k] * D[k, i, 1]
+            p2 += x[6 + k] * D[k, i, 2]
+        out[3 * i] = r00 * p0 + r01 * p1 + r02 * p2 + t0 - targets[i, 0]
+        out[3 * i + 1] = r10 * p0 + r11 * p1 + r12 * p2 + t1 - targets[i, 1]
+        out[3 * i + 2] = r20 * p0 + r21 * p1 + r22 * p2 + t2 - targets[i, 2]
+
+    norm = 0.0
+    for k in range(npcs):
+        norm += x[6 + k] * x[6 + k]
+    scale = np.sqrt(mwn / np.sqrt(norm)) if norm > 0.0 else 0.0
+    for k in range(npcs):
+        out[3 * nl + k] = scale * x[6 + k]
+
+    return out
+
+
+def _residualsNumpy(x, Lc0, D, dc, c0, targets, mwn, out):
+    w = x[6:]
+    R = rotations.matrixFromEuler(x[3:6])
+    fitted = (Lc0 + np.tensordot(w, D, axes=1)).dot(R.T) + (c0 + w.dot(dc) + x[:3])
+    nl3 = 3 * Lc0.shape[0]
+    out[:nl3] = (fitted - targets).ravel()
+    norm = np.linalg.norm(w)
+    out[nl3:] = np.sqrt(mwn / norm) * w if norm > 0.0 else 0.0
+    return out
+
+
+if numba is not None:
+    _residualsJit = numba.njit(cache=True)(_residualsLoop)
+else:
+    _residualsJit = None
+
+
+def residualKernel(jit=True):
+    '''
+    The landmark residual kernel, compiled if jit and Numba is available.
+    Signature: kernel(x, Lc0, D, dc, c0, targets, mwn, out) writes the
+    3 * n_landmarks landmark residuals followed by the npcs prior residuals
+    into out and returns it. The prior residuals are sqrt(mwn / ||w||) * w,
+    so their sum of squares is the gias3 shape prior mwn * ||w||.
+    '''
+    if jit and (_residualsJit is not None):
+        return _residualsJit
+    return _residualsNumpy
+
+
+def alignModelLandmarksPCLeastSq(gf, landmarks, pc, npcs, gf_params_callback=None, mw0=1.0, mwn=1.0,
+                                 w0=None, jit=True, xtol=1e-8, ftol=1e-8, maxIterations=None, fitCallback=None,
+                                 maxRelinearisations=10):
+    '''
+    Drop-in alternative to model_alignment.alignModelLandmarksPC that
+    jointly optimises pose and PC weights with scipy least_squares on the
+    residual kernel, minimising the same objective (see closedform).
+    gf_params_callback is called with the nodal
+    parameters whenever the landmark SSE improves. xtol and ftol are the
+    least_squares tolerances and maxIterations caps the residual
+    evaluations of each least_squares run. fitCallback(T, sse) is called
+    after every residual evaluation with its x and landmark SSE.
+
+    With nonlinear landmarks (see closedform.LandmarkModeModel) the fit is
+    repeated from its solution with the landmark model re-linearised there,
+    up to maxRelinearisations times until x changes by at most xtol, and
+    the SSE is evaluated on the shape itself.
+    '''
+    # imported here so that the kernels themselves only need NumPy
+    from scipy import optimize
+    from mapclientplugins.fieldworkpcregpelvis2landmarksstep import closedform
+
+    names, targets = zip(*landmarks)
+    targets = np.array(targets, dtype=float)
+    model = closedform.LandmarkModeModel(gf, names, pc, npcs)
+    kernel = residualKernel(jit)
+
+    # start from one alternating step, away from the kink of the prior at w = 0
+    w = np.zeros(npcs) if w0 is None else np.array(w0, dtype=float)[:npcs]
+    model.linearise(w)
+    R, tau = rotations.kabsch(model.centred(w), targets)
+    w = closedform.ridgePCWeights(model, R, tau, targets, closedform.priorPenalty(w, mwn))
+    model.linearise(w)
+    R, tau = rotations.kabsch(model.centred(w), targets)
+    x0 = np.hstack([tau - model.centre(w), rotations.eulerFromMatrix(R), w])
+
+    out = np.empty(3 * len(targets) + npcs)
+    sseHistory = []
+
+    def residuals(x):
+        r = kernel(x, model.Lc0, D, model.dc, model.c0, targets, mwn, out).copy()
+        if model.nonlinear:
+            sse = ((model.posedLandmarks(x) - targets) ** 2.0).sum()
+        else:
+            sse = (r[:3 * len(targets)] ** 2.0).sum()
+        if (not sseHistory) or (sse < sseHistory[-1]):
+            sseHistory.append(sse)
+            if gf_params_callback is not None:
+                gf_params_callback(_params(model, x))
+        if fitCallback is not None:
+            fitCallback(np.array(x), sse)
+        return r
+
+    for it in range(maxRelinearisations if model.nonlinear else 1):
+        D = np.ascontiguousarray(model.D)
+        xOpt = optimize.least_squares(residuals, x0, method='lm', xtol=xtol, ftol=ftol, max_nfev=maxIterations).x
+        model.linearise(xOpt[6:])
+        if np.linalg.norm(xOpt - x0) <= xtol * (np.linalg.norm(xOpt) + xtol):
+            break
+        x0 = xOpt
+
+    residuals(xOpt)
+    sseHistory.append(((model.posedLandmarks(xOpt) - targets) ** 2.0).sum())
+
+    outputModel = copy.deepcopy(gf)
+    outputModel.set_field_parameters(_params(model, xOpt).reshape((3, -1, 1)))
+    return outputModel, sseHistory, xOpt
+
+
+def _params(model, x):
+    w = x[6:]
+    R = rotations.matrixFromEuler(x[3:6])
+    return model.transformedParams(w, R, x[:3] + model.centre(w))
@@ -0,0 +1,79 @@
+'''
+Lazily materialised output model.
+
+Holds only a reference to the template (and PC model) and the fitted
+transform parameters T. Nodal parameters, and the geometric field built from
+them, are reconstructed on first access, so downstream steps that only use
+the transform or the RMSE never pay for the mesh. Once built, the field
+belongs to the lazy model and lives as long as it does, so changes made to
+it downstream are kept.
+'''
+import copy
+
+import numpy as np
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import closedform
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import registration
+
+_OWNATTRIBUTES = ('template', 'pc', 'T', 'regMode', 'npcs', '_model')
+
+
+class LazyFieldworkModel(object):
+    '''
+    Stand-in for the registered fieldwork model. Attributes not defined here
+    (get_field_parameters, triangulate, ...) are read from and written to
+    the materialised model. isinstance checks see the template's class, and
+    copies and pickles are of the materialised model.
+    '''
+
+    def __init__(self, template, pc, T, regMode, npcs=None):
+        self.template = template
+        self.pc = pc
+        self.T = np.asarray(T, dtype=float)
+        self.regMode = regMode
+        self.npcs = len(self.T) - 6 if npcs is None else npcs
+        self._model = None
+
+    @property
+    def __class__(self):
+        return type(self.template)
+
+    def parameters(self):
+        '''
+        Flattened nodal parameters of the registered model.
+        '''
+        if self._model is not None:
+            return self._model.get_field_parameters().ravel()
+        if self.regMode in registration.PCMODES:
+            return closedform.pcParams(self.pc, self.T[:6 + self.npcs])
+        return closedform.linScaleParams(self.template, self.T)
+
+    def materialise(self):
+        '''
+        The registered geometric field, built on first access.
+        '''
+        if self._model is None:
+            model = copy.deepcopy(self.template)
+            model.set_field_parameters(self.parameters().reshape((3, -1, 1)))
+            self._model = model
+        return self._model
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name in _OWNATTRIBUTES:
+            raise AttributeError(name)
+        return getattr(self.materialise(), name)
+
+    def __setattr__(self, name, value):
+        if name in _OWNATTRIBUTES:
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.materialise(), name, value)
+
+    def __copy__(self):
+        return copy.copy(self.materialise())
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self.materialise(), memo)
+
+    def __reduce_ex__(self, protocol):
+        return self.materialise().__reduce_ex__(protocol)
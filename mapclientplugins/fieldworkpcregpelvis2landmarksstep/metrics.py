@@ -0,0 +1,280 @@
+'''
+Registration metrics in the Prometheus text exposition format.
+
+Counters, gauges and histograms are plain in-process objects updated under
+a lock, so recording costs a few dictionary operations per registration and
+per optimiser callback. The registry can be written atomically to a file
+(e.g. for the node_exporter textfile collector) or served over HTTP on
+localhost:
+
+    metrics.writeTextfile('/var/lib/node_exporter/pelvisreg.prom')
+    metrics.serveMetrics(9465)    # GET http://127.0.0.1:9465/metrics
+
+Metrics are per process. Worker processes of the batch, server, watch,
+tuning and multi-atlas tools record their fits inside collectFits and return
+the records with their results, and the parent adds them to its registry
+with recordFits. Fits are labelled by kind, so that the speculative
+background fits of the viewer and the fits of a parameter search do not
+count as subject registrations, and cancelled fits are counted separately
+from failures.
+'''
+import os
+import time
+import threading
+import contextlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+def _formatLabels(key):
+    if not key:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in key) + '}'
+
+
+def _formatValue(v):
+    if v == float('inf'):
+        return '+Inf'
+    return repr(float(v))
+
+
+class _Metric(object):
+    typeName = None
+
+    def __init__(self, name, help, registry=None):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self._values = {}
+        (REGISTRY if registry is None else registry).register(self)
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.typeName)]
+        with self._lock:
+            lines.extend('{}{} {}'.format(name, _formatLabels(key), _formatValue(v)) for name, key, v in
+                         self._samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    typeName = 'counter'
+
+    def inc(self, amount=1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(tuple(sorted(labels.items())), 0.0)
+
+    def _samples(self):
+        return [(self.name, key, v) for key, v in sorted(self._values.items())]
+
+
+class Gauge(_Metric):
+    typeName = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+    def _samples(self):
+        return [(self.name, key, v) for key, v in sorted(self._values.items())]
+
+
+class Histogram(_Metric):
+    typeName = 'histogram'
+
+    def __init__(self, name, help, buckets, registry=None):
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        super(Histogram, self).__init__(name, help, registry)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, le in enumerate(self.buckets):
+                if value <= le:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def _samples(self):
+        samples = []
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for le, c in zip(self.buckets, counts):
+                cumulative += c
+                samples.append((self.name + '_bucket', key + (('le', _formatValue(le)),), cumulative))
+            samples.append((self.name + '_sum', key, total))
+            samples.append((self.name + '_count', key, cumulative))
+        return samples
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        return '\n'.join(m.render() for m in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+REGISTRATIONS = Counter('pelvisreg_registrations_total', 'Registrations completed, by regMode and kind.')
+FAILURES = Counter('pelvisreg_failures_total', 'Registrations that raised an exception, by regMode and kind.')
+CANCELLED = Counter('pelvisreg_cancelled_total', 'Registrations cancelled before completion, by regMode and kind.')
+CALLBACKS = Counter('pelvisreg_callbacks_total', 'gf_params callbacks emitted by the optimisers.')
+FIT_SECONDS = Histogram('pelvisreg_fit_seconds', 'Wall-clock time of one registration, by kind.',
+                        (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+FIT_ITERATIONS = Histogram('pelvisreg_fit_iterations', 'gf_params callbacks per registration, by kind.',
+                           (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000))
+FIT_RMSE = Histogram('pelvisreg_fit_rmse', 'Landmark RMSE of completed registrations, by kind.',
+                     (0.5, 1.0, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 20.0, 50.0))
+CACHE_HITS = Counter('pelvisreg_cache_hits_total', 'Cache hits, by cache.')
+CACHE_MISSES = Counter('pelvisreg_cache_misses_total', 'Cache misses, by cache.')
+JOBS = Counter('pelvisreg_jobs_total', 'Server jobs finished, by status.')
+JOB_SECONDS = Histogram('pelvisreg_job_seconds', 'Server job time from submission to completion.',
+                        (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0))
+QUEUE_DEPTH = Gauge('pelvisreg_queue_depth', 'Server jobs queued or running, by state.')
+
+
+class FitRecorder(object):
+    '''
+    Records one registration: wrap() the gf_params callback to count
+    emissions, then call done(), failed() or cancelled(). kind labels the
+    fit: 'fit', 'speculative' for background fits the user may never look
+    at, or 'tuning' for the fits of a parameter search.
+    '''
+
+    def __init__(self, regMode, kind='fit'):
+        self.regMode = regMode
+        self.kind = kind
+        self.nCallbacks = 0
+        self._start = time.perf_counter()
+
+    def wrap(self, callback):
+        def countingCallback(params):
+            self.nCallbacks += 1
+            if callback is not None:
+                callback(params)
+
+        return countingCallback
+
+    def _record(self, status, rmse=None):
+        recordFit({'regMode': self.regMode, 'kind': self.kind, 'status': status, 'callbacks': self.nCallbacks,
+                   'seconds': time.perf_counter() - self._start, 'rmse': rmse})
+
+    def done(self, rmse):
+        self._record('done', float(rmse))
+
+    def failed(self):
+        self._record('failed')
+
+    def cancelled(self):
+        self._record('cancelled')
+
+
+_collecting = threading.local()
+
+
+@contextlib.contextmanager
+def collectFits():
+    '''
+    Collect the fits recorded by this thread in the block into the yielded
+    list instead of the registry. Worker processes return the list with
+    their results for the parent to pass to recordFits.
+    '''
+    fits = []
+    if not hasattr(_collecting, 'stack'):
+        _collecting.stack = []
+    _collecting.stack.append(fits)
+    try:
+        yield fits
+    finally:
+        _collecting.stack.pop()
+
+
+def recordFit(fit):
+    '''
+    Add one fit record of a FitRecorder to the registry, or to the list of
+    the innermost collectFits block.
+    '''
+    stack = getattr(_collecting, 'stack', None)
+    if stack:
+        stack[-1].append(fit)
+        return
+
+    CALLBACKS.inc(fit['callbacks'])
+    if fit['status'] == 'done':
+        REGISTRATIONS.inc(regMode=fit['regMode'], kind=fit['kind'])
+        FIT_SECONDS.observe(fit['seconds'], kind=fit['kind'])
+        FIT_ITERATIONS.observe(fit['callbacks'], kind=fit['kind'])
+        FIT_RMSE.observe(fit['rmse'], kind=fit['kind'])
+    elif fit['status'] == 'failed':
+        FAILURES.inc(regMode=fit['regMode'], kind=fit['kind'])
+    else:
+        CANCELLED.inc(regMode=fit['regMode'], kind=fit['kind'])
+
+
+def recordFits(fits):
+    for fit in fits:
+        recordFit(fit)
+
+
+def writeTextfile(filename, registry=None):
+    '''
+    Atomically write the registry to filename.
+    '''
+    registry = REGISTRY if registry is None else registry
+    tmp = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(registry.render())
+    os.replace(tmp, filename)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        data = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_servers = {}
+
+
+def serveMetrics(port, host='127.0.0.1', registry=None):
+    '''
+    Serve /metrics from a daemon thread. Only one server is started per
+    (host, port); later calls return the running one.
+    '''
+    if (host, port) not in _servers:
+        handler = type('Handler', (_Handler,), {'registry': REGISTRY if registry is None else registry})
+        httpd = ThreadingHTTPServer((host, port), handler)
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        _servers[(host, port)] = httpd
+    return _servers[(host, port)]
@@ -0,0 +1,96 @@
+'''
+Concurrent fitting of several PC atlases with automatic model selection.
+
+Each atlas is a PC model with its matching template. The step's
+registration is run for every atlas in a worker process, and the best fit
+is chosen by one of the CRITERIA:
+
+    rmse  in-sample landmark RMSE
+    bic   Bayesian information criterion n.ln(SSE/n) + k.ln(n), with
+          n = 3 x number of landmarks and k = 6 + npcs, penalising
+          atlases fitted with more PCs
+    loo   analytic leave-one-landmark-out RMSE (see diagnostics)
+'''
+import copy
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import registration
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import budget
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import diagnostics
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import metrics
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import threadlimits
+
+CRITERIA = ('rmse', 'bic', 'loo')
+
+
+def _fitAtlas(name, landmarks, pc, template, config, pointCloud):
+    model = copy.deepcopy(template)
+    registration.prepareInputModel(model, pc, config)
+
+    landmarks = dict((k, np.array(v, dtype=float)) for k, v in landmarks.items())
+    registration.correctLandmarks(landmarks, config)
+    inputLandmarks = registration.inputLandmarkList(landmarks, config)
+    fitBudget = budget.FitBudget.fromConfig(config)
+    with metrics.collectFits() as fits:
+        outputModel, rmse, T, transform = registration.align(model, inputLandmarks, pc, config,
+                                                             pointCloud=pointCloud, fitBudget=fitBudget)
+    diag = diagnostics.landmarkDiagnostics(model, inputLandmarks, pc, config, T)
+    diag.update(fitBudget.status())
+
+    n = 3 * len(inputLandmarks)
+    k = 6 + (config['npcs'] if config['regMode'] in registration.PCMODES else 1)
+    sse = max(n * rmse ** 2.0 / 3.0, 1e-12)
+    return name, {'rmse': float(rmse),
+                  'bic': float(n * np.log(sse / n) + k * np.log(n)),
+                  'loo': diag['looRMSE'],
+                  'npcs': config['npcs'],
+                  'outputModel': outputModel,
+                  'T': T,
+                  'transform': transform,
+                  'diagnostics': diag,
+                  'fits': fits,
+                  }
+
+
+def fitAtlases(landmarks, atlases, config, criterion='rmse', processes=None, pointCloud=None):
+    '''
+    Fit every atlas to landmarks (a ju#landmarks dict) concurrently.
+
+    atlases is a dict of name: (pc, template) or name: (pc, template, npcs)
+    to override config['npcs'] per atlas. Returns the name of the best atlas
+    under criterion and a dict of name: fit result, each with the scores
+    rmse, bic and loo, the output model, T and transform.
+    '''
+    if criterion not in CRITERIA:
+        raise ValueError('unknown atlas selection criterion {}'.format(criterion))
+
+    jobs = []
+    for name, atlas in sorted(atlases.items()):
+        atlasConfig = dict(config)
+        if len(atlas) > 2:
+            atlasConfig['npcs'] = atlas[2]
+        jobs.append((name, landmarks, atlas[0], atlas[1], atlasConfig, pointCloud))
+
+    processes = processes or len(jobs)
+    # config blasThreads of 0 shares the cores evenly between the atlases
+    threads = config.get('blasThreads') or threadlimits.threadsPerProcess(processes)
+    ctx = multiprocessing.get_context('spawn')
+    with threadlimits.threadEnvironment(threads), \
+            ProcessPoolExecutor(max_workers=processes, mp_context=ctx,
+                                initializer=threadlimits.workerInitializer(threads)) as executor:
+        results = dict(executor.map(_fitAtlas, *zip(*jobs)))
+    for result in results.values():
+        metrics.recordFits(result.pop('fits'))
+
+    best = min(results, key=lambda name: results[name][criterion])
+    return best, results
+
+
+def atlasScores(results):
+    '''
+    Per-atlas scores without the fitted models, e.g. for reporting.
+    '''
+    return dict((name, dict((k, r[k]) for k in ('rmse', 'bic', 'loo', 'npcs'))) for name, r in results.items())
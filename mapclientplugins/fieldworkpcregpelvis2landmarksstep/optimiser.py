@@ -0,0 +1,78 @@
+'''
+The three fmin stages of model_alignment.alignModelLandmarksPC, run on the
+gias3 PCA_fitting stage objectives: rigid, rigid + first mode weighted by
+mw0, then rigid + the first npcs modes weighted by mwn.
+
+Running the stages here rather than through alignModelLandmarksPC gives a
+callback after every fmin iteration, which the fit budgets need, and lets
+initial weights w0 warm-start the fit.
+'''
+import copy
+
+import numpy as np
+from scipy.optimize import fmin
+
+from gias3.learning import PCA_fitting
+from gias3.musculoskeletal import fw_model_landmarks as fml
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import closedform
+
+MAXFEV = 100000
+
+
+def alignModelLandmarksPCOptimiser(gf, landmarks, pc, npcs, gf_params_callback=None, mw0=1.0, mwn=1.0,
+                                   w0=None, xtol=1e-6, ftol=1e-6, maxIterations=None, fitCallback=None):
+    '''
+    Drop-in replacement for model_alignment.alignModelLandmarksPC.
+
+    xtol and ftol are the fmin tolerances and maxIterations the fmin
+    iterations of each stage. gf_params_callback is called with the nodal
+    parameters after each stage, fitCallback(T, sse) after every fmin
+    iteration with the current T and landmark SSE. With w0 the rigid stage
+    poses the shape with weights w0 and the first-mode stage is skipped.
+    Returns the registered copy of gf, the landmark SSE after each stage,
+    and T.
+    '''
+    names, targets = zip(*landmarks)
+    targets = np.array(targets, dtype=float)
+    evaluators = [fml.makeLandmarkEvaluator(n, gf) for n in names]
+
+    def sse(params):
+        P = np.asarray(params).reshape((3, -1))
+        return ((np.array([e(P) for e in evaluators]) - targets) ** 2.0).sum()
+
+    def stage(obj, x0, args, toT):
+        def callback(xk):
+            if fitCallback is not None:
+                T = toT(xk)
+                fitCallback(T, sse(closedform.pcParams(pc, T)))
+
+        x = fmin(obj, x0, args=args, xtol=xtol, ftol=ftol, maxiter=maxIterations, maxfun=MAXFEV, disp=False,
+                 callback=callback)
+        params = closedform.pcParams(pc, toT(x))
+        sseHistory.append(sse(params))
+        if gf_params_callback is not None:
+            gf_params_callback(params)
+        return x
+
+    sseHistory = []
+    w = np.zeros(npcs)
+    if w0 is not None:
+        w0 = np.array(w0, dtype=float)[:npcs]
+        w[:len(w0)] = w0
+    P0 = closedform.pcParams(pc, np.hstack([np.zeros(6), w])).reshape((3, -1))
+    x0 = np.hstack([targets[0] - evaluators[0](P0), 0.0, 0.0, 0.0])
+    x = stage(PCA_fitting.rigidObj, x0, (P0.T, sse), lambda xk: np.hstack([xk, w]))
+
+    if w0 is None:
+        x = stage(PCA_fitting.rigidMode0Obj, np.hstack([x, 0.0]), (sse, pc, mw0),
+                  lambda xk: np.hstack([xk, np.zeros(npcs - 1)]))
+        x = np.hstack([x, np.zeros(npcs - 1)])
+    else:
+        x = np.hstack([x, w])
+
+    T = stage(PCA_fitting.rigidModeNObj, x, (sse, pc, list(range(npcs)), mwn, ()), lambda xk: np.array(xk))
+
+    outputModel = copy.deepcopy(gf)
+    outputModel.set_field_parameters(closedform.pcParams(pc, T).reshape((3, -1, 1)))
+    return outputModel, sseHistory, T
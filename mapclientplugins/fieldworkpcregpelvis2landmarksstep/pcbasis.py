@@ -0,0 +1,39 @@
+'''
+Truncated PC basis with a selectable storage precision.
+
+Only the mean and the first npcs modes (pre-scaled by their SD) are kept, so
+reconstruction is a single matrix-vector product. Storing them as float32
+halves the memory and bandwidth of the reconstruction for large atlases.
+Projection solves its small normal equations in float64.
+'''
+import numpy as np
+
+
+class TruncatedPCBasis(object):
+
+    def __init__(self, pc, npcs, dtype=np.float64):
+        self.npcs = npcs
+        self.dtype = np.dtype(dtype)
+        mean = np.asarray(pc.getMean(), dtype=float)
+        modes = np.empty((len(mean), npcs), dtype=self.dtype)
+        for m in range(npcs):
+            modes[:, m] = pc.reconstruct(pc.getWeightsBySD([m], [1.0]), [m]) - mean
+        self.mean = mean.astype(self.dtype)
+        self.modes = modes
+        self._gram = modes.T.dot(modes).astype(float)
+
+    def reconstruct(self, w):
+        '''
+        Flattened nodal parameters for SD-scaled weights w.
+        '''
+        return self.mean + self.modes.dot(np.asarray(w, dtype=self.dtype))
+
+    def project(self, P):
+        '''
+        Least-squares SD-scaled weights of flattened nodal parameters P.
+        '''
+        r = self.modes.T.dot(np.asarray(P, dtype=self.dtype) - self.mean).astype(float)
+        return np.linalg.solve(self._gram, r)
+
+    def nbytes(self):
+        return self.mean.nbytes + self.modes.nbytes
@@ -19,9 +19,9 @@ This file is part of MAP Client. (http://launchpad.net/mapclient)
 '''
 import os
 
-os.environ['ETS_TOOLKIT'] = 'qt5'
+os.environ.setdefault('ETS_TOOLKIT', 'qt5')
 
-from PySide6.QtWidgets import QDialog, QAbstractItemView, QTableWidgetItem
+from PySide6.QtWidgets import QDialog, QAbstractItemView, QTableWidgetItem, QMessageBox
 from PySide6.QtGui import QIntValidator
 from PySide6.QtCore import Qt
 from PySide6.QtCore import QThread, Signal
@@ -32,24 +32,36 @@ from traits.api import HasTraits, Instance, on_trait_change, \
 
 from gias3.mapclientpluginutilities.viewers import MayaviViewerObjectsContainer, MayaviViewerLandmark, MayaviViewerFieldworkModel, colours
 
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep.speculative import SpeculativeFits
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import registration
+
 import copy
+import traceback
 
 REGMODES = {'PC': 1,
             'Linear Scaling': 2,
+            'PC + Point Cloud': 3,
             }
 
 
 class _ExecThread(QThread):
     finalUpdate = Signal(tuple)
     update = Signal(tuple)
+    failed = Signal(str)
 
     def __init__(self, func):
         QThread.__init__(self)
         self.func = func
 
     def run(self):
-        output = self.func(self.update)
-        self.finalUpdate.emit(output)
+        # an exception would otherwise end the thread silently and leave the
+        # UI locked
+        try:
+            output = self.func(self.update)
+        except Exception:
+            self.failed.emit(traceback.format_exc())
+        else:
+            self.finalUpdate.emit(output)
 
 
 class MayaviPCRegViewerWidget(QDialog):
@@ -63,9 +75,13 @@ class MayaviPCRegViewerWidget(QDialog):
     _modelDisc = [10, 10]
     _landmarkRenderArgs = {'mode': 'sphere', 'scale_factor': 20.0, 'color': (0, 1, 0)}
 
-    def __init__(self, landmarks, model, config, regFunc, parent=None):
+    def __init__(self, landmarks, model, config, regFunc, parent=None, fitFunc=None, resultFunc=None,
+                 regModes=(1, 2)):
         '''
-        Constructor
+        Constructor. If fitFunc(config, w0, landmarks) is given, fits for neighbouring
+        npcs and the other regModes are computed in the background after each
+        registration, and resultFunc(config, result) is called when one of
+        them is shown.
         '''
         QDialog.__init__(self, parent)
         self._ui = Ui_Dialog()
@@ -81,10 +97,18 @@ class MayaviPCRegViewerWidget(QDialog):
         self._origModel = model
         self._regFunc = regFunc
         self._config = config
+        self._regModes = regModes
 
         self._worker = _ExecThread(self._regFunc)
         self._worker.finalUpdate.connect(self._regUpdate)
         self._worker.update.connect(self._updateMeshGeometry)
+        self._worker.failed.connect(self._regFailed)
+
+        self._resultFunc = resultFunc
+        if fitFunc is not None:
+            self._speculative = SpeculativeFits(fitFunc, regModes=regModes)
+        else:
+            self._speculative = None
 
         # print 'init...', self._config
 
@@ -123,8 +147,9 @@ class MayaviPCRegViewerWidget(QDialog):
     def _setupGui(self):
         self._ui.screenshotPixelXLineEdit.setValidator(QIntValidator())
         self._ui.screenshotPixelYLineEdit.setValidator(QIntValidator())
-        self._ui.comboBoxRegMode.addItem('PC')
-        self._ui.comboBoxRegMode.addItem('Linear Scaling')
+        for name in sorted(REGMODES, key=REGMODES.get):
+            if REGMODES[name] in self._regModes:
+                self._ui.comboBoxRegMode.addItem(name)
         self._ui.spinBoxNPCs.setSingleStep(1)
         for l in self._landmarkNames:
             self._ui.comboBoxLASIS.addItem(l)
@@ -142,6 +167,7 @@ class MayaviPCRegViewerWidget(QDialog):
 
         self._ui.regButton.clicked.connect(self._worker.start)
         self._ui.regButton.clicked.connect(self._regLockUI)
+        self._ui.regButton.clicked.connect(self._clearSpeculative)
 
         self._ui.resetButton.clicked.connect(self._reset)
         self._ui.abortButton.clicked.connect(self._abort)
@@ -160,7 +186,10 @@ class MayaviPCRegViewerWidget(QDialog):
 
     def _initialiseSettings(self):
 
-        self._ui.comboBoxRegMode.setCurrentIndex(self._config['regMode'] - 1)
+        if self._config['regMode'] not in self._regModes:
+            # e.g. regMode 3 without a point cloud
+            self._config['regMode'] = REGMODES['PC']
+        self._ui.comboBoxRegMode.setCurrentIndex(sorted(self._regModes).index(self._config['regMode']))
         self._ui.spinBoxNPCs.setValue(self._config['npcs'])
 
         if self._config['LASIS'] in self._landmarkNames:
@@ -291,9 +320,11 @@ class MayaviPCRegViewerWidget(QDialog):
 
     def _updateConfigRegMode(self):
         self._config['regMode'] = REGMODES[self._ui.comboBoxRegMode.currentText()]
+        self._showSpeculative()
 
     def _updateConfigNPCs(self):
         self._config['npcs'] = self._ui.spinBoxNPCs.value()
+        self._showSpeculative()
 
     def _updateMeshGeometry(self, P):
         meshObj = self._objects.getObject('pelvis mesh')
@@ -301,12 +332,45 @@ class MayaviPCRegViewerWidget(QDialog):
 
     def _regUpdate(self, output):
         regModel, RMSE, T = output
+        self._showFitErrors(RMSE, T)
+
+        # unlock reg ui
+        self._regUnlockUI()
+        self._scheduleSpeculative(T)
+
+    def _regFailed(self, message):
+        self._regUnlockUI()
+        QMessageBox.critical(self, 'Registration Failed', message.strip().splitlines()[-1])
+
+    def _showFitErrors(self, RMSE, T):
         # update error field
         self._ui.lineEditRMSE.setText('{:12.10f}'.format(RMSE))
         self._ui.lineEditTransformation.setText(', '.join(['{:5.2f}'.format(t) for t in T]))
 
-        # unlock reg ui
-        self._regUnlockUI()
+    def _clearSpeculative(self):
+        if self._speculative is not None:
+            self._speculative.clear()
+
+    def _scheduleSpeculative(self, T):
+        if self._speculative is not None:
+            self._speculative.schedule(dict(self._config), T,
+                                       (self._ui.spinBoxNPCs.minimum(), self._ui.spinBoxNPCs.maximum()),
+                                       registration.inputLandmarkList(self._landmarks, self._config))
+
+    def _showSpeculative(self):
+        # show a finished background fit for the new settings, if there is one
+        if (self._speculative is None) or (not self._ui.regButton.isEnabled()):
+            return
+        result = self._speculative.get(self._config)
+        if result is None:
+            return
+
+        regModel, RMSE, T = result[:3]
+        self._updateMeshGeometry(regModel.get_field_parameters())
+        self._showFitErrors(RMSE, T)
+        if self._resultFunc is not None:
+            self._resultFunc(dict(self._config), result)
+        self._scheduleSpeculative(T)
 
     def _regLockUI(self):
         self._ui.comboBoxRegMode.setEnabled(False)
@@ -356,11 +420,39 @@ class MayaviPCRegViewerWidget(QDialog):
         self._close()
 
     def _close(self):
-        for name in self._objects.getObjectNames():
-            self._objects.getObject(name).remove()
-
-        self._objects._objects = {}
-        self._objects == None
+        '''
+        Release everything the viewer holds so that a closed viewer does not
+        keep the scene, VTK pipelines, worker thread or models alive.
+        '''
+        if self._speculative is not None:
+            self._speculative.shutdown()
+            self._speculative = None
+
+        if self._worker is not None:
+            # the registration cannot be interrupted, wait for it to finish
+            self._worker.wait()
+            self._ui.regButton.clicked.disconnect(self._worker.start)
+            self._worker.finalUpdate.disconnect()
+            self._worker.update.disconnect()
+            self._worker.failed.disconnect()
+            self._worker.deleteLater()
+            self._worker = None
+
+        if self._objects is not None:
+            for name in self._objects.getObjectNames():
+                self._objects.getObject(name).remove()
+            self._objects._objects = {}
+            self._objects = None
+
+        if self._scene is not None:
+            self._scene.mlab.clf(figure=self._scene.mayavi_scene)
+            self._scene = None
+
+        # drop references back to the step and its data
+        self._regFunc = None
+        self._resultFunc = None
+        self._origModel = None
+        self._landmarks = None
 
         # for r in xrange(self._ui.tableWidget.rowCount()):
         #     self._ui.tableWidget.removeRow(r)
@@ -0,0 +1,107 @@
+'''
+Per-registration profiling.
+
+When a profile directory is set, in the step config as 'profileDir' or in
+the PELVISREG_PROFILE environment variable, each registration is run under
+cProfile and tracemalloc. Three files are written to the directory, named
+<identifier>_<subject>_<timestamp>:
+
+    .prof        cProfile stats, for pstats or snakeviz
+    .tracemalloc tracemalloc snapshot, load with tracemalloc.Snapshot.load
+    .txt         top functions by cumulative time and top allocation sites
+
+cProfile only sees the thread it runs in. In the viewer this is the
+_ExecThread running reg, so the optimiser, field evaluation, transform
+building and the time spent emitting the Qt update signal are all included.
+'''
+import os
+import io
+import time
+import pstats
+import hashlib
+import cProfile
+import tracemalloc
+
+PROFILE_ENV = 'PELVISREG_PROFILE'
+
+
+def profileDir(config):
+    '''
+    The profile directory from config or the environment, or None if
+    profiling is off.
+    '''
+    return config.get('profileDir') or os.environ.get(PROFILE_ENV) or None
+
+
+def landmarksDigest(landmarks):
+    '''
+    Short digest of a ju#landmarks dict, used as the subject name when none
+    is known.
+    '''
+    h = hashlib.sha1()
+    for name in sorted(landmarks):
+        h.update(name.encode('utf-8'))
+        h.update(repr([round(float(x), 3) for x in landmarks[name]]).encode('utf-8'))
+    return h.hexdigest()[:10]
+
+
+def _safe(name):
+    return ''.join(c if (c.isalnum() or c in '-.') else '_' for c in str(name)) or 'none'
+
+
+class RegistrationProfile(object):
+    '''
+    Context manager profiling one registration. Does nothing if directory
+    is None. The written file prefix is in prefix after exit.
+    '''
+
+    def __init__(self, directory, identifier, subject, nTop=30):
+        self.directory = directory
+        self.identifier = identifier
+        self.subject = subject
+        self.nTop = nTop
+        self.prefix = None
+        self._profile = None
+        self._startedTracing = False
+
+    def __enter__(self):
+        if self.directory is None:
+            return self
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._startedTracing = True
+        self._baseline = tracemalloc.take_snapshot()
+        self._start = time.perf_counter()
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        if self._profile is None:
+            return False
+        self._profile.disable()
+        elapsed = time.perf_counter() - self._start
+        snapshot = tracemalloc.take_snapshot()
+        if self._startedTracing:
+            tracemalloc.stop()
+
+        os.makedirs(self.directory, exist_ok=True)
+        now = time.time()
+        timestamp = '{}.{:03d}'.format(time.strftime('%Y%m%d-%H%M%S', time.localtime(now)), int(now * 1000) % 1000)
+        self.prefix = os.path.join(self.directory, '{}_{}_{}'.format(_safe(self.identifier), _safe(self.subject),
+                                                                     timestamp))
+        self._profile.dump_stats(self.prefix + '.prof')
+        snapshot.dump(self.prefix + '.tracemalloc')
+
+        out = io.StringIO()
+        out.write('{} {}: {:.3f} s{}\n\n'.format(self.identifier, self.subject, elapsed,
+                                                  '' if excType is None else ' (failed)'))
+        pstats.Stats(self._profile, stream=out).sort_stats('cumulative').print_stats(self.nTop)
+        out.write('\nallocations since start of registration:\n')
+        for stat in snapshot.compare_to(self._baseline, 'lineno')[:self.nTop]:
+            out.write('{}\n'.format(stat))
+        with open(self.prefix + '.txt', 'w') as f:
+            f.write(out.getvalue())
+
+        self._profile = None
+        return False
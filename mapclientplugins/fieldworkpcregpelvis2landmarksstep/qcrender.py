@@ -0,0 +1,183 @@
+'''
+Headless QC rendering of registration results.
+
+Renders the registered pelvis mesh and its target landmarks from standard
+anatomical views (anterior, lateral, superior) into image files without an
+interactive scene, so that QC images can be produced for a whole cohort in
+parallel worker processes on machines without a display.
+
+Without a display, VTK must be able to render offscreen (a VTK build with
+OSMesa or EGL), or the renders must run under a virtual display such as
+xvfb-run.
+'''
+import os
+import contextlib
+import multiprocessing
+
+import numpy as np
+
+QCVIEWS = ('anterior', 'lateral', 'superior')
+
+_meshColour = (0.89, 0.85, 0.79)  # bone
+_landmarkColour = (0, 1, 0)
+_landmarkScale = 10.0
+_modelDisc = [10, 10]
+
+# read by traits and Qt when they are first imported
+HEADLESS_ENV = {'ETS_TOOLKIT': 'null', 'QT_QPA_PLATFORM': 'offscreen'}
+
+
+@contextlib.contextmanager
+def headlessEnvironment():
+    '''
+    Set the headless toolkit environment variables for processes started
+    inside the block, and restore them afterwards.
+    '''
+    previous = dict((v, os.environ.get(v)) for v in HEADLESS_ENV)
+    os.environ.update(HEADLESS_ENV)
+    try:
+        yield
+    finally:
+        for v, value in previous.items():
+            if value is None:
+                os.environ.pop(v, None)
+            else:
+                os.environ[v] = value
+
+
+def _initOffscreen():
+    '''
+    Force a GUI-less mayavi/VTK backend. Must run before mayavi is first
+    used in the process, and only in the render worker processes: it
+    changes the environment and toolkit of the process for good.
+    '''
+    os.environ['ETS_TOOLKIT'] = 'null'
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    try:
+        from traits.etsconfig.api import ETSConfig
+        ETSConfig.toolkit = 'null'
+    except ValueError:
+        # toolkit already chosen in this process
+        pass
+
+    from mayavi import mlab
+    mlab.options.offscreen = True
+    return mlab
+
+
+def _unit(v):
+    return v / np.linalg.norm(v)
+
+
+def pelvisViewFrame(landmarks):
+    '''
+    Return (centre, anterior, superior, right) unit axes of the pelvis from a
+    dict of landmark coordinates keyed by pelvis landmark name (LASIS, RASIS,
+    LPSIS, RPSIS, Sacral). Falls back to the global axes when the ASIS or a
+    posterior landmark is missing.
+    '''
+    if ('LASIS' in landmarks) and ('RASIS' in landmarks):
+        lasis = np.asarray(landmarks['LASIS'], dtype=float)
+        rasis = np.asarray(landmarks['RASIS'], dtype=float)
+        centreAnt = 0.5 * (lasis + rasis)
+        if 'Sacral' in landmarks:
+            centrePos = np.asarray(landmarks['Sacral'], dtype=float)
+        elif ('LPSIS' in landmarks) and ('RPSIS' in landmarks):
+            centrePos = 0.5 * (np.asarray(landmarks['LPSIS'], dtype=float) +
+                               np.asarray(landmarks['RPSIS'], dtype=float))
+        else:
+            centrePos = None
+
+        if centrePos is not None:
+            right = _unit(rasis - lasis)
+            ant = centreAnt - centrePos
+            ant = _unit(ant - np.dot(ant, right) * right)
+            sup = np.cross(right, ant)
+            return 0.5 * (centreAnt + centrePos), ant, sup, right
+
+    pts = np.array(list(landmarks.values()), dtype=float)
+    return pts.mean(0), np.array([1.0, 0, 0]), np.array([0, 1.0, 0]), np.array([0, 0, 1.0])
+
+
+def _cameraViews(centre, ant, sup, right, distance):
+    '''
+    Camera (position, focal point, view up) for each view in QCVIEWS.
+    '''
+    return {'anterior': (centre + distance * ant, centre, sup),
+            'lateral': (centre + distance * right, centre, sup),
+            'superior': (centre + distance * sup, centre, ant),
+            }
+
+
+def _renderArrays(V, T, landmarks, filenamePrefix, size, views, fileFormat):
+    mlab = _initOffscreen()
+    fig = mlab.figure(bgcolor=(0.0, 0.0, 0.0), size=size)
+    try:
+        mlab.triangular_mesh(V[:, 0], V[:, 1], V[:, 2], T, color=_meshColour, figure=fig)
+        if landmarks:
+            L = np.array(list(landmarks.values()), dtype=float)
+            mlab.points3d(L[:, 0], L[:, 1], L[:, 2], mode='sphere', color=_landmarkColour,
+                          scale_factor=_landmarkScale, figure=fig)
+
+        centre, ant, sup, right = pelvisViewFrame(landmarks) if landmarks else \
+            (V.mean(0), np.array([1.0, 0, 0]), np.array([0, 1.0, 0]), np.array([0, 0, 1.0]))
+        distance = 3.0 * np.linalg.norm(V - centre, axis=1).max()
+        cameras = _cameraViews(centre, ant, sup, right, distance)
+
+        filenames = []
+        for view in views:
+            position, focalPoint, viewUp = cameras[view]
+            camera = fig.scene.camera
+            camera.position = position
+            camera.focal_point = focalPoint
+            camera.view_up = viewUp
+            fig.scene.reset_zoom()
+            filename = '{}_{}.{}'.format(filenamePrefix, view, fileFormat)
+            mlab.savefig(filename, size=size, figure=fig)
+            filenames.append(filename)
+    finally:
+        mlab.close(fig)
+
+    return filenames
+
+
+def _renderJob(job):
+    return _renderArrays(*job)
+
+
+def renderQCViews(model, landmarks, filenamePrefix, size=(800, 800), views=QCVIEWS, fileFormat='png'):
+    '''
+    Render model (a fieldwork geometric field, e.g. the output model from
+    reg) and landmarks (dict of name: coordinates) offscreen into one image
+    per view, named <filenamePrefix>_<view>.<fileFormat>. Returns the list of
+    written filenames.
+
+    The render runs in a worker process, see renderQCViewsParallel, so this
+    is safe to call from a process with a live GUI.
+    '''
+    return renderQCViewsParallel([(model, landmarks, filenamePrefix)], processes=1, size=size, views=views,
+                                 fileFormat=fileFormat)[0]
+
+
+def renderQCViewsParallel(jobs, processes=None, size=(800, 800), views=QCVIEWS, fileFormat='png'):
+    '''
+    Render QC views for many subjects in parallel worker processes.
+
+    jobs is an iterable of (model, landmarks, filenamePrefix) tuples.
+    Models are triangulated in the calling process so that workers only
+    receive plain arrays. Workers are spawned rather than forked so that no
+    GUI state is inherited from the parent, and start with the headless
+    environment of headlessEnvironment. Returns a list of filename lists
+    in job order.
+    '''
+    arrayJobs = []
+    for model, landmarks, filenamePrefix in jobs:
+        V, T = model.triangulate(_modelDisc, merge=True)
+        arrayJobs.append((np.asarray(V), np.asarray(T), dict(landmarks), filenamePrefix,
+                          tuple(size), tuple(views), fileFormat))
+
+    ctx = multiprocessing.get_context('spawn')
+    # workers inherit the environment when they start, before they import
+    # anything that could pick a GUI toolkit
+    with headlessEnvironment(), ctx.Pool(processes=processes, maxtasksperchild=16) as pool:
+        return pool.map(_renderJob, arrayJobs, chunksize=1)
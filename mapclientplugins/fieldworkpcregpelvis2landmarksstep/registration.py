@@ -0,0 +1,272 @@
+'''
+Registration logic of the step without any GUI or workflow dependencies, so
+that it can be run from batch tools and worker processes.
+'''
+import copy
+
+import numpy as np
+
+from gias3.musculoskeletal import model_alignment as ma
+from gias3.musculoskeletal import fw_model_landmarks as fml
+from gias3.common import math
+from gias3.mapclientpluginutilities.datatypes import transformations
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import closedform
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import kernels
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import optimiser
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import budget
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import metrics
+
+PELVISLANDMARKS = ('LASIS', 'RASIS', 'LPSIS', 'RPSIS', 'Sacral', 'LHJC', 'RHJC')
+PCSOLVERS = {'optimiser': optimiser.alignModelLandmarksPCOptimiser,
+             'alternating': closedform.alignModelLandmarksPCAlternating,
+             'leastsq': kernels.alignModelLandmarksPCLeastSq,
+             }
+# regModes that fit PC weights: PC, PC + Point Cloud
+PCMODES = (1, 3)
+PCFITMW0 = 1e2
+PCFITMWN = 1e2
+LANDMARKSHIFT = 10.0
+
+
+class FitCancelled(Exception):
+    '''
+    Raised from a callback to stop a fit that is no longer wanted. Recorded
+    in the metrics as cancelled rather than failed.
+    '''
+    pass
+
+
+def correctLandmarks(landmarks, config, shift=LANDMARKSHIFT):
+    '''
+    Move the ASIS and posterior landmarks closer to the centre of the pelvis
+    in the anterior-posterior direction. Modifies landmarks in place.
+    '''
+    centreAnt = 0.5 * (landmarks[config['LASIS']] + landmarks[config['RASIS']])
+    if config.get('Sacral') != 'none':
+        centrePos = landmarks[config['Sacral']]
+    elif (config.get('LPSIS') != 'none') and (config.get('RPSIS') != 'none'):
+        centrePos = 0.5 * (landmarks[config.get('LPSIS')] +
+                           landmarks[config.get('RPSIS')]
+                           )
+    else:
+        return
+
+    vPosAnt = centreAnt - centrePos
+    vPosAntn = math.norm(vPosAnt)
+    landmarks[config['LASIS']] -= shift * vPosAntn
+    landmarks[config['RASIS']] -= shift * vPosAntn
+    if config.get('Sacral') != 'none':
+        landmarks[config['Sacral']] += shift * vPosAntn
+    if (config.get('LPSIS') != 'none') and (config.get('RPSIS') != 'none'):
+        landmarks[config['LPSIS']] += shift * vPosAntn
+        landmarks[config['RPSIS']] += shift * vPosAntn
+
+
+def inputLandmarkList(landmarks, config):
+    '''
+    List of (model landmark name, coordinates) for the landmarks mapped in
+    config.
+    '''
+    return [('pelvis-' + l, landmarks[config[l]]) for l in PELVISLANDMARKS if config[l] != 'none']
+
+
+def prepareInputModel(model, pc, config):
+    '''
+    Set model to the PC mean shape when fitting PCs, as done by the step
+    before registration.
+    '''
+    if config['regMode'] in PCMODES:
+        model.set_field_parameters(pc.getMean().reshape((3, -1, 1)))
+
+
+def align(model, inputLandmarks, pc, config, callback=None, w0=None, pointCloud=None, fitBudget=None,
+          kind='fit'):
+    '''
+    Register model to inputLandmarks according to config. w0 optionally
+    warm-starts the PC weights of the solvers that support it. pointCloud
+    is the (N, 3) surface point cloud needed in PC + Point Cloud mode.
+    Returns the registered model, landmark RMSE, the transform parameters T
+    and the corresponding geometric transform object.
+
+    The fit stops early with the best parameters seen so far if the
+    timeBudget (seconds) or iterationBudget in config runs out, or as soon
+    as the landmark RMSE reaches targetRMSE. Both are checked after every
+    solver iteration, see budget. Pass a budget.FitBudget as fitBudget to
+    find out whether it did.
+
+    xtol, ftol and maxIterations in config (0 for the solver default) end
+    the fit normally, they do not count as running out of budget. What they
+    mean depends on the solver:
+
+        PC, optimiser (the gias3 fmin stages): fmin xtol and ftol, and
+            maxIterations fmin iterations per stage.
+        PC, alternating: relative change in pose and weights (xtol) or in
+            the objective (ftol) between iterations, and maxIterations
+            iterations.
+        PC, leastsq: least_squares xtol and ftol, and maxIterations
+            residual evaluations.
+        Linear Scaling (gias3 fmin stages): fmin xtol and ftol, and
+            maxIterations fmin iterations per stage.
+        PC + Point Cloud: as alternating, within each stage of the
+            matching schedule, and maxIterations iterations per stage.
+
+    Every call is recorded in the registration metrics, labelled with kind
+    (see metrics.FitRecorder).
+    '''
+    recorder = metrics.FitRecorder(config['regMode'], kind)
+    try:
+        result = _alignWithBudget(model, inputLandmarks, pc, config, recorder.wrap(callback), w0, pointCloud,
+                                  fitBudget)
+    except FitCancelled:
+        recorder.cancelled()
+        raise
+    except Exception:
+        recorder.failed()
+        raise
+    recorder.done(result[1])
+    return result
+
+
+def _alignWithBudget(model, inputLandmarks, pc, config, callback, w0, pointCloud, fitBudget):
+    if fitBudget is None:
+        fitBudget = budget.FitBudget.fromConfig(config)
+    if not fitBudget.limited():
+        return _align(model, inputLandmarks, pc, config, callback, w0, pointCloud)
+
+    fitBudget.start(len(inputLandmarks))
+    try:
+        return _align(model, inputLandmarks, pc, config, callback, w0, pointCloud, fitCallback=fitBudget)
+    except budget.BudgetExhausted:
+        pass
+
+    T = fitBudget.bestT
+    if config['regMode'] in PCMODES:
+        params = closedform.pcParams(pc, T)
+        transform = transformations.RigidPCModesTransform(T)
+    else:
+        params = closedform.linScaleParams(model, T)
+        transform = transformations.RigidScaleTransformAboutPoint(T, P=model.calc_CoM())
+
+    outputModel = copy.deepcopy(model)
+    outputModel.set_field_parameters(params.reshape((3, -1, 1)))
+    rmse = np.sqrt(fitBudget.bestSSE / len(inputLandmarks))
+    return outputModel, rmse, T, transform
+
+
+def _linScaleFitCallback(model, inputLandmarks, fitCallback):
+    '''
+    fmin callback for both stages of alignModelLandmarksLinScale that calls
+    fitCallback with T and the landmark SSE. The first stage is rigid, its
+    T has unit scale.
+    '''
+    names, targets = zip(*inputLandmarks)
+    targets = np.array(targets, dtype=float)
+    evaluators = [fml.makeLandmarkEvaluator(n, model) for n in names]
+
+    def callback(xk):
+        T = np.hstack([xk, 1.0]) if len(xk) == 6 else np.array(xk)
+        P = closedform.linScaleParams(model, T).reshape((3, -1))
+        fitCallback(T, ((np.array([e(P) for e in evaluators]) - targets) ** 2.0).sum())
+
+    return callback
+
+
+def usesWarmStart(config):
+    '''
+    True if the solver for config starts from initial mode weights w0, as
+    all PC solvers do.
+    '''
+    return config['regMode'] in PCMODES
+
+
+def usesMw0(config):
+    '''
+    True if pcfitmw0 affects the fit for config. It only weights the
+    first-mode stage of the default optimiser.
+    '''
+    return (config['regMode'] == 1) and (config.get('pcSolver', 'optimiser') == 'optimiser')
+
+
+def _tolerances(config, names=(('xtol', 'xtol'), ('ftol', 'ftol'), ('maxIterations', 'maxIterations'))):
+    '''
+    The xtol, ftol and maxIterations set in config, under the names the
+    solver takes them as, from (config key, solver argument) pairs.
+    '''
+    return dict((arg, config[key]) for key, arg in names if config.get(key))
+
+
+def _align(model, inputLandmarks, pc, config, callback, w0, pointCloud, fitCallback=None):
+    mw0 = config.get('pcfitmw0', PCFITMW0)
+    mwn = config.get('pcfitmwn', PCFITMWN)
+    if config['regMode'] == 1:
+        pcSolver = config.get('pcSolver', 'optimiser')
+        solverArgs = _tolerances(config)
+        if pcSolver == 'alternating':
+            solverArgs['float32'] = config.get('float32', False)
+        elif pcSolver == 'leastsq':
+            solverArgs['jit'] = config.get('jit', False)
+        if (w0 is not None) and usesWarmStart(config):
+            solverArgs['w0'] = w0
+        outputModel, \
+        alignmentSSE, \
+        T = PCSOLVERS[pcSolver](
+            model,
+            inputLandmarks,
+            pc,
+            config['npcs'],
+            gf_params_callback=callback,
+            mw0=mw0,
+            mwn=mwn,
+            fitCallback=fitCallback,
+            **solverArgs
+        )
+        transform = transformations.RigidPCModesTransform(T)
+    elif config['regMode'] == 3:
+        if pointCloud is None:
+            raise ValueError('PC + Point Cloud registration needs a point cloud')
+        outputModel, \
+        alignmentSSE, \
+        T = closedform.alignModelLandmarksPCPointCloud(
+            model,
+            inputLandmarks,
+            pc,
+            config['npcs'],
+            pointCloud,
+            gf_params_callback=callback,
+            mw0=mw0,
+            mwn=mwn,
+            w0=w0,
+            pointWeight=config.get('pointCloudWeight', 1.0),
+            fitCallback=fitCallback,
+            **_tolerances(config, (('xtol', 'xtol'), ('ftol', 'ftol'), ('maxIterations', 'iterationsPerStage')))
+        )
+        transform = transformations.RigidPCModesTransform(T)
+    else:
+        fminargs = dict({'maxfun': 100000},
+                        **_tolerances(config, (('xtol', 'xtol'), ('ftol', 'ftol'), ('maxIterations', 'maxiter'))))
+        if fitCallback is not None:
+            fminargs['callback'] = _linScaleFitCallback(model, inputLandmarks, fitCallback)
+        outputModel, \
+        alignmentSSE, \
+        T = ma.alignModelLandmarksLinScale(
+            model,
+            inputLandmarks,
+            gf_params_callback=callback,
+            fminargs=fminargs
+        )
+        transform = transformations.RigidScaleTransformAboutPoint(T, P=model.calc_CoM())
+
+    rmse = np.sqrt(alignmentSSE[-1] / len(inputLandmarks))
+    return outputModel, rmse, T, transform
+
+
+def registerPelvis(landmarks, pc, model, config, callback=None, pointCloud=None):
+    '''
+    Full registration of one subject as performed by the step: landmark
+    correction followed by alignment. landmarks is the ju#landmarks dict and
+    is not modified.
+    '''
+    landmarks = dict((k, np.array(v, dtype=float)) for k, v in landmarks.items())
+    correctLandmarks(landmarks, config)
+    return align(model, inputLandmarkList(landmarks, config), pc, config, callback=callback, pointCloud=pointCloud)
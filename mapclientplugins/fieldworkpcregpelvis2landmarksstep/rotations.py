@@ -0,0 +1,48 @@
+'''
+Rigid rotations in the gias3 convention.
+
+gias3 (transform3D.transformRigid3D, used by the PC fitting objectives and
+RigidPCModesTransform / RigidScaleTransformAboutPoint) builds the rotation
+of T = [tx, ty, tz, rx, ry, rz, ...] as R = Rx.Ry.Rz, applied to column
+vectors.
+'''
+import numpy as np
+
+
+def kabsch(source, target, weights=None):
+    '''
+    Rotation R and translation t minimising
+    sum weights_i ||R.source_i + t - target_i||^2.
+    '''
+    if weights is None:
+        weights = np.ones(len(source))
+    weights = weights / weights.sum()
+    sc = weights.dot(source)
+    tc = weights.dot(target)
+    H = ((source - sc) * weights[:, np.newaxis]).T.dot(target - tc)
+    U, S, Vt = np.linalg.svd(H)
+    d = np.sign(np.linalg.det(Vt.T.dot(U.T)))
+    R = Vt.T.dot(np.diag([1.0, 1.0, d])).dot(U.T)
+    return R, tc - R.dot(sc)
+
+
+def matrixFromEuler(r):
+    rx, ry, rz = r
+    cx, sx = np.cos(rx), np.sin(rx)
+    cy, sy = np.cos(ry), np.sin(ry)
+    cz, sz = np.cos(rz), np.sin(rz)
+    Rx = np.array([[1.0, 0.0, 0.0], [0.0, cx, -sx], [0.0, sx, cx]])
+    Ry = np.array([[cy, 0.0, sy], [0.0, 1.0, 0.0], [-sy, 0.0, cy]])
+    Rz = np.array([[cz, -sz, 0.0], [sz, cz, 0.0], [0.0, 0.0, 1.0]])
+    return Rx.dot(Ry).dot(Rz)
+
+
+def eulerFromMatrix(R):
+    '''
+    [rx, ry, rz] with matrixFromEuler([rx, ry, rz]) == R, ry in
+    [-pi/2, pi/2].
+    '''
+    ry = np.arcsin(np.clip(R[0, 2], -1.0, 1.0))
+    rx = np.arctan2(-R[1, 2], R[2, 2])
+    rz = np.arctan2(-R[0, 1], R[0, 0])
+    return np.array([rx, ry, rz])
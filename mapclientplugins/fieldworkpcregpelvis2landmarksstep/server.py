@@ -0,0 +1,235 @@
+'''
+Local HTTP job queue for pelvis registrations.
+
+Registration requests are queued onto a pool of worker processes that each
+hold a preloaded PC model and template, so that pipeline services can
+submit registrations programmatically and collect results asynchronously.
+The server only listens on localhost by default.
+
+    POST /jobs        {"landmarks": {name: [x, y, z], ...}, "config": {step config},
+                       "pointCloud": [[x, y, z], ...] (PC + Point Cloud mode only)}
+                      -> 202 {"id": job id}, or 503 when the queue is full
+    GET  /jobs/<id>   -> {"status": "queued" | "running" | "done" | "failed", ...}
+                      with "rmse", "T" and "params" once done
+    GET  /status      -> {"queued": n, "running": n, "capacity": n}
+    GET  /metrics     -> Prometheus text format, see metrics
+
+Usage:
+    python -m mapclientplugins.fieldworkpcregpelvis2landmarksstep.server \\
+        --pc pelvis.pc --gf pelvis.geof --ens pelvis.ens --mesh pelvis.mesh
+'''
+import json
+import copy
+import time
+import uuid
+import argparse
+import threading
+import traceback
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import registration
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import dataio
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import metrics
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import threadlimits
+
+_worker = {}
+
+
+def _initWorker(pc, model):
+    meanModel = copy.deepcopy(model)
+    registration.prepareInputModel(meanModel, pc, {'regMode': 1})
+    _worker['pc'] = pc
+    _worker['model'] = model
+    _worker['meanModel'] = meanModel
+
+
+def _register(landmarks, config, pointCloud=None):
+    landmarks = dict((k, np.array(v, dtype=float)) for k, v in landmarks.items())
+    if pointCloud is not None:
+        pointCloud = np.array(pointCloud, dtype=float)
+    model = _worker['meanModel'] if config['regMode'] in registration.PCMODES else _worker['model']
+    with metrics.collectFits() as fits:
+        outputModel, rmse, T, transform = registration.registerPelvis(landmarks, _worker['pc'], model, config,
+                                                                      pointCloud=pointCloud)
+    return {'rmse': float(rmse),
+            'T': np.asarray(T, dtype=float).tolist(),
+            'params': np.asarray(outputModel.get_field_parameters(), dtype=float).ravel().tolist(),
+            'fits': fits,
+            }
+
+
+class RegistrationQueue(object):
+    '''
+    Bounded queue of registration jobs running on a process pool. At most
+    capacity jobs are queued or running at once; further submissions are
+    rejected so that callers can back off. Finished jobs are kept for
+    retrieval until keepFinished newer jobs have finished.
+    '''
+
+    def __init__(self, pc, model, workers=None, capacity=64, keepFinished=1024, threads=None):
+        self.capacity = capacity
+        if threads is None:
+            threads = threadlimits.threadsPerProcess(workers)
+        self._executor = ProcessPoolExecutor(max_workers=workers,
+                                             mp_context=multiprocessing.get_context('spawn'),
+                                             initializer=threadlimits.workerInitializer(threads, _initWorker),
+                                             initargs=(pc, model))
+        self._threads = threads
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._finished = collections.OrderedDict()
+        self._keepFinished = keepFinished
+
+    def submit(self, landmarks, config, pointCloud=None):
+        '''
+        Queue a registration. Returns the job id, or None if the queue is
+        full.
+        '''
+        with self._lock:
+            if len(self._pending) >= self.capacity:
+                return None
+            jobId = uuid.uuid4().hex
+            # workers are started on demand, they inherit the thread environment
+            with threadlimits.threadEnvironment(self._threads):
+                future = self._executor.submit(_register, landmarks, config, pointCloud)
+            self._pending[jobId] = future
+
+        submitted = time.perf_counter()
+        future.add_done_callback(lambda f, jobId=jobId: self._done(jobId, f, submitted, config['regMode']))
+        return jobId
+
+    def _done(self, jobId, future, submitted, regMode):
+        try:
+            result = dict(future.result(), status='done')
+            metrics.recordFits(result.pop('fits'))
+        except Exception:
+            result = {'status': 'failed', 'error': traceback.format_exc()}
+            # the worker's fit records are lost with the exception
+            metrics.FAILURES.inc(regMode=regMode, kind='fit')
+        metrics.JOBS.inc(status=result['status'])
+        metrics.JOB_SECONDS.observe(time.perf_counter() - submitted)
+
+        with self._lock:
+            self._pending.pop(jobId, None)
+            self._finished[jobId] = result
+            while len(self._finished) > self._keepFinished:
+                self._finished.popitem(last=False)
+
+    def status(self, jobId):
+        with self._lock:
+            if jobId in self._finished:
+                return self._finished[jobId]
+            future = self._pending.get(jobId)
+        if future is None:
+            return None
+        return {'status': 'running' if future.running() else 'queued'}
+
+    def depth(self):
+        with self._lock:
+            running = sum(1 for f in self._pending.values() if f.running())
+            return {'queued': len(self._pending) - running,
+                    'running': running,
+                    'capacity': self.capacity,
+                    }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    queue = None
+
+    def _reply(self, code, body, contentType='application/json'):
+        data = body.encode('utf-8') if contentType != 'application/json' else json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(data)))
+        if code == 503:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self._reply(200, self.queue.depth())
+        elif self.path == '/metrics':
+            depth = self.queue.depth()
+            metrics.QUEUE_DEPTH.set(depth['queued'], state='queued')
+            metrics.QUEUE_DEPTH.set(depth['running'], state='running')
+            self._reply(200, metrics.REGISTRY.render(), 'text/plain; version=0.0.4; charset=utf-8')
+        elif self.path.startswith('/jobs/'):
+            status = self.queue.status(self.path[len('/jobs/'):])
+            if status is None:
+                self._reply(404, {'error': 'unknown job'})
+            else:
+                self._reply(200, status)
+        else:
+            self._reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/jobs':
+            self._reply(404, {'error': 'not found'})
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            landmarks = request['landmarks']
+            config = request['config']
+        except (ValueError, KeyError, TypeError):
+            self._reply(400, {'error': 'expected JSON with "landmarks" and "config"'})
+            return
+
+        jobId = self.queue.submit(landmarks, config, request.get('pointCloud'))
+        if jobId is None:
+            self._reply(503, dict(self.queue.depth(), error='queue full'))
+        else:
+            self._reply(202, {'id': jobId})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(queue, host='127.0.0.1', port=8765):
+    '''
+    Serve queue over HTTP until interrupted.
+    '''
+    handler = type('Handler', (_Handler,), {'queue': queue})
+    httpd = ThreadingHTTPServer((host, port), handler)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        queue.shutdown()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Local pelvis registration job queue.')
+    parser.add_argument('--pc', required=True, help='principal components file')
+    parser.add_argument('--gf', required=True, help='template geometric field file')
+    parser.add_argument('--ens', default=None, help='template ensemble file')
+    parser.add_argument('--mesh', default=None, help='template mesh file')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--capacity', type=int, default=64, help='maximum queued and running jobs')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='BLAS threads per worker, 0 for no limit, default cores / workers')
+    args = parser.parse_args(args)
+
+    queue = RegistrationQueue(dataio.loadPC(args.pc),
+                              dataio.loadModel(args.gf, args.ens, args.mesh),
+                              workers=args.workers,
+                              capacity=args.capacity,
+                              threads=args.threads)
+    serve(queue, args.host, args.port)
+
+
+if __name__ == '__main__':
+    main()
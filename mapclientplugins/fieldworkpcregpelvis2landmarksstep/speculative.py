@@ -0,0 +1,128 @@
+'''
+Speculative background fits for the registration viewer.
+
+While the user inspects a result, idle worker threads fit the neighbouring
+npcs values and the other registration modes, warm-started from the PC
+weights of the inspected fit. Results are cached by (regMode, npcs, landmark
+mapping) so that switching the spinner or mode can show a finished fit at
+once. The cache is cleared whenever a new registration is started, since the
+fits are relative to the landmarks of the latest registration.
+'''
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import registration
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import metrics
+
+
+def fitKey(config):
+    return (config['regMode'],
+            config['npcs'] if config['regMode'] in registration.PCMODES else None,
+            tuple(config[l] for l in registration.PELVISLANDMARKS),
+            )
+
+
+def warmStartWeights(T, npcs):
+    '''
+    Initial PC weights for npcs modes from the transform parameters T of
+    another fit, zero-padded. None if T has no PC weights.
+    '''
+    T = np.asarray(T, dtype=float)
+    if len(T) <= 7:
+        # rigid-scale T, no weights
+        return None
+    w0 = np.zeros(npcs)
+    n = min(npcs, len(T) - 6)
+    w0[:n] = T[6:6 + n]
+    return w0
+
+
+class SpeculativeFits(object):
+    '''
+    Cache of fits computed in the background by fitFunc(config, w0,
+    landmarks), which must return a tuple starting with the (outputModel, rmse, T) of
+    registration.align and must not modify shared state.
+    '''
+
+    def __init__(self, fitFunc, regModes=(1, 2), workers=1):
+        self._fitFunc = fitFunc
+        self.regModes = regModes
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        # reentrant: cancelling a future, or adding a callback to a finished
+        # one, runs _done in the calling thread while the lock is held
+        self._lock = threading.RLock()
+        self._results = {}
+        self._pending = {}
+        self._generation = 0
+
+    def get(self, config):
+        with self._lock:
+            result = self._results.get(fitKey(config))
+        if result is None:
+            metrics.CACHE_MISSES.inc(cache='speculative')
+        else:
+            metrics.CACHE_HITS.inc(cache='speculative')
+        return result
+
+    def put(self, config, result):
+        with self._lock:
+            self._results[fitKey(config)] = result
+
+    def clear(self):
+        '''
+        Drop all cached and pending fits. Pending fits still running finish
+        but their results are discarded.
+        '''
+        with self._lock:
+            self._generation += 1
+            self._results = {}
+            for future in self._pending.values():
+                future.cancel()
+            self._pending = {}
+
+    def schedule(self, config, T, npcsRange, landmarks):
+        '''
+        Queue fits for npcs +/- 1 (within npcsRange) in the PC modes and for
+        the other regModes, warm-started from T of the fit for config. The
+        fits get their own copy of the (name, coordinates) list landmarks,
+        so a later registration correcting the landmarks in place does not
+        change them mid-fit.
+        '''
+        landmarks = [(name, np.array(x, dtype=float)) for name, x in landmarks]
+        variants = []
+        for regMode in self.regModes:
+            if regMode in registration.PCMODES:
+                npcsValues = [config['npcs']] if regMode != config['regMode'] else []
+                if config['regMode'] in registration.PCMODES:
+                    npcsValues += [config['npcs'] - 1, config['npcs'] + 1]
+                for npcs in npcsValues:
+                    if npcsRange[0] <= npcs <= npcsRange[1]:
+                        variants.append(dict(config, regMode=regMode, npcs=npcs))
+            elif regMode != config['regMode']:
+                variants.append(dict(config, regMode=regMode))
+
+        with self._lock:
+            for variant in variants:
+                key = fitKey(variant)
+                if (key in self._results) or (key in self._pending):
+                    continue
+                w0 = warmStartWeights(T, variant['npcs']) if variant['regMode'] in registration.PCMODES else None
+                future = self._executor.submit(self._fitFunc, variant, w0, landmarks)
+                self._pending[key] = future
+                future.add_done_callback(
+                    lambda f, key=key, generation=self._generation: self._done(key, generation, f)
+                )
+
+    def _done(self, key, generation, future):
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._pending.pop(key, None)
+            if (not future.cancelled()) and (future.exception() is None):
+                self._results[key] = future.result()
+
+    def shutdown(self):
+        self.clear()
+        self._executor.shutdown(wait=False)
@@ -5,19 +5,27 @@ import os
 import json
 import copy
 
-from PySide6 import QtGui
-
-from mapclient.mountpoints.workflowstep import WorkflowStepMountPoint
-from mapclientplugins.fieldworkpcregpelvis2landmarksstep.configuredialog import ConfigureDialog
-from mapclientplugins.fieldworkpcregpelvis2landmarksstep.pcregviewerwidget import MayaviPCRegViewerWidget
-
-from gias3.musculoskeletal import model_alignment as ma
-from gias3.common import math
-from gias3.mapclientpluginutilities.datatypes import transformations
-
 import numpy as np
 
-PELVISLANDMARKS = ('LASIS', 'RASIS', 'LPSIS', 'RPSIS', 'Sacral', 'LHJC', 'RHJC')
+try:
+    from mapclient.mountpoints.workflowstep import WorkflowStepMountPoint
+except ImportError:
+    # the registration modules and headless tools import this package
+    # without MAP Client, the step is then defined but not registered
+    WorkflowStepMountPoint = object
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import qcrender
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import registration
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import diagnostics
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import asyncreg
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import lazymodel
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import warmstart
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import multiatlas
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import budget
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import metrics
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import profiling
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import threadlimits
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import cohortstore
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep.registration import PELVISLANDMARKS
 
 
 class FieldworkPCRegPelvis2LandmarksStep(WorkflowStepMountPoint):
@@ -26,15 +34,19 @@ class FieldworkPCRegPelvis2LandmarksStep(WorkflowStepMountPoint):
     for new steps.
     '''
 
-    _pcfitmw0 = 1e2
-    _pcfitmwn = 1e2
-    _landmarkShift = 10.0
+    _pcfitmw0 = registration.PCFITMW0
+    _pcfitmwn = registration.PCFITMWN
+    _landmarkShift = registration.LANDMARKSHIFT
 
     def __init__(self, location):
         super(FieldworkPCRegPelvis2LandmarksStep, self).__init__('Fieldwork PC-Reg Pelvis 2 Landmarks', location)
         self._configured = False  # A step cannot be executed until it has been configured.
         self._category = 'Registration'
         # Add any other initialisation code here:
+        # Qt is imported with the step, not the package, so that the
+        # headless tools can run without it
+        from PySide6 import QtGui
+        from mapclientplugins.fieldworkpcregpelvis2landmarksstep import resources_rc
         self._icon = QtGui.QImage(':/fieldworkpcregpelvis2landmarksstep/images/fieldworkpelvispcregicon.png')
         # Ports:
         self.addPort(('http://physiomeproject.org/workflow/1.0/rdf-schema#port',
@@ -55,21 +67,60 @@ class FieldworkPCRegPelvis2LandmarksStep(WorkflowStepMountPoint):
         self.addPort(('http://physiomeproject.org/workflow/1.0/rdf-schema#port',
                       'http://physiomeproject.org/workflow/1.0/rdf-schema#provides',
                       'python#float'))
+        self.addPort(('http://physiomeproject.org/workflow/1.0/rdf-schema#port',
+                      'http://physiomeproject.org/workflow/1.0/rdf-schema#provides',
+                      'python#dict'))
+        self.addPort(('http://physiomeproject.org/workflow/1.0/rdf-schema#port',
+                      'http://physiomeproject.org/workflow/1.0/rdf-schema#uses',
+                      'http://physiomeproject.org/workflow/1.0/rdf-schema#pointcloud'))
 
         self._config = {}
         self._config['identifier'] = ''
         self._config['regMode'] = 1
         self._config['npcs'] = 3
         self._config['GUI'] = True
+        self._config['pcSolver'] = 'optimiser'
+        self._config['float32'] = False
+        self._config['jit'] = False
+        self._config['lazyOutput'] = False
+        self._config['warmStartIndex'] = ''
+        self._config['pointCloudWeight'] = 1.0
+        self._config['atlasCriterion'] = 'rmse'
+        self._config['speculative'] = True
+        self._config['timeBudget'] = 0.0
+        self._config['iterationBudget'] = 0
+        # 0 for the solver defaults / no target
+        self._config['xtol'] = 0.0
+        self._config['ftol'] = 0.0
+        self._config['maxIterations'] = 0
+        self._config['targetRMSE'] = 0.0
+        # Prometheus metrics, written to this file after each registration
+        # and/or served on this localhost port
+        self._config['metricsFile'] = ''
+        self._config['metricsPort'] = 0
+        # per-registration cProfile and tracemalloc dumps, see profiling
+        self._config['profileDir'] = ''
+        # BLAS/OpenMP threads per registration, 0 for no limit
+        self._config['blasThreads'] = 0
+        # directory of a cohortstore.CohortStore to add every result to
+        self._config['cohortStore'] = ''
         for l in PELVISLANDMARKS:
             self._config[l] = 'none'
 
         self._landmarks = None
+        self._pointCloud = None
         self._pc = None
         self._inputModel = None
         self._outputModel = None
         self._rmse = None
         self._transform = None
+        self._diagnostics = None
+        self._warmStart = None
+        self._inputLandmarks = None
+        self._subject = None
+        self._cohortStore = None
+        # (T, config) of the fit shown to the user, kept when it is accepted
+        self._pendingResult = None
 
     def execute(self):
         '''
@@ -77,49 +128,54 @@ class FieldworkPCRegPelvis2LandmarksStep(WorkflowStepMountPoint):
         Make sure you call the _doneExecution() method when finished.  This method
         may be connected up to a button in a widget for example.
         '''
-        if self._config['regMode'] == 1:
-            self._inputModel.set_field_parameters(self._pc.getMean().reshape((3, -1, 1)))
+        if self._isMultiAtlas():
+            # show the first atlas' template, the best fit is drawn on its mesh
+            viewerModel = self._inputModel[sorted(self._inputModel)[0]]
+            if self._config['GUI']:
+                self._checkAtlasTemplates(viewerModel)
+        else:
+            registration.prepareInputModel(self._inputModel, self._pc, self._config)
+            viewerModel = self._inputModel
         if self._config['GUI']:
+            from mapclientplugins.fieldworkpcregpelvis2landmarksstep.pcregviewerwidget import MayaviPCRegViewerWidget
             print('launching registration gui')
             # model = copy.deepcopy(self._inputModel)
+            speculative = self._config['speculative'] and not self._isMultiAtlas()
             self._widget = MayaviPCRegViewerWidget(self._landmarks,
-                                                   self._inputModel,
+                                                   viewerModel,
                                                    self._config,
                                                    self.reg,
+                                                   fitFunc=self.fitVariant if speculative else None,
+                                                   resultFunc=self.setResult,
+                                                   regModes=self._regModes(),
                                                    )
-            self._widget._ui.acceptButton.clicked.connect(self._doneExecution)
+            self._widget._ui.acceptButton.clicked.connect(self._accept)
             self._widget._ui.abortButton.clicked.connect(self._abort)
             self._widget.setModal(True)
             self._setCurrentWidget(self._widget)
         else:
             self.reg()
-            self._doneExecution()
+            self._accept()
+
+    def _accept(self):
+        # only the accepted fit goes into the cohort store and warm start index
+        if self._pendingResult is not None:
+            T, config = self._pendingResult
+            self._storeResult(T, config)
+            self._addWarmStart(T, config)
+            self._pendingResult = None
+        self._doneExecution()
+
+    def _regModes(self):
+        # PC + Point Cloud needs the point cloud port
+        return (1, 2) if self._pointCloud is None else (1, 2, 3)
 
     def _abort(self):
         raise RuntimeError('Pelvis Landmark Registration Aborted')
 
     def _correctLandmarks(self):
         # move landmarks closer to centre in anterior-posterior direction
-        centreAnt = 0.5 * (self._landmarks[self._config['LASIS']] + self._landmarks[self._config['RASIS']])
-        if self._config.get('Sacral') != 'none':
-            centrePos = self._landmarks[self._config['Sacral']]
-        elif (self._config.get('LPSIS') != 'none') and (self._config.get('RPSIS') != 'none'):
-            centrePos = 0.5 * (self._landmarks[self._config.get('LPSIS')] +
-                               self._landmarks[self._config.get('RPSIS')]
-                               )
-        else:
-            return
-
-        centre = 0.5 * (centreAnt + centrePos)
-        vPosAnt = centreAnt - centrePos
-        vPosAntn = math.norm(vPosAnt)
-        self._landmarks[self._config['LASIS']] -= self._landmarkShift * vPosAntn
-        self._landmarks[self._config['RASIS']] -= self._landmarkShift * vPosAntn
-        if self._config.get('Sacral') != 'none':
-            self._landmarks[self._config['Sacral']] += self._landmarkShift * vPosAntn
-        if (self._config.get('LPSIS') != 'none') and (self._config.get('RPSIS') != 'none'):
-            self._landmarks[self._config['LPSIS']] += self._landmarkShift * vPosAntn
-            self._landmarks[self._config['RPSIS']] += self._landmarkShift * vPosAntn
+        registration.correctLandmarks(self._landmarks, self._config, self._landmarkShift)
 
     def reg(self, callbackSignal=None):
 
@@ -129,37 +185,171 @@ class FieldworkPCRegPelvis2LandmarksStep(WorkflowStepMountPoint):
         else:
             callback = None
 
-        self._correctLandmarks()
-        inputLandmarks = [('pelvis-' + l, self._landmarks[self._config[l]]) for l in PELVISLANDMARKS if
-                          self._config[l] != 'none']
-
-        if self._config['regMode'] == 1:
-            self._outputModel, \
-            alignmentSSE, \
-            T = ma.alignModelLandmarksPC(
-                self._inputModel,
-                inputLandmarks,
-                self._pc,
-                self._config['npcs'],
-                gf_params_callback=callback,
-                mw0=self._pcfitmw0,
-                mwn=self._pcfitmwn
-            )
-            self._transform = transformations.RigidPCModesTransform(T)
-        elif self._config['regMode']:
-            self._outputModel, \
-            alignmentSSE, \
-            T = ma.alignModelLandmarksLinScale(
-                self._inputModel,
-                inputLandmarks,
-                gf_params_callback=callback,
-            )
-            self._transform = transformations.RigidScaleTransformAboutPoint(T, P=self._inputModel.calc_CoM())
-
-        self._rmse = np.sqrt(alignmentSSE[-1] / len(inputLandmarks))
+        if self._config['metricsPort']:
+            metrics.serveMetrics(int(self._config['metricsPort']))
+
+        directory = profiling.profileDir(self._config)
+        with profiling.RegistrationProfile(directory, self._config['identifier'], self._subject), \
+                threadlimits.limitThreads(self._config['blasThreads']):
+            if self._isMultiAtlas():
+                return self._regMultiAtlas(callback)
+            return self._regSingle(callback)
 
+    def _regSingle(self, callback):
+        self._correctLandmarks()
+        inputLandmarks = registration.inputLandmarkList(self._landmarks, self._config)
+        self._inputLandmarks = inputLandmarks
+
+        config = dict(self._config)
+        config.setdefault('pcfitmw0', self._pcfitmw0)
+        config.setdefault('pcfitmwn', self._pcfitmwn)
+
+        warmStart = self._getWarmStartIndex(config)
+        w0 = None
+        if (warmStart is not None) and registration.usesWarmStart(config):
+            w0 = warmStart.query(warmstart.pelvisFeatures(inputLandmarks), self._config['npcs'])
+            if w0 is None:
+                metrics.CACHE_MISSES.inc(cache='warmstart')
+            else:
+                metrics.CACHE_HITS.inc(cache='warmstart')
+
+        fitBudget = budget.FitBudget.fromConfig(config)
+        self._outputModel, \
+        self._rmse, \
+        T, \
+        self._transform = registration.align(self._inputModel, inputLandmarks, self._pc, config, callback=callback,
+                                             w0=w0, pointCloud=self._pointCloud, fitBudget=fitBudget)
+        self._diagnostics = diagnostics.landmarkDiagnostics(self._inputModel, inputLandmarks, self._pc, config, T)
+        self._diagnostics.update(fitBudget.status())
+        if self._config['lazyOutput']:
+            # keep only the transform, the mesh is rebuilt when first accessed downstream
+            self._outputModel = lazymodel.LazyFieldworkModel(self._inputModel, self._pc, T,
+                                                             self._config['regMode'], self._config['npcs'])
+
+        self._pendingResult = (T, dict(self._config))
+        self._exportMetrics()
         return self._outputModel, self._rmse, T
 
+    def fitVariant(self, config, w0=None, landmarks=None):
+        '''
+        Fit landmarks, by default a copy of those of the last reg, with
+        config instead of the step config, e.g. another npcs, without
+        changing the step's state. Safe to run in a background thread if
+        landmarks is not modified meanwhile. Returns the output of
+        registration.align followed by the budget status. Recorded in the
+        metrics as a speculative fit.
+        '''
+        config = dict(config)
+        config.setdefault('pcfitmw0', self._pcfitmw0)
+        config.setdefault('pcfitmwn', self._pcfitmwn)
+        if landmarks is None:
+            landmarks = [(name, np.array(x, dtype=float)) for name, x in self._inputLandmarks]
+        model = copy.deepcopy(self._inputModel)
+        fitBudget = budget.FitBudget.fromConfig(config)
+        result = registration.align(model, landmarks, self._pc, config, w0=w0,
+                                    pointCloud=self._pointCloud, fitBudget=fitBudget, kind='speculative')
+        return result + (fitBudget.status(),)
+
+    def setResult(self, config, result):
+        '''
+        Use a fit from fitVariant as the step's output.
+        '''
+        config = dict(config)
+        config.setdefault('pcfitmw0', self._pcfitmw0)
+        config.setdefault('pcfitmwn', self._pcfitmwn)
+        self._outputModel, self._rmse, T, self._transform, status = result
+        self._diagnostics = diagnostics.landmarkDiagnostics(self._inputModel, self._inputLandmarks, self._pc,
+                                                            config, T)
+        self._diagnostics.update(status)
+        if self._config['lazyOutput']:
+            self._outputModel = lazymodel.LazyFieldworkModel(self._inputModel, self._pc, T,
+                                                             config['regMode'], config['npcs'])
+        self._pendingResult = (T, config)
+
+    def _isMultiAtlas(self):
+        return isinstance(self._pc, dict)
+
+    def _checkAtlasTemplates(self, viewerModel):
+        nNodes = viewerModel.get_field_parameters().shape[1]
+        for name in sorted(self._inputModel):
+            if self._inputModel[name].get_field_parameters().shape[1] != nNodes:
+                raise ValueError('The viewer needs atlas templates with the same nodes, template {} has {} nodes '
+                                 'instead of {}. Run without the GUI to fit atlases with different meshes.'
+                                 .format(name, self._inputModel[name].get_field_parameters().shape[1], nNodes))
+
+    def _regMultiAtlas(self, callback):
+        # ju#principalcomponents and ju#fieldworkmodel are dicts of atlas name: PC model / template
+        config = dict(self._config)
+        config.setdefault('pcfitmw0', self._pcfitmw0)
+        config.setdefault('pcfitmwn', self._pcfitmwn)
+        atlases = dict((name, (pc, self._inputModel[name])) for name, pc in self._pc.items())
+        best, results = multiatlas.fitAtlases(self._landmarks, atlases, config,
+                                              criterion=self._config['atlasCriterion'],
+                                              pointCloud=self._pointCloud)
+
+        result = results[best]
+        self._outputModel = result['outputModel']
+        self._rmse = result['rmse']
+        self._transform = result['transform']
+        self._diagnostics = dict(result['diagnostics'],
+                                 atlas=best,
+                                 atlasScores=multiatlas.atlasScores(results))
+        if callback is not None:
+            callback(self._outputModel.get_field_parameters().ravel())
+
+        self._pendingResult = (result['T'], dict(self._config, npcs=result['npcs'], atlas=best))
+        self._exportMetrics()
+        return self._outputModel, self._rmse, result['T']
+
+    def _storeResult(self, T, config):
+        directory = self._config['cohortStore']
+        if not directory:
+            return
+        if (self._cohortStore is None) or (self._cohortStore.directory != directory):
+            self._cohortStore = cohortstore.CohortStore(directory)
+        subject = '{}_{}'.format(self._config['identifier'], self._subject) if self._config['identifier'] else \
+            self._subject
+        pc = self._pc[config['atlas']] if self._isMultiAtlas() else self._pc
+        self._cohortStore.add(subject, T, self._rmse, config['regMode'], config['npcs'],
+                              cohortstore.atlasIdentity(pc))
+
+    def _exportMetrics(self):
+        if self._config['metricsFile']:
+            metrics.writeTextfile(self._config['metricsFile'])
+
+    def _getWarmStartIndex(self, config):
+        filename = self._config.get('warmStartIndex')
+        if (not filename) or (config['regMode'] not in registration.PCMODES) or self._isMultiAtlas():
+            return None
+        if (self._warmStart is None) or (self._warmStart.filename != filename):
+            self._warmStart = warmstart.WarmStartIndex(filename)
+        return self._warmStart
+
+    def _addWarmStart(self, T, config):
+        warmStart = self._getWarmStartIndex(config)
+        if warmStart is not None:
+            warmStart.add(warmstart.pelvisFeatures(self._inputLandmarks), T[6:])
+            warmStart.save()
+
+    def regAsync(self, executor=None):
+        '''
+        Run reg in an executor from a running asyncio event loop. Returns an
+        asyncreg.AsyncRegistration that yields intermediate parameters and
+        resolves to the output of reg.
+        '''
+        return asyncreg.AsyncRegistration(self.reg, executor=executor)
+
+    def _pelvisLandmarks(self):
+        return dict((l, self._landmarks[self._config[l]]) for l in PELVISLANDMARKS if self._config[l] != 'none')
+
+    def saveQCViews(self, filenamePrefix, size=(800, 800)):
+        '''
+        Render the registered model and landmarks offscreen to the standard
+        anterior, lateral and superior views in a worker process, leaving
+        the GUI toolkit of this process alone. Does not need a display.
+        '''
+        return qcrender.renderQCViews(self._outputModel, self._pelvisLandmarks(), filenamePrefix, size=size)
+
     def setPortData(self, index, dataIn):
         '''
         Add your code here that will set the appropriate objects for this step.
@@ -168,10 +358,15 @@ class FieldworkPCRegPelvis2LandmarksStep(WorkflowStepMountPoint):
         '''
         if index == 0:
             self._landmarks = dataIn  # ju#landmarks
+            # named before reg corrects the landmarks in place, so that the
+            # name does not change when reg is run again
+            self._subject = profiling.landmarksDigest(dataIn)
         elif index == 1:
             self._pc = dataIn
-        else:
+        elif index == 2:
             self._inputModel = dataIn
+        else:
+            self._pointCloud = dataIn  # pointcloud, PC + Point Cloud mode only
 
     def getPortData(self, index):
         '''
@@ -183,8 +378,10 @@ class FieldworkPCRegPelvis2LandmarksStep(WorkflowStepMountPoint):
             return self._outputModel  # ju#landmarks
         elif index == 4:
             return self._transform
-        else:
+        elif index == 5:
             return self._rmse
+        else:
+            return self._diagnostics  # per-landmark residuals and LOLO errors
 
     def configure(self):
         '''
@@ -194,14 +391,15 @@ class FieldworkPCRegPelvis2LandmarksStep(WorkflowStepMountPoint):
         then set:
             self._configured = True
         '''
-        dlg = ConfigureDialog(self._main_window)
+        from mapclientplugins.fieldworkpcregpelvis2landmarksstep.configuredialog import ConfigureDialog
+        dlg = ConfigureDialog(self._main_window, regModes=self._regModes())
         dlg.identifierOccursCount = self._identifierOccursCount
         dlg.setConfig(self._config)
         dlg.validate()
         dlg.setModal(True)
 
         if dlg.exec_():
-            self._config = dlg.getConfig()
+            self._config.update(dlg.getConfig())
 
         self._configured = dlg.validate()
         self._configuredObserver()
@@ -244,10 +442,68 @@ class FieldworkPCRegPelvis2LandmarksStep(WorkflowStepMountPoint):
         if 'npcs' not in self._config:
             self._config['npcs'] = 3
 
+        if 'pcSolver' not in self._config:
+            self._config['pcSolver'] = 'optimiser'
+
+        if 'float32' not in self._config:
+            self._config['float32'] = False
+
+        if 'jit' not in self._config:
+            self._config['jit'] = False
+
+        if 'lazyOutput' not in self._config:
+            self._config['lazyOutput'] = False
+
+        if 'warmStartIndex' not in self._config:
+            self._config['warmStartIndex'] = ''
+
+        if 'pointCloudWeight' not in self._config:
+            self._config['pointCloudWeight'] = 1.0
+
+        if 'atlasCriterion' not in self._config:
+            self._config['atlasCriterion'] = 'rmse'
+
+        if 'speculative' not in self._config:
+            self._config['speculative'] = True
+
+        if 'timeBudget' not in self._config:
+            self._config['timeBudget'] = 0.0
+
+        if 'iterationBudget' not in self._config:
+            self._config['iterationBudget'] = 0
+
+        if 'xtol' not in self._config:
+            self._config['xtol'] = 0.0
+
+        if 'ftol' not in self._config:
+            self._config['ftol'] = 0.0
+
+        if 'maxIterations' not in self._config:
+            self._config['maxIterations'] = 0
+
+        if 'targetRMSE' not in self._config:
+            self._config['targetRMSE'] = 0.0
+
+        if 'metricsFile' not in self._config:
+            self._config['metricsFile'] = ''
+
+        if 'metricsPort' not in self._config:
+            self._config['metricsPort'] = 0
+
+        if 'profileDir' not in self._config:
+            self._config['profileDir'] = ''
+
+        if 'blasThreads' not in self._config:
+            self._config['blasThreads'] = 0
+
+        if 'cohortStore' not in self._config:
+            self._config['cohortStore'] = ''
+
         for l in PELVISLANDMARKS:
             if l not in self._config:
                 self._config[l] = 'none'
 
+        from mapclientplugins.fieldworkpcregpelvis2landmarksstep.configuredialog import ConfigureDialog
         d = ConfigureDialog()
         d.identifierOccursCount = self._identifierOccursCount
         d.setConfig(self._config)
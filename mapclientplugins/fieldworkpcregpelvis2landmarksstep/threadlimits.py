@@ -0,0 +1,77 @@
+'''
+BLAS/OpenMP thread budgets for registrations.
+
+NumPy and SciPy linear algebra starts a thread pool as large as the machine
+for every process. When several registrations run side by side, the pools
+oversubscribe the cores. The limits are applied with threadpoolctl when it
+is installed. Worker processes also inherit the *_NUM_THREADS environment
+variables, which BLAS libraries read when they are first loaded, so limits
+reach child processes even without threadpoolctl.
+
+A thread budget of None or 0 means no limit.
+'''
+import os
+import contextlib
+import functools
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'BLIS_NUM_THREADS',
+                   'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+def threadsPerProcess(processes):
+    '''
+    Threads per worker that share the cores evenly between processes.
+    '''
+    return max(1, (os.cpu_count() or 1) // max(1, processes or os.cpu_count() or 1))
+
+
+def limitThreads(threads):
+    '''
+    Context manager limiting the BLAS/OpenMP threads of this process.
+    Has no effect without threadpoolctl once BLAS is loaded.
+    '''
+    if (not threads) or (threadpool_limits is None):
+        return contextlib.nullcontext()
+    return threadpool_limits(limits=int(threads))
+
+
+@contextlib.contextmanager
+def threadEnvironment(threads):
+    '''
+    Set the thread environment variables for processes started inside the
+    block, and restore them afterwards.
+    '''
+    if not threads:
+        yield
+        return
+
+    previous = dict((v, os.environ.get(v)) for v in THREAD_ENV_VARS)
+    os.environ.update((v, str(int(threads))) for v in THREAD_ENV_VARS)
+    try:
+        yield
+    finally:
+        for v, value in previous.items():
+            if value is None:
+                os.environ.pop(v, None)
+            else:
+                os.environ[v] = value
+
+
+def _initWorker(threads, initializer, *initargs):
+    if threads and (threadpool_limits is not None):
+        threadpool_limits(limits=int(threads))
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def workerInitializer(threads, initializer=None):
+    '''
+    Process pool initializer that limits the worker's threads before
+    calling initializer with the pool's initargs.
+    '''
+    return functools.partial(_initWorker, threads, initializer)
@@ -0,0 +1,119 @@
+'''
+Streaming pose tracking of motion-capture pelvis markers.
+
+The shape (PC weights or scale) is fitted once to a static trial with the
+step's registration. After that only the rigid pose changes, so each frame
+is a closed-form Kabsch fit of the fitted model's landmarks to the markers.
+
+The step's landmark correction shifts markers by a fixed offset in the pelvis
+frame. This offset is moved onto the model landmarks once, after the static
+fit, so frames are used as recorded. Markers that are missing from a frame
+(absent or NaN) are left out of that frame's fit. If fewer than 3 markers are
+visible, the previous frame's pose is held.
+'''
+import numpy as np
+
+from gias3.mapclientpluginutilities.datatypes import transformations
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import registration
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import closedform
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import rotations
+
+
+class PelvisPoseTracker(object):
+    '''
+    Fit shape once with fitStatic, then call track on a generator of frames
+    to get one RigidPCModesTransform (PC mode) or
+    RigidScaleTransformAboutPoint (linear scaling mode) per frame.
+    '''
+
+    def __init__(self, pc, model, config):
+        self.pc = pc
+        self.model = model
+        self.config = config
+        self.markerNames = [config[l] for l in registration.PELVISLANDMARKS if config[l] != 'none']
+        self.landmarkNames = ['pelvis-' + l for l in registration.PELVISLANDMARKS if config[l] != 'none']
+        self.staticTransform = None
+        self.staticRMSE = None
+        self._modelMarkers = None
+        self._shapeParams = None
+        self._centre = None
+        self._prevRotation = None
+        self._prevTransform = None
+
+    def fitStatic(self, landmarks):
+        '''
+        Fit the shape and pose to the ju#landmarks dict of a static trial.
+        Returns the static trial's transform.
+        '''
+        raw = np.array([landmarks[n] for n in self.markerNames], dtype=float)
+        outputModel, rmse, T, transform = registration.registerPelvis(landmarks, self.pc, self.model, self.config)
+        corrected = self._correctedArray(landmarks)
+
+        T = np.asarray(T, dtype=float)
+        R = rotations.matrixFromEuler(T[3:6])
+        if self.config['regMode'] in registration.PCMODES:
+            npcs = self.config['npcs']
+            lm = closedform.LandmarkModeModel(self.model, self.landmarkNames, self.pc, npcs)
+            self._shapeParams = T[6:6 + npcs]
+            shapeLandmarks = lm.exactCentred(self._shapeParams)
+            self._centre = lm.centre(self._shapeParams)
+        else:
+            self._centre = np.asarray(self.model.calc_CoM(), dtype=float)
+            self._shapeParams = T[6]
+            X = closedform.evaluateModelLandmarks(self.model, self.landmarkNames)
+            shapeLandmarks = self._shapeParams * (X - self._centre)
+
+        # markers sit at the uncorrected positions in the model frame
+        self._modelMarkers = shapeLandmarks - (corrected - raw).dot(R)
+        self.staticTransform = transform
+        self.staticRMSE = rmse
+        self._prevRotation = T[3:6]
+        self._prevTransform = transform
+        return transform
+
+    def _correctedArray(self, landmarks):
+        landmarks = dict((k, np.array(v, dtype=float)) for k, v in landmarks.items())
+        registration.correctLandmarks(landmarks, self.config)
+        return np.array([landmarks[n] for n in self.markerNames], dtype=float)
+
+    def _frameArray(self, frame):
+        if isinstance(frame, dict):
+            nan = np.full(3, np.nan)
+            return np.array([frame.get(n, nan) for n in self.markerNames], dtype=float)
+        return np.asarray(frame, dtype=float)
+
+    def trackFrame(self, frame):
+        '''
+        Pose for one frame, either a dict of marker name: coordinates or an
+        (n_markers, 3) array in markerNames order with NaN rows for missing
+        markers.
+        '''
+        X = self._frameArray(frame)
+        visible = ~np.isnan(X).any(1)
+        if visible.sum() < 3:
+            return self._prevTransform
+
+        R, tau = rotations.kabsch(self._modelMarkers[visible], X[visible])
+        # keep the Euler angles continuous with the previous frame
+        r = rotations.eulerFromMatrix(R)
+        r = self._prevRotation + (r - self._prevRotation + np.pi) % (2.0 * np.pi) - np.pi
+
+        T = np.hstack([tau - self._centre, r, self._shapeParams])
+        if self.config['regMode'] in registration.PCMODES:
+            transform = transformations.RigidPCModesTransform(T)
+        else:
+            transform = transformations.RigidScaleTransformAboutPoint(T, P=self._centre)
+
+        self._prevRotation = r
+        self._prevTransform = transform
+        return transform
+
+    def track(self, frames):
+        '''
+        Generator of per-frame transforms for a generator of frames.
+        '''
+        if self._modelMarkers is None:
+            raise RuntimeError('fitStatic must be called before tracking')
+        for frame in frames:
+            yield self.trackFrame(frame)
@@ -0,0 +1,193 @@
+'''
+Grid search over the PC fit hyperparameters (npcs and the mode prior
+weights mw0/mwn) on a cohort of landmark sets.
+
+Each setting is scored by the leave-one-landmark-out (LOLO) prediction error,
+i.e. how well the fit to all but one landmark predicts the left-out
+landmark, and by the mean fit time. LOLO errors are computed analytically
+from each fit (see diagnostics) unless refit is requested, in which case the
+fit is repeated once per left-out landmark. Settings are evaluated in
+parallel worker processes and the recommendation is written into a step JSON
+config. mw0 only weights the intermediate stage of the default optimiser, so
+for the other PC solvers the mw0 of the config is kept.
+
+Usage:
+    python -m mapclientplugins.fieldworkpcregpelvis2landmarksstep.tuning \\
+        --config step.json --pc pelvis.pc --gf pelvis.geof --ens pelvis.ens \\
+        --mesh pelvis.mesh subject1.json subject2.json ...
+'''
+import copy
+import time
+import argparse
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from gias3.musculoskeletal import fw_model_landmarks as fml
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import registration
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import dataio
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import diagnostics
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import metrics
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import threadlimits
+
+DEFAULTNPCS = (1, 2, 3, 4, 5)
+DEFAULTMW = (1e0, 1e1, 1e2, 1e3)
+
+_worker = {}
+
+
+def leaveOneLandmarkOutErrors(inputLandmarks, pc, model, config):
+    '''
+    Distance between each of inputLandmarks, a list of (model landmark name,
+    coordinates), and its prediction by a refit to the other landmarks.
+    Returns an array of errors in landmark order.
+    '''
+    errors = []
+    for i, (name, target) in enumerate(inputLandmarks):
+        subset = inputLandmarks[:i] + inputLandmarks[i + 1:]
+        outputModel = registration.align(model, subset, pc, config, kind='tuning')[0]
+        predicted = fml.makeLandmarkEvaluator(name, outputModel)(outputModel.get_field_parameters().reshape((3, -1)))
+        errors.append(np.linalg.norm(predicted - target))
+
+    return np.array(errors)
+
+
+def _initWorker(cohort, pc, model, config, refit):
+    model = copy.deepcopy(model)
+    registration.prepareInputModel(model, pc, config)
+    _worker['refit'] = refit
+    _worker['cohort'] = cohort
+    _worker['pc'] = pc
+    _worker['model'] = model
+    _worker['config'] = config
+
+
+def _scoreSetting(setting):
+    npcs, mw0, mwn = setting
+    config = dict(_worker['config'], npcs=npcs, pcfitmw0=mw0, pcfitmwn=mwn)
+    pc = _worker['pc']
+    model = _worker['model']
+
+    fitTimes = []
+    rmses = []
+    loloErrors = []
+    with metrics.collectFits() as fits:
+        for landmarks in _worker['cohort']:
+            landmarks = dict((k, np.array(v, dtype=float)) for k, v in landmarks.items())
+            registration.correctLandmarks(landmarks, config)
+            inputLandmarks = registration.inputLandmarkList(landmarks, config)
+
+            t0 = time.perf_counter()
+            outputModel, rmse, T, transform = registration.align(model, inputLandmarks, pc, config, kind='tuning')
+            fitTimes.append(time.perf_counter() - t0)
+            rmses.append(rmse)
+            if _worker['refit']:
+                loloErrors.append(leaveOneLandmarkOutErrors(inputLandmarks, pc, model, config))
+            else:
+                loloErrors.append(diagnostics.landmarkDiagnostics(model, inputLandmarks, pc, config, T)['looErrors'])
+
+    loloErrors = np.hstack(loloErrors)
+    return {'npcs': npcs,
+            'pcfitmw0': mw0,
+            'pcfitmwn': mwn,
+            'loloRMSE': float(np.sqrt((loloErrors ** 2.0).mean())),
+            'rmse': float(np.mean(rmses)),
+            'fitTime': float(np.mean(fitTimes)),
+            'fits': fits,
+            }
+
+
+def recommend(scores, tolerance=0.05):
+    '''
+    Fastest setting whose LOLO RMSE is within tolerance (relative) of the
+    best LOLO RMSE.
+    '''
+    best = min(s['loloRMSE'] for s in scores)
+    candidates = [s for s in scores if s['loloRMSE'] <= best * (1.0 + tolerance)]
+    return min(candidates, key=lambda s: (s['fitTime'], s['loloRMSE']))
+
+
+def gridSearch(cohort, pc, model, config, npcsValues=DEFAULTNPCS, mw0Values=DEFAULTMW, mwnValues=DEFAULTMW,
+               processes=None, refit=False, threads=None):
+    '''
+    Score every combination of npcs, mw0 and mwn on cohort, a list of
+    ju#landmarks dicts, using the landmark mapping and solver in config.
+    If refit, LOLO errors are computed by refitting instead of analytically.
+    threads is the BLAS thread budget per worker, by default the cores
+    shared evenly between workers. Solvers that ignore mw0 are only scored
+    with the pcfitmw0 of config. Returns a list of score dicts.
+    '''
+    config = dict(config, regMode=1)
+    if not registration.usesMw0(config):
+        mw0Values = [config.get('pcfitmw0', registration.PCFITMW0)]
+    settings = list(itertools.product(npcsValues, mw0Values, mwnValues))
+    if threads is None:
+        threads = threadlimits.threadsPerProcess(processes)
+    ctx = multiprocessing.get_context('spawn')
+    with threadlimits.threadEnvironment(threads), \
+            ProcessPoolExecutor(max_workers=processes, mp_context=ctx,
+                                initializer=threadlimits.workerInitializer(threads, _initWorker),
+                                initargs=(cohort, pc, model, config, refit)) as executor:
+        scores = list(executor.map(_scoreSetting, settings))
+    for score in scores:
+        metrics.recordFits(score.pop('fits'))
+    return scores
+
+
+def writeRecommendation(configFilename, setting, outputFilename=None):
+    '''
+    Write the recommended npcs, pcfitmw0 and pcfitmwn into a step config.
+    '''
+    config = dataio.loadConfig(configFilename)
+    config['npcs'] = int(setting['npcs'])
+    config['pcfitmw0'] = float(setting['pcfitmw0'])
+    config['pcfitmwn'] = float(setting['pcfitmwn'])
+    dataio.saveConfig(outputFilename or configFilename, config)
+    return config
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Tune npcs and mode prior weights of the pelvis PC fit.')
+    parser.add_argument('landmarks', nargs='+', help='landmark files, one per subject')
+    parser.add_argument('--config', required=True, help='step JSON config with the landmark mapping')
+    parser.add_argument('--pc', required=True, help='principal components file')
+    parser.add_argument('--gf', required=True, help='template geometric field file')
+    parser.add_argument('--ens', default=None, help='template ensemble file')
+    parser.add_argument('--mesh', default=None, help='template mesh file')
+    parser.add_argument('--npcs', type=int, nargs='+', default=DEFAULTNPCS)
+    parser.add_argument('--mw0', type=float, nargs='+', default=DEFAULTMW)
+    parser.add_argument('--mwn', type=float, nargs='+', default=DEFAULTMW)
+    parser.add_argument('--tolerance', type=float, default=0.05,
+                        help='relative LOLO RMSE tolerance when preferring faster settings')
+    parser.add_argument('--refit', action='store_true',
+                        help='compute LOLO errors by refitting instead of analytically')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--threads', type=int, default=None,
+                        help='BLAS threads per process, 0 for no limit, default cores / processes')
+    parser.add_argument('--output', default=None, help='config file to write, defaults to --config')
+    args = parser.parse_args(args)
+
+    cohort = [dataio.loadLandmarks(f) for f in args.landmarks]
+    scores = gridSearch(cohort,
+                        dataio.loadPC(args.pc),
+                        dataio.loadModel(args.gf, args.ens, args.mesh),
+                        dataio.loadConfig(args.config),
+                        args.npcs, args.mw0, args.mwn,
+                        processes=args.processes,
+                        refit=args.refit,
+                        threads=args.threads
+                        )
+    for s in sorted(scores, key=lambda s: s['loloRMSE']):
+        print('npcs {npcs:2d} mw0 {pcfitmw0:8.2e} mwn {pcfitmwn:8.2e}: '
+              'LOLO RMSE {loloRMSE:8.4f} RMSE {rmse:8.4f} fit time {fitTime:8.4f} s'.format(**s))
+
+    best = recommend(scores, args.tolerance)
+    writeRecommendation(args.config, best, args.output)
+    print('recommended: npcs {npcs}, mw0 {pcfitmw0}, mwn {pcfitmwn}'.format(**best))
+
+
+if __name__ == '__main__':
+    main()
@@ -16,9 +16,9 @@ from PySide6.QtGui import (QBrush, QColor, QConicalGradient, QCursor,
     QImage, QKeySequence, QLinearGradient, QPainter,
     QPalette, QPixmap, QRadialGradient, QTransform)
 from PySide6.QtWidgets import (QAbstractButton, QApplication, QCheckBox, QComboBox,
-    QDialog, QDialogButtonBox, QFormLayout, QGridLayout,
-    QGroupBox, QLabel, QLineEdit, QSizePolicy,
-    QSpinBox, QWidget)
+    QDialog, QDialogButtonBox, QDoubleSpinBox, QFormLayout,
+    QGridLayout, QGroupBox, QLabel, QLineEdit,
+    QSizePolicy, QSpinBox, QWidget)
 
 class Ui_Dialog(object):
     def setupUi(self, Dialog):
@@ -149,6 +149,77 @@ class Ui_Dialog(object):
 
         self.formLayout.setWidget(1, QFormLayout.LabelRole, self.label_10)
 
+        self.label_11 = QLabel(self.configGroupBox)
+        self.label_11.setObjectName(u"label_11")
+
+        self.formLayout.setWidget(11, QFormLayout.LabelRole, self.label_11)
+
+        self.doubleSpinBoxTimeBudget = QDoubleSpinBox(self.configGroupBox)
+        self.doubleSpinBoxTimeBudget.setObjectName(u"doubleSpinBoxTimeBudget")
+        self.doubleSpinBoxTimeBudget.setMaximum(3600.000000000000000)
+
+        self.formLayout.setWidget(11, QFormLayout.FieldRole, self.doubleSpinBoxTimeBudget)
+
+        self.label_12 = QLabel(self.configGroupBox)
+        self.label_12.setObjectName(u"label_12")
+
+        self.formLayout.setWidget(12, QFormLayout.LabelRole, self.label_12)
+
+        self.spinBoxIterationBudget = QSpinBox(self.configGroupBox)
+        self.spinBoxIterationBudget.setObjectName(u"spinBoxIterationBudget")
+        self.spinBoxIterationBudget.setMaximum(100000)
+
+        self.formLayout.setWidget(12, QFormLayout.FieldRole, self.spinBoxIterationBudget)
+
+        self.label_13 = QLabel(self.configGroupBox)
+        self.label_13.setObjectName(u"label_13")
+
+        self.formLayout.setWidget(13, QFormLayout.LabelRole, self.label_13)
+
+        self.doubleSpinBoxXtol = QDoubleSpinBox(self.configGroupBox)
+        self.doubleSpinBoxXtol.setObjectName(u"doubleSpinBoxXtol")
+        self.doubleSpinBoxXtol.setDecimals(10)
+        self.doubleSpinBoxXtol.setMaximum(1.000000000000000)
+        self.doubleSpinBoxXtol.setSingleStep(0.000001000000000)
+
+        self.formLayout.setWidget(13, QFormLayout.FieldRole, self.doubleSpinBoxXtol)
+
+        self.label_14 = QLabel(self.configGroupBox)
+        self.label_14.setObjectName(u"label_14")
+
+        self.formLayout.setWidget(14, QFormLayout.LabelRole, self.label_14)
+
+        self.doubleSpinBoxFtol = QDoubleSpinBox(self.configGroupBox)
+        self.doubleSpinBoxFtol.setObjectName(u"doubleSpinBoxFtol")
+        self.doubleSpinBoxFtol.setDecimals(10)
+        self.doubleSpinBoxFtol.setMaximum(1.000000000000000)
+        self.doubleSpinBoxFtol.setSingleStep(0.000001000000000)
+
+        self.formLayout.setWidget(14, QFormLayout.FieldRole, self.doubleSpinBoxFtol)
+
+        self.label_15 = QLabel(self.configGroupBox)
+        self.label_15.setObjectName(u"label_15")
+
+        self.formLayout.setWidget(15, QFormLayout.LabelRole, self.label_15)
+
+        self.spinBoxMaxIterations = QSpinBox(self.configGroupBox)
+        self.spinBoxMaxIterations.setObjectName(u"spinBoxMaxIterations")
+        self.spinBoxMaxIterations.setMaximum(100000)
+
+        self.formLayout.setWidget(15, QFormLayout.FieldRole, self.spinBoxMaxIterations)
+
+        self.label_16 = QLabel(self.configGroupBox)
+        self.label_16.setObjectName(u"label_16")
+
+        self.formLayout.setWidget(16, QFormLayout.LabelRole, self.label_16)
+
+        self.doubleSpinBoxTargetRMSE = QDoubleSpinBox(self.configGroupBox)
+        self.doubleSpinBoxTargetRMSE.setObjectName(u"doubleSpinBoxTargetRMSE")
+        self.doubleSpinBoxTargetRMSE.setDecimals(3)
+        self.doubleSpinBoxTargetRMSE.setMaximum(100.000000000000000)
+
+        self.formLayout.setWidget(16, QFormLayout.FieldRole, self.doubleSpinBoxTargetRMSE)
+
 
         self.gridLayout.addWidget(self.configGroupBox, 0, 0, 1, 1)
 
@@ -175,5 +246,19 @@ class Ui_Dialog(object):
         self.label_8.setText(QCoreApplication.translate("Dialog", u"RHJC:", None))
         self.label_9.setText(QCoreApplication.translate("Dialog", u"PCs to Fit:", None))
         self.label_10.setText(QCoreApplication.translate("Dialog", u"Registration Mode:", None))
+        self.label_11.setText(QCoreApplication.translate("Dialog", u"Time Budget:", None))
+        self.doubleSpinBoxTimeBudget.setSpecialValueText(QCoreApplication.translate("Dialog", u"none", None))
+        self.doubleSpinBoxTimeBudget.setSuffix(QCoreApplication.translate("Dialog", u" s", None))
+        self.label_12.setText(QCoreApplication.translate("Dialog", u"Iteration Budget:", None))
+        self.spinBoxIterationBudget.setSpecialValueText(QCoreApplication.translate("Dialog", u"none", None))
+        self.label_13.setText(QCoreApplication.translate("Dialog", u"Solver xtol:", None))
+        self.doubleSpinBoxXtol.setSpecialValueText(QCoreApplication.translate("Dialog", u"default", None))
+        self.label_14.setText(QCoreApplication.translate("Dialog", u"Solver ftol:", None))
+        self.doubleSpinBoxFtol.setSpecialValueText(QCoreApplication.translate("Dialog", u"default", None))
+        self.label_15.setText(QCoreApplication.translate("Dialog", u"Max Iterations:", None))
+        self.spinBoxMaxIterations.setSpecialValueText(QCoreApplication.translate("Dialog", u"default", None))
+        self.label_16.setText(QCoreApplication.translate("Dialog", u"Target RMSE:", None))
+        self.doubleSpinBoxTargetRMSE.setSpecialValueText(QCoreApplication.translate("Dialog", u"none", None))
+        self.doubleSpinBoxTargetRMSE.setSuffix(QCoreApplication.translate("Dialog", u" mm", None))
     # retranslateUi
 
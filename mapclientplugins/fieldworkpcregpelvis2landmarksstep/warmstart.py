@@ -0,0 +1,90 @@
+'''
+Persistent nearest-neighbour index of previous PC fits for warm-starting.
+
+Each fitted subject is stored with a few landmark-derived size features
+(inter-ASIS width, ASIS-PSIS depth, HJC spacing) and its fitted SD-scaled PC
+weights. A new subject starts from the inverse-distance weighted mean of the
+weights of its k nearest neighbours in feature space instead of the mean
+shape. Features missing for either subject are ignored in the distance.
+'''
+import os
+
+import numpy as np
+
+FEATURES = ('interASIS', 'depth', 'interHJC')
+
+
+def pelvisFeatures(inputLandmarks):
+    '''
+    Size features from a list of (model landmark name, coordinates) as
+    passed to the solvers. Unavailable features are NaN.
+    '''
+    l = dict((n.replace('pelvis-', ''), np.asarray(x, dtype=float)) for n, x in inputLandmarks)
+    f = np.full(len(FEATURES), np.nan)
+    if ('LASIS' in l) and ('RASIS' in l):
+        f[0] = np.linalg.norm(l['RASIS'] - l['LASIS'])
+        if ('LPSIS' in l) and ('RPSIS' in l):
+            f[1] = np.linalg.norm(0.5 * (l['LASIS'] + l['RASIS']) - 0.5 * (l['LPSIS'] + l['RPSIS']))
+        elif 'Sacral' in l:
+            f[1] = np.linalg.norm(0.5 * (l['LASIS'] + l['RASIS']) - l['Sacral'])
+    if ('LHJC' in l) and ('RHJC' in l):
+        f[2] = np.linalg.norm(l['RHJC'] - l['LHJC'])
+    return f
+
+
+class WarmStartIndex(object):
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.features = np.zeros((0, len(FEATURES)))
+        self.weights = np.zeros((0, 0))
+        if filename and os.path.exists(filename):
+            with np.load(filename) as data:
+                self.features = data['features']
+                self.weights = data['weights']
+
+    def __len__(self):
+        return len(self.features)
+
+    def add(self, features, weights):
+        '''
+        Add a fitted subject. Weights of different lengths are padded with
+        NaN.
+        '''
+        weights = np.asarray(weights, dtype=float)
+        n = max(self.weights.shape[1], len(weights))
+        padded = np.full((len(self.weights) + 1, n), np.nan)
+        padded[:-1, :self.weights.shape[1]] = self.weights
+        padded[-1, :len(weights)] = weights
+        self.weights = padded
+        self.features = np.vstack([self.features, features])
+
+    def save(self, filename=None):
+        filename = filename or self.filename
+        tmp = filename + '.tmp.npz'
+        np.savez(tmp, features=self.features, weights=self.weights)
+        os.replace(tmp, filename)
+
+    def query(self, features, npcs, k=5):
+        '''
+        Initial SD-scaled weights for a subject with the given features,
+        or None if no stored subject is comparable.
+        '''
+        if not len(self):
+            return None
+
+        features = np.asarray(features, dtype=float)
+        # scale-free distance over the features both subjects have
+        diff = (self.features - features) / features
+        valid = ~np.isnan(diff)
+        nValid = valid.sum(1)
+        dist = np.sqrt((np.where(valid, diff, 0.0) ** 2.0).sum(1) / np.maximum(nValid, 1))
+        hasWeights = ~np.isnan(self.weights[:, :npcs]).any(1) if self.weights.shape[1] >= npcs else \
+            np.zeros(len(self), dtype=bool)
+        candidates = np.where((nValid > 0) & hasWeights)[0]
+        if not len(candidates):
+            return None
+
+        nearest = candidates[np.argsort(dist[candidates])[:k]]
+        idw = 1.0 / np.maximum(dist[nearest], 1e-6)
+        return (self.weights[nearest, :npcs] * idw[:, np.newaxis]).sum(0) / idw.sum()
@@ -0,0 +1,137 @@
+'''
+Vectorised warping of point sets with the transforms this step produces.
+
+All functions take (N, 3) arrays and apply the transform in one pass.
+RigidScaleTransformAboutPoint parameters are [tx, ty, tz, rx, ry, rz, s]
+about P; RigidPCModesTransform parameters are [tx, ty, tz, rx, ry, rz, w0,
+...] with the rigid part applied about the centre of mass of the PC shape,
+see closedform.
+
+PC-mode warps of arbitrary points need the mode displacements at those
+points. PCModeWarp interpolates them once from the nodal displacements of the
+mean shape. After that, each transform applied to the same points costs one
+small tensor product.
+'''
+import numpy as np
+from scipy.spatial import cKDTree
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import closedform
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import rotations
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import pcbasis
+
+
+def applyRigidScale(T, P, X):
+    '''
+    s.R.(X - P) + P + t for points X (N, 3).
+    '''
+    T = np.asarray(T, dtype=float)
+    P = np.asarray(P, dtype=float)
+    R = rotations.matrixFromEuler(T[3:6])
+    s = T[6] if len(T) > 6 else 1.0
+    return s * (np.asarray(X, dtype=float) - P).dot(R.T) + P + T[:3]
+
+
+def invertRigidScale(T, P, X):
+    '''
+    Inverse of applyRigidScale.
+    '''
+    T = np.asarray(T, dtype=float)
+    P = np.asarray(P, dtype=float)
+    R = rotations.matrixFromEuler(T[3:6])
+    s = T[6] if len(T) > 6 else 1.0
+    return (np.asarray(X, dtype=float) - P - T[:3]).dot(R) / s + P
+
+
+class PCModeWarp(object):
+    '''
+    PC shape plus rigid warp of fixed points on the mean-shape template.
+
+    Mode displacements at points are inverse-distance weighted from the k
+    nearest mean-shape nodes. For points at nodes this reproduces the nodal
+    displacement exactly.
+    '''
+
+    def __init__(self, pc, npcs, points, k=8, power=2.0):
+        basis = pcbasis.TruncatedPCBasis(pc, npcs)
+        meanNodes = basis.mean.reshape((3, -1)).T
+        modeNodes = basis.modes.T.reshape((npcs, 3, -1)).transpose((0, 2, 1))
+        self.points = np.asarray(points, dtype=float)
+        self.npcs = npcs
+
+        k = min(k, len(meanNodes))
+        dist, idx = cKDTree(meanNodes).query(self.points, k=k)
+        dist = dist.reshape((len(self.points), k))
+        idx = idx.reshape((len(self.points), k))
+        with np.errstate(divide='ignore'):
+            weights = 1.0 / dist ** power
+        exact = np.isinf(weights)
+        rowsExact = exact.any(1)
+        weights[rowsExact] = exact[rowsExact].astype(float)
+        weights /= weights.sum(1)[:, np.newaxis]
+
+        # (npcs, N, 3) displacement of every point per unit SD of each mode
+        self.displacements = np.einsum('pk,mpkj->mpj', weights, modeNodes[:, idx, :])
+        self.c0 = meanNodes.mean(0)
+        self.dc = modeNodes.mean(1)
+
+    def shape(self, w):
+        '''
+        Points deformed by SD-scaled PC weights w, before the rigid part.
+        '''
+        w = np.asarray(w, dtype=float)[:self.npcs]
+        return self.points + np.tensordot(w, self.displacements, axes=1)
+
+    def apply(self, T):
+        '''
+        Points warped by RigidPCModesTransform parameters T.
+        '''
+        T = np.asarray(T, dtype=float)
+        w = T[6:6 + self.npcs]
+        c = self.c0 + w.dot(self.dc)
+        R = rotations.matrixFromEuler(T[3:6])
+        return (self.shape(w) - c).dot(R.T) + c + T[:3]
+
+    def applyMany(self, Ts):
+        '''
+        Points warped by each row of Ts (n_transforms, 6 + npcs), returned as
+        (n_transforms, N, 3).
+        '''
+        Ts = np.atleast_2d(np.asarray(Ts, dtype=float))
+        W = Ts[:, 6:6 + self.npcs]
+        shapes = self.points + np.einsum('tm,mpj->tpj', W, self.displacements)
+        c = self.c0 + W.dot(self.dc)
+        R = np.array([rotations.matrixFromEuler(r) for r in Ts[:, 3:6]])
+        return np.einsum('tpj,tij->tpi', shapes - c[:, np.newaxis], R) + (c + Ts[:, :3])[:, np.newaxis]
+
+
+# transformType of the gias3 transforms that are a rigid(-scale) transform
+# about a point, and whether that point is the transform's P or the origin
+RIGIDTYPES = {'rigid': False,
+              'rigid_about_point': True,
+              'rigidscale_about_point': True,
+              }
+
+
+def _rigidCentre(transform):
+    if transform.transformType not in RIGIDTYPES:
+        raise ValueError('unsupported transform type {}'.format(transform.transformType))
+    return transform.P if RIGIDTYPES[transform.transformType] else np.zeros(3)
+
+
+def warpPoints(transform, X=None, pcWarp=None):
+    '''
+    Apply a rigid or rigid-scale transform to points X, or a
+    RigidPCModesTransform to the points of pcWarp.
+    '''
+    if transform.transformType == 'rigidpcmodes':
+        if pcWarp is None:
+            raise ValueError('a PCModeWarp is needed to apply a PC modes transform')
+        return pcWarp.apply(transform.T)
+    return applyRigidScale(transform.T, _rigidCentre(transform), X)
+
+
+def unwarpPoints(transform, X):
+    '''
+    Inverse of a rigid or rigid-scale transform for points X.
+    '''
+    return invertRigidScale(transform.T, _rigidCentre(transform), X)
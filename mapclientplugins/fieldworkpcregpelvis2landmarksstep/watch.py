@@ -0,0 +1,286 @@
+'''
+Watch-folder daemon for continuous registration.
+
+Polls a drop directory for landmark files (see dataio.loadLandmarks) and
+registers each new one with a fixed step config, PC model and template that
+are loaded once into a pool of worker processes. The result of
+subject.json is written next to it as subject.reg.json, with status, rmse,
+T and the registered nodal params, or the error.
+
+A file is picked up once its size and modification time are unchanged for
+one poll interval, so that files still being copied are left alone. Files
+are deduplicated by content digest in a ledger in the directory, so
+restarts, touched files and renamed copies are not registered again. A
+file whose content changes is registered again. At most workers files are
+registered at a time.
+
+Only registration results, including registrations that raise, go into the
+ledger. If a worker process dies (e.g. killed for memory), the pool is
+recreated and the file is retried on a later poll, up to MAXATTEMPTS times
+per run of the daemon.
+
+Usage:
+    python -m mapclientplugins.fieldworkpcregpelvis2landmarksstep.watch dropdir \\
+        --config step.json --pc pelvis.pc --gf pelvis.geof --ens pelvis.ens --mesh pelvis.mesh
+'''
+import os
+import json
+import copy
+import time
+import fnmatch
+import hashlib
+import argparse
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import registration
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import dataio
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import metrics
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import threadlimits
+
+LEDGER = '.pelvisreg_processed.jsonl'
+RESULTSUFFIX = '.reg.json'
+PATTERNS = ('*.json', '*.txt')
+MAXATTEMPTS = 3
+
+_worker = {}
+
+
+def _initWorker(pc, model, config):
+    model = copy.deepcopy(model)
+    registration.prepareInputModel(model, pc, config)
+    _worker['pc'] = pc
+    _worker['model'] = model
+    _worker['config'] = config
+
+
+def _registerFile(filename):
+    with metrics.collectFits() as fits:
+        try:
+            landmarks = dataio.loadLandmarks(filename)
+            outputModel, rmse, T, transform = registration.registerPelvis(landmarks,
+                                                                          _worker['pc'],
+                                                                          _worker['model'],
+                                                                          _worker['config'])
+        except Exception:
+            return {'status': 'failed', 'error': traceback.format_exc(), 'fits': fits}
+
+    return {'status': 'ok',
+            'rmse': float(rmse),
+            'T': np.asarray(T, dtype=float).tolist(),
+            'params': np.asarray(outputModel.get_field_parameters(), dtype=float).ravel().tolist(),
+            'fits': fits,
+            }
+
+
+def fileDigest(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def resultFilename(filename):
+    return os.path.splitext(filename)[0] + RESULTSUFFIX
+
+
+class WatchFolder(object):
+    '''
+    Polling registration daemon for one directory. run() polls until
+    stop() is called or it is interrupted.
+    '''
+
+    def __init__(self, directory, pc, model, config, workers=2, interval=2.0, patterns=PATTERNS, threads=None):
+        self.directory = directory
+        self.workers = workers
+        self.interval = interval
+        self.patterns = patterns
+        self._threads = threadlimits.threadsPerProcess(workers) if threads is None else threads
+        self._initargs = (pc, model, config)
+        self._executor = self._makeExecutor()
+        self._ledgerFilename = os.path.join(directory, LEDGER)
+        self._processed = self._loadLedger()
+        self._sizes = {}
+        self._digests = {}
+        self._running = {}
+        self._attempts = {}
+        self._stopped = False
+
+    def _makeExecutor(self):
+        return ProcessPoolExecutor(max_workers=self.workers,
+                                   mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=threadlimits.workerInitializer(self._threads, _initWorker),
+                                   initargs=self._initargs)
+
+    def _restartExecutor(self):
+        print('worker pool broken, restarting it')
+        self._executor.shutdown(wait=False)
+        self._executor = self._makeExecutor()
+
+    def _loadLedger(self):
+        processed = set()
+        if os.path.exists(self._ledgerFilename):
+            with open(self._ledgerFilename, 'r') as f:
+                for line in f:
+                    try:
+                        processed.add(json.loads(line)['digest'])
+                    except (ValueError, KeyError):
+                        # partial line from an interrupted write
+                        pass
+        return processed
+
+    def _record(self, filename, digest, result):
+        with open(resultFilename(filename) + '.tmp', 'w') as f:
+            json.dump(dict(result, input=os.path.basename(filename)), f)
+        os.replace(resultFilename(filename) + '.tmp', resultFilename(filename))
+
+        with open(self._ledgerFilename, 'a') as f:
+            f.write(json.dumps({'file': os.path.basename(filename), 'digest': digest, 'status': result['status'],
+                                'time': time.time()}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._processed.add(digest)
+
+    def _isInput(self, name):
+        if name.startswith('.') or name.endswith(RESULTSUFFIX):
+            return False
+        return any(fnmatch.fnmatch(name, p) for p in self.patterns)
+
+    def poll(self):
+        '''
+        Files that have settled since the last poll and are not yet
+        processed or running, oldest first.
+        '''
+        ready = []
+        sizes = {}
+        for name in sorted(os.listdir(self.directory)):
+            filename = os.path.join(self.directory, name)
+            if (not self._isInput(name)) or (not os.path.isfile(filename)):
+                continue
+            stat = os.stat(filename)
+            sizes[filename] = (stat.st_size, stat.st_mtime)
+            if self._sizes.get(filename) == sizes[filename]:
+                ready.append((stat.st_mtime, filename))
+        self._sizes = sizes
+
+        new = []
+        runningFiles = set(filename for filename, digest in self._running.values())
+        seen = set(digest for filename, digest in self._running.values())
+        for mtime, filename in sorted(ready):
+            if filename in runningFiles:
+                continue
+            # only hash files that are new or have changed
+            key = (filename,) + sizes[filename]
+            if key not in self._digests:
+                self._digests[key] = fileDigest(filename)
+            digest = self._digests[key]
+            if (digest not in self._processed) and (digest not in seen) and \
+                    (self._attempts.get(digest, 0) < MAXATTEMPTS):
+                seen.add(digest)
+                new.append((filename, digest))
+        self._digests = dict((k, d) for k, d in self._digests.items() if k[0] in sizes)
+        return new
+
+    def _collect(self, done):
+        done = list(done)
+        broken = False
+        while done:
+            future = done.pop(0)
+            filename, digest = self._running.pop(future)
+            try:
+                result = future.result()
+            except Exception:
+                # _registerFile returns registration errors, so this is a
+                # dead worker or pool: not recorded, the file is retried
+                if isinstance(future.exception(), BrokenProcessPool) and not broken:
+                    broken = True
+                    # the other registrations in the pool fail with it
+                    done.extend(f for f in self._running if f not in done)
+                self._attempts[digest] = self._attempts.get(digest, 0) + 1
+                print('{}: worker error, attempt {} of {}\n{}'.format(os.path.basename(filename),
+                                                                    self._attempts[digest], MAXATTEMPTS,
+                                                                    traceback.format_exc()))
+                continue
+            self._attempts.pop(digest, None)
+            metrics.recordFits(result.pop('fits'))
+            self._record(filename, digest, result)
+            print('{}: {}'.format(os.path.basename(filename), result['status']))
+        if broken:
+            self._restartExecutor()
+
+    def step(self):
+        '''
+        One poll: collect finished registrations and submit new files up
+        to the concurrency limit.
+        '''
+        self._collect([f for f in self._running if f.done()])
+        for filename, digest in self.poll():
+            if len(self._running) >= self.workers:
+                # picked up again by a later poll
+                break
+            with threadlimits.threadEnvironment(self._threads):
+                try:
+                    future = self._executor.submit(_registerFile, filename)
+                except BrokenProcessPool:
+                    self._restartExecutor()
+                    future = self._executor.submit(_registerFile, filename)
+            self._running[future] = (filename, digest)
+
+    def run(self):
+        try:
+            while not self._stopped:
+                self.step()
+                if self._running:
+                    self._collect(wait(list(self._running), timeout=self.interval,
+                                       return_when=FIRST_COMPLETED).done)
+                else:
+                    time.sleep(self.interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+
+    def stop(self):
+        self._stopped = True
+
+    def shutdown(self):
+        '''
+        Wait for running registrations, record them, and stop the workers.
+        '''
+        if self._running:
+            self._collect(wait(list(self._running)).done)
+        self._executor.shutdown(wait=True)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Register landmark files as they arrive in a directory.')
+    parser.add_argument('directory', help='drop directory to watch')
+    parser.add_argument('--config', required=True, help='step JSON config')
+    parser.add_argument('--pc', required=True, help='principal components file')
+    parser.add_argument('--gf', required=True, help='template geometric field file')
+    parser.add_argument('--ens', default=None, help='template ensemble file')
+    parser.add_argument('--mesh', default=None, help='template mesh file')
+    parser.add_argument('--workers', type=int, default=2, help='maximum concurrent registrations')
+    parser.add_argument('--interval', type=float, default=2.0, help='poll interval in seconds')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='BLAS threads per worker, 0 for no limit, default cores / workers')
+    args = parser.parse_args(args)
+
+    watcher = WatchFolder(args.directory,
+                          dataio.loadPC(args.pc),
+                          dataio.loadModel(args.gf, args.ens, args.mesh),
+                          dataio.loadConfig(args.config),
+                          workers=args.workers,
+                          interval=args.interval,
+                          threads=args.threads)
+    print('watching {}'.format(args.directory))
+    watcher.run()
+
+
+if __name__ == '__main__':
+    main()
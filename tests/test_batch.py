@@ -0,0 +1,54 @@
+import os
+import json
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('gias3.musculoskeletal.model_alignment')
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import batch
+
+
+def _lines(filename):
+    with open(filename) as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.mark.parametrize('content', [b'', b'{"job": "ab'])
+def test_missing_header_is_rewritten(tmpdir, content):
+    filename = str(tmpdir.join('results.jsonl'))
+    with open(filename, 'wb') as f:
+        f.write(content)
+    store = batch.ResultsStore(filename, 'abc')
+    store.add({'subject': 's1', 'status': 'ok'})
+    assert _lines(filename) == [{'job': 'abc'}, {'subject': 's1', 'status': 'ok'}]
+
+
+def test_resume(tmpdir):
+    filename = str(tmpdir.join('results.jsonl'))
+    store = batch.ResultsStore(filename, 'abc')
+    store.add({'subject': 's1', 'status': 'ok'})
+    store.add({'subject': 's2', 'status': 'failed'})
+    with open(filename, 'a') as f:
+        f.write('{"subject": "s3", "sta')
+
+    store = batch.ResultsStore(filename, 'abc')
+    assert store.completed == {'s1'}
+    assert [r['subject'] for r in store.records()] == ['s1', 's2']
+
+    with pytest.raises(ValueError):
+        batch.ResultsStore(filename, 'other')
+
+
+def test_digest_ignores_subjects():
+    spec = {'config': 'step.json', 'pc': 'pelvis.pc', 'gf': 'pelvis.geof', 'ens': 'pelvis.ens',
+            'mesh': 'pelvis.mesh', 'results': 'results.jsonl', 'subjects': {'s1': 's1.json'}}
+    config = {'regMode': 1, 'npcs': 3, 'LASIS': 'lasis', 'GUI': False, 'identifier': 'a'}
+    digest = batch.jobDigest(spec, config)
+
+    grown = dict(spec, subjects={'s1': 's1.json', 's2': 's2.json'}, results='other.jsonl')
+    assert batch.jobDigest(grown, dict(config, GUI=True, identifier='b')) == digest
+
+    assert batch.jobDigest(spec, dict(config, npcs=4)) != digest
+    assert batch.jobDigest(spec, dict(config, LASIS='other')) != digest
+    assert batch.jobDigest(dict(spec, pc='other.pc'), config) != digest
@@ -0,0 +1,256 @@
+'''
+The closed-form and least-squares PC solvers against
+model_alignment.alignModelLandmarksPC on a synthetic shape model.
+'''
+import copy
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('scipy')
+pytest.importorskip('gias3.musculoskeletal.model_alignment')
+
+from gias3.common import geoprimitives
+from gias3.common import transform3D
+from gias3.learning import PCA_fitting
+from gias3.learning.PCA import PrincipalComponents
+from gias3.musculoskeletal import model_alignment as ma
+from gias3.musculoskeletal import fw_model_landmarks as fml
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import closedform
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import kernels
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import optimiser
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import budget
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import registration
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import diagnostics
+
+# landmarks gias3 evaluates from single nodes (Sacral is the PSIS midpoint)
+NAMES = ('pelvis-LASIS', 'pelvis-RASIS', 'pelvis-LPSIS', 'pelvis-RPSIS', 'pelvis-Sacral')
+# nodes standing in for the acetabula of the hip joint centre sphere fits
+HJCNODES = {'pelvis-LHJC': np.arange(1100, 1160), 'pelvis-RHJC': np.arange(1200, 1260)}
+NPCS = 2
+
+
+class Field(object):
+    '''
+    The part of the geometric_field interface the solvers use.
+    '''
+
+    def __init__(self, P):
+        self.field_parameters = np.asarray(P, dtype=float).reshape((3, -1, 1))
+
+    def get_field_parameters(self):
+        return self.field_parameters.copy()
+
+    def set_field_parameters(self, P):
+        self.field_parameters = np.asarray(P, dtype=float).reshape((3, -1, 1))
+
+    def calc_CoM(self):
+        return self.field_parameters[:, :, 0].mean(1)
+
+
+def _atlas(acetabula=False):
+    rng = np.random.default_rng(0)
+    nNodes = 1400
+    nodes = rng.normal(0.0, 1.0, (nNodes, 3)) * [80.0, 60.0, 40.0]
+    if acetabula:
+        for nodeIndices, centre in zip(HJCNODES.values(), ([80.0, -20.0, 0.0], [-80.0, -20.0, 0.0])):
+            v = rng.normal(0.0, 1.0, (len(nodeIndices), 3))
+            v[:, 1] = -abs(v[:, 1])
+            nodes[nodeIndices] = centre + 25.0 * v / np.linalg.norm(v, axis=1)[:, np.newaxis]
+    mean = nodes.T.ravel()
+    modes = np.linalg.qr(rng.normal(0.0, 1.0, (3 * nNodes, 4)))[0]
+    # mode SDs of roughly 20, 10, 6 and 4 mm per node
+    weights = (np.array([20.0, 10.0, 6.0, 4.0]) * np.sqrt(3 * nNodes) / 4.0) ** 2.0
+    pc = PrincipalComponents(mean=mean, weights=weights, modes=modes)
+    return pc, Field(mean)
+
+
+@pytest.fixture(scope='module')
+def atlas():
+    return _atlas()
+
+
+@pytest.fixture
+def hjcAtlas(monkeypatch):
+    '''
+    The synthetic atlas with hemispherical acetabula, and LHJC and RHJC
+    evaluated as sphere fits to them as gias3 does on its pelvis mesh.
+    '''
+    def makeEvaluator(nodeIndices):
+        def evaluator(gf, **kwargs):
+            return lambda P: geoprimitives.fitSphereAnalytic(np.asarray(P).reshape((3, -1))[:, nodeIndices].T)[0]
+        return evaluator
+
+    for name, nodeIndices in HJCNODES.items():
+        monkeypatch.setitem(fml._landmarkEvaluators, name, makeEvaluator(nodeIndices))
+    return _atlas(acetabula=True)
+
+
+def _landmarks(pc, gf, T, names=NAMES):
+    modes = list(range(len(T) - 6))
+    P = pc.reconstruct(pc.getWeightsBySD(modes, T[6:]), modes)
+    P = transform3D.transformRigid3DAboutCoM(P.reshape((3, -1)).T, T[:6]).T
+    return [(n, fml.makeLandmarkEvaluator(n, gf)(P)) for n in names]
+
+
+def _gias3Fit(gf, landmarks, pc, npcs, mw0, mwn):
+    try:
+        return ma.alignModelLandmarksPC(gf, landmarks, pc, npcs, mw0=mw0, mwn=mwn)
+    except TypeError:
+        # gias3 3.0.2 passes mWeight where PCFit expects m_weight; run the
+        # same three stages directly
+        pass
+    evaluators = [fml.makeLandmarkEvaluator(n, gf) for n, x in landmarks]
+    targets = [x for n, x in landmarks]
+
+    def obj(P):
+        P = P.reshape((3, -1))
+        return sum(((x - e(P)) ** 2.0).sum() for e, x in zip(evaluators, targets))
+
+    fitter = PCA_fitting.PCFit(pc=pc)
+    fitter.useFMin = True
+    fitter.maxfev = 100000
+    x0 = np.hstack([targets[0] - evaluators[0](pc.getMean().reshape((3, -1))), 0.0, 0.0, 0.0])
+    fitter.rigidFit(obj, x0=x0)
+    fitter.rigidMode0Fit(obj, m_weight=mw0)
+    T, P = fitter.rigidModeNFit(obj, modes=list(range(1, npcs)), m_weight=mwn)
+    outputModel = copy.deepcopy(gf)
+    outputModel.set_field_parameters(P.reshape((3, -1, 1)))
+    return outputModel, [obj(P)], T
+
+
+def _objective(outputModel, landmarks, T, mwn):
+    P = outputModel.get_field_parameters().reshape((3, -1))
+    sse = sum(((x - fml.makeLandmarkEvaluator(n, outputModel)(P)) ** 2.0).sum() for n, x in landmarks)
+    return sse + closedform.priorObjective(T[6:], mwn)
+
+
+def _gias3Params(pc, T):
+    '''
+    Nodal parameters (n, 3) of T applied the way gias3 applies it.
+    '''
+    modes = list(range(len(T) - 6))
+    P = pc.reconstruct(pc.getWeightsBySD(modes, T[6:]), modes)
+    return transform3D.transformRigid3DAboutCoM(P.reshape((3, -1)).T, T[:6])
+
+
+SOLVERS = [('optimiser', optimiser.alignModelLandmarksPCOptimiser, {}),
+           ('alternating', closedform.alignModelLandmarksPCAlternating, {'maxIterations': 200, 'ftol': 1e-12}),
+           ('leastsq', kernels.alignModelLandmarksPCLeastSq, {'jit': False}),
+           ]
+
+
+@pytest.mark.parametrize('mw', [1e-6, 10.0, 1e2])
+@pytest.mark.parametrize('name,solver,args', SOLVERS)
+def test_agrees_with_gias3(atlas, mw, name, solver, args):
+    pc, gf = atlas
+    landmarks = _landmarks(pc, gf, np.array([5.0, -3.0, 8.0, 0.2, -0.15, 0.3, 0.8, -0.5]))
+    refModel, refSSE, refT = _gias3Fit(gf, landmarks, pc, NPCS, mw, mw)
+    outputModel, sse, T = solver(gf, landmarks, pc, NPCS, mw0=mw, mwn=mw, **args)
+
+    # same objective, reached at least as well as the Nelder-Mead reference
+    refObj = _objective(refModel, landmarks, refT, mw)
+    assert _objective(outputModel, landmarks, T, mw) <= refObj * (1.0 + 1e-4) + 1e-8
+
+    # same T, in the gias3 convention
+    np.testing.assert_allclose(T, refT, atol=5e-3)
+    X = outputModel.get_field_parameters().reshape((3, -1)).T
+    np.testing.assert_allclose(X, _gias3Params(pc, T), atol=1e-8)
+    np.testing.assert_allclose(X, refModel.get_field_parameters().reshape((3, -1)).T, atol=0.1)
+
+
+def test_alternating_defaults_close_to_gias3(atlas):
+    pc, gf = atlas
+    landmarks = _landmarks(pc, gf, np.array([-4.0, 6.0, 2.0, -0.1, 0.25, -0.2, -0.6, 0.9]))
+    refModel, refSSE, refT = _gias3Fit(gf, landmarks, pc, NPCS, 1e2, 1e2)
+    outputModel, sse, T = closedform.alignModelLandmarksPCAlternating(gf, landmarks, pc, NPCS, mw0=1e2, mwn=1e2)
+    assert abs(np.sqrt(sse[-1] / len(NAMES)) - np.sqrt(refSSE[-1] / len(NAMES))) < 0.05
+    np.testing.assert_allclose(outputModel.get_field_parameters(), refModel.get_field_parameters(), atol=0.5)
+
+
+def test_point_cloud_tolerances(atlas):
+    pc, gf = atlas
+    T = np.array([3.0, 2.0, -5.0, 0.1, 0.2, -0.1, 0.5, 0.4])
+    landmarks = _landmarks(pc, gf, T)
+    pointCloud = _gias3Params(pc, T)[::7]
+    full = closedform.alignModelLandmarksPCPointCloud(gf, landmarks, pc, NPCS, pointCloud, mw0=1.0, mwn=1.0)
+    early = closedform.alignModelLandmarksPCPointCloud(gf, landmarks, pc, NPCS, pointCloud, mw0=1.0, mwn=1.0,
+                                                       ftol=1e-6)
+    assert len(early[1]) < len(full[1]) == 30
+    np.testing.assert_allclose(early[2], full[2], atol=1e-2)
+
+
+def _config(pcSolver, **kwargs):
+    config = {'regMode': 1, 'npcs': NPCS, 'pcSolver': pcSolver, 'pcfitmw0': 1.0, 'pcfitmwn': 1.0}
+    config.update(kwargs)
+    return config
+
+
+def _rmse(outputModel, landmarks):
+    P = outputModel.get_field_parameters().reshape((3, -1))
+    return np.sqrt(np.mean([((x - fml.makeLandmarkEvaluator(n, outputModel)(P)) ** 2.0).sum()
+                            for n, x in landmarks]))
+
+
+@pytest.mark.parametrize('pcSolver', ['optimiser', 'alternating', 'leastsq'])
+def test_iteration_budget(atlas, pcSolver):
+    pc, gf = atlas
+    landmarks = _landmarks(pc, gf, np.array([5.0, -3.0, 8.0, 0.2, -0.15, 0.3, 0.8, -0.5]))
+    fitBudget = budget.FitBudget(iterations=3)
+    outputModel, rmse, T, transform = registration.align(gf, landmarks, pc, _config(pcSolver),
+                                                         fitBudget=fitBudget)
+
+    # stopped within the first stage, with the output built from the best T
+    assert fitBudget.exhausted and (fitBudget.nIterations == 3)
+    np.testing.assert_array_equal(T, fitBudget.bestT)
+    X = outputModel.get_field_parameters().reshape((3, -1)).T
+    np.testing.assert_allclose(X, _gias3Params(pc, T), atol=1e-8)
+    np.testing.assert_allclose(rmse, _rmse(outputModel, landmarks), rtol=1e-8)
+
+
+@pytest.mark.parametrize('pcSolver', ['optimiser', 'alternating', 'leastsq'])
+def test_target_rmse(atlas, pcSolver):
+    pc, gf = atlas
+    landmarks = _landmarks(pc, gf, np.array([5.0, -3.0, 8.0, 0.2, -0.15, 0.3, 0.8, -0.5]))
+    full = budget.FitBudget(iterations=100000)
+    registration.align(gf, landmarks, pc, _config(pcSolver), fitBudget=full)
+    fitBudget = budget.FitBudget(targetRMSE=5.0)
+    outputModel, rmse, T, transform = registration.align(gf, landmarks, pc, _config(pcSolver),
+                                                         fitBudget=fitBudget)
+
+    assert fitBudget.targetReached and not fitBudget.exhausted
+    assert fitBudget.nIterations < full.nIterations
+    assert rmse <= 5.0
+    np.testing.assert_allclose(rmse, _rmse(outputModel, landmarks), rtol=1e-8)
+
+
+@pytest.mark.parametrize('pcSolver', ['optimiser', 'alternating', 'leastsq'])
+def test_hip_joint_centres(hjcAtlas, pcSolver):
+    pc, gf = hjcAtlas
+    landmarks = _landmarks(pc, gf, np.array([5.0, -3.0, 8.0, 0.2, -0.15, 0.3, 0.8, -0.5]),
+                           NAMES + tuple(HJCNODES))
+    config = _config(pcSolver, maxIterations=200 if pcSolver == 'alternating' else 0)
+    outputModel, rmse, T, transform = registration.align(gf, landmarks, pc, config)
+
+    # the reported error is that of the sphere fits on the registered shape
+    np.testing.assert_allclose(rmse, _rmse(outputModel, landmarks), rtol=1e-6)
+    assert rmse < 0.5
+    diag = diagnostics.landmarkDiagnostics(gf, landmarks, pc, config, T)
+    P = outputModel.get_field_parameters().reshape((3, -1))
+    errors = [np.linalg.norm(x - fml.makeLandmarkEvaluator(n, gf)(P)) for n, x in landmarks]
+    np.testing.assert_allclose(diag['residualErrors'], errors, rtol=1e-6, atol=1e-8)
+
+
+def test_optimiser_warm_start(atlas):
+    pc, gf = atlas
+    landmarks = _landmarks(pc, gf, np.array([5.0, -3.0, 8.0, 0.2, -0.15, 0.3, 0.8, -0.5]))
+    cold = budget.FitBudget(iterations=100000)
+    coldFit = registration.align(gf, landmarks, pc, _config('optimiser'), fitBudget=cold)
+    warm = budget.FitBudget(iterations=100000)
+    warmFit = registration.align(gf, landmarks, pc, _config('optimiser'), w0=coldFit[2][6:], fitBudget=warm)
+
+    assert registration.usesWarmStart(_config('optimiser'))
+    assert warm.nIterations < cold.nIterations
+    assert warmFit[1] <= coldFit[1] + 1e-3
+    np.testing.assert_allclose(warmFit[2], coldFit[2], atol=5e-3)
@@ -0,0 +1,72 @@
+'''
+Replacing results in the cohort store keeps the running statistics exact.
+'''
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('gias3.musculoskeletal.model_alignment')
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import cohortstore
+
+
+def _T(rng, npcs):
+    return np.hstack([rng.normal(0.0, 10.0, 6), rng.normal(0.0, 1.0, npcs)])
+
+
+def _check(store, results):
+    # statistics match those of the latest result per subject
+    latest = {}
+    for subject, T, rmse, regMode, npcs, atlas in results:
+        latest[subject] = (T, rmse, npcs, atlas)
+    assert len(store) == len(latest)
+    summary = store.summary()
+    rmses = [r[1] for r in latest.values()]
+    np.testing.assert_allclose(summary['rmse']['mean'], [np.mean(rmses)])
+    groups = {}
+    for T, rmse, npcs, atlas in latest.values():
+        groups.setdefault('pc{}@{}'.format(npcs, atlas), []).append(T[6:])
+    assert sorted(k for k in summary if k != 'rmse') == sorted(groups)
+    for group, W in groups.items():
+        np.testing.assert_allclose(summary[group]['mean'], np.mean(W, 0))
+        if len(W) > 1:
+            np.testing.assert_allclose(summary[group]['covariance'], np.cov(np.array(W).T), atol=1e-10)
+    stored = dict((r['subject'], r) for r in store.records())
+    for subject, (T, rmse, npcs, atlas) in latest.items():
+        np.testing.assert_array_equal(stored[subject]['T'], T)
+        assert stored[subject]['atlas'] == atlas
+
+
+def test_replace(tmp_path):
+    rng = np.random.default_rng(0)
+    store = cohortstore.CohortStore(str(tmp_path), chunkSize=4)
+    results = []
+    for i in range(10):
+        results.append(('s{}'.format(i), _T(rng, 3), rng.uniform(1.0, 5.0), 1, 3, 'a'))
+    # refits in the full first shard and in the current shard, one with another atlas and npcs
+    results.append(('s1', _T(rng, 3), 2.0, 1, 3, 'a'))
+    results.append(('s9', _T(rng, 2), 3.0, 1, 2, 'b'))
+    results.append(('s1', _T(rng, 3), 4.0, 1, 3, 'a'))
+    for r in results:
+        store.add(*r)
+    _check(store, results)
+
+    reopened = cohortstore.CohortStore(str(tmp_path), chunkSize=4)
+    _check(reopened, results)
+    assert 's9' in reopened
+    results.append(('s2', _T(rng, 3), 1.5, 1, 3, 'b'))
+    reopened.add(*results[-1])
+    _check(reopened, results)
+
+
+def test_rebuild_stale_stats(tmp_path):
+    rng = np.random.default_rng(1)
+    store = cohortstore.CohortStore(str(tmp_path))
+    results = [('s0', _T(rng, 2), 1.0, 1, 2, 'a'), ('s1', _T(rng, 2), 2.0, 1, 2, 'a')]
+    for r in results:
+        store.add(*r)
+    stale = (tmp_path / 'stats.npz').read_bytes()
+    results.append(('s0', _T(rng, 2), 3.0, 1, 2, 'a'))
+    store.add(*results[-1])
+    # a crash between writing the shard and the statistics of a replacement
+    (tmp_path / 'stats.npz').write_bytes(stale)
+    _check(cohortstore.CohortStore(str(tmp_path)), results)
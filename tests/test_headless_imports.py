@@ -0,0 +1,32 @@
+'''
+The registration modules and headless tools must import without the GUI
+stack, as in batch and watch worker processes.
+'''
+import sys
+import subprocess
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('gias3.musculoskeletal.model_alignment')
+
+GUIPACKAGES = ('PySide6', 'PySide2', 'mayavi', 'traits', 'traitsui', 'pyface', 'vtk', 'mapclient')
+MODULES = ('step', 'registration', 'batch', 'server', 'tuning', 'watch', 'qcrender', 'multiatlas', 'cohortstore')
+
+# fails the import of any GUI package, even when it is installed
+BLOCKER = '''
+import sys
+class Blocker(object):
+    def find_spec(self, name, path=None, target=None):
+        if name.split('.')[0] in {packages!r}:
+            raise ImportError('GUI package imported: ' + name)
+sys.meta_path.insert(0, Blocker())
+import mapclientplugins.fieldworkpcregpelvis2landmarksstep.{module}
+'''
+
+
+@pytest.mark.parametrize('module', MODULES)
+def test_imports_without_gui(module):
+    code = BLOCKER.format(packages=GUIPACKAGES, module=module)
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
@@ -0,0 +1,62 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import kernels
+
+
+def _inputs(rng, nl, npcs, zeroWeights=False):
+    x = np.hstack([rng.normal(0.0, 20.0, 3), rng.uniform(-np.pi, np.pi, 3), rng.normal(0.0, 1.5, npcs)])
+    if zeroWeights:
+        x[6:] = 0.0
+    return (x,
+            rng.normal(0.0, 80.0, (nl, 3)),
+            rng.normal(0.0, 5.0, (npcs, nl, 3)),
+            rng.normal(0.0, 1.0, (npcs, 3)),
+            rng.normal(0.0, 10.0, 3),
+            rng.normal(0.0, 80.0, (nl, 3)),
+            rng.uniform(0.0, 200.0))
+
+
+def _residuals(kernel, args):
+    x, Lc0, D = args[:3]
+    return kernel(*args, np.full(3 * len(Lc0) + len(D), np.nan)).copy()
+
+
+def _cases():
+    rng = np.random.default_rng(0)
+    for nl, npcs in [(5, 1), (7, 3), (7, 10), (20, 25)]:
+        for i in range(10):
+            yield _inputs(rng, nl, npcs)
+        yield _inputs(rng, nl, npcs, zeroWeights=True)
+
+
+def test_loop_matches_numpy():
+    for args in _cases():
+        np.testing.assert_allclose(_residuals(kernels._residualsLoop, args),
+                                   _residuals(kernels._residualsNumpy, args), rtol=1e-12, atol=1e-9)
+
+
+def test_jit_matches_numpy():
+    pytest.importorskip('numba')
+    jit = kernels.residualKernel(jit=True)
+    assert jit is not kernels._residualsNumpy
+    for args in _cases():
+        np.testing.assert_allclose(_residuals(jit, args), _residuals(kernels._residualsNumpy, args),
+                                   rtol=1e-12, atol=1e-9)
+
+
+def test_residuals():
+    rng = np.random.default_rng(1)
+    x, Lc0, D, dc, c0, targets, mwn = _inputs(rng, 6, 4)
+    r = _residuals(kernels.residualKernel(jit=False), (x, Lc0, D, dc, c0, targets, mwn))
+    w = x[6:]
+
+    # the prior residuals sum to the gias3 prior mwn * ||w||
+    np.testing.assert_allclose((r[18:] ** 2.0).sum(), mwn * np.linalg.norm(w))
+
+    # landmark residuals of the posed shape, rotated about the centre of mass
+    from mapclientplugins.fieldworkpcregpelvis2landmarksstep import rotations
+    shape = Lc0 + np.tensordot(w, D, axes=1)
+    fitted = shape.dot(rotations.matrixFromEuler(x[3:6]).T) + c0 + w.dot(dc) + x[:3]
+    np.testing.assert_allclose(r[:18], (fitted - targets).ravel())
@@ -0,0 +1,61 @@
+'''
+The lazy output model behaves as the geometric field it stands in for.
+'''
+import copy
+import pickle
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('gias3.learning.PCA')
+
+from gias3.learning.PCA import PrincipalComponents
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import closedform
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import lazymodel
+
+
+class Field(object):
+
+    def __init__(self, P):
+        self.field_parameters = np.asarray(P, dtype=float).reshape((3, -1, 1))
+
+    def get_field_parameters(self):
+        return self.field_parameters.copy()
+
+    def set_field_parameters(self, P):
+        self.field_parameters = np.asarray(P, dtype=float).reshape((3, -1, 1))
+
+    def calc_CoM(self):
+        return self.field_parameters[:, :, 0].mean(1)
+
+
+@pytest.fixture
+def lazy():
+    rng = np.random.default_rng(0)
+    mean = rng.normal(0.0, 50.0, 3 * 40)
+    modes = np.linalg.qr(rng.normal(0.0, 1.0, (3 * 40, 2)))[0]
+    pc = PrincipalComponents(mean=mean, weights=np.array([100.0, 25.0]), modes=modes)
+    T = np.array([1.0, 2.0, 3.0, 0.1, -0.2, 0.3, 0.5, -1.0])
+    return lazymodel.LazyFieldworkModel(Field(mean), pc, T, 1, 2)
+
+
+def test_parameters(lazy):
+    np.testing.assert_allclose(lazy.get_field_parameters().ravel(), closedform.pcParams(lazy.pc, lazy.T))
+
+
+def test_materialised_once(lazy):
+    model = lazy.materialise()
+    assert lazy.materialise() is model
+    lazy.set_field_parameters(np.zeros(3 * 40))
+    lazy.field_parameters[0, 0, 0] = 1.0
+    assert lazy.materialise() is model
+    assert model.field_parameters.sum() == 1.0
+
+
+def test_isinstance_copy_pickle(lazy):
+    assert isinstance(lazy, Field)
+    for other in (copy.copy(lazy), copy.deepcopy(lazy), pickle.loads(pickle.dumps(lazy))):
+        assert type(other) is Field
+        np.testing.assert_array_equal(other.get_field_parameters(), lazy.get_field_parameters())
+    assert not hasattr(pickle.loads(pickle.dumps(lazy)), 'pc')
@@ -0,0 +1,60 @@
+'''
+Fit records reach the registry of the process that collects them, labelled
+by kind, and cancelled fits are not counted as failures.
+'''
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('gias3.musculoskeletal.model_alignment')
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import metrics
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import registration
+
+
+class Field(object):
+
+    def __init__(self, P):
+        self.field_parameters = np.asarray(P, dtype=float).reshape((3, -1, 1))
+
+    def get_field_parameters(self):
+        return self.field_parameters.copy()
+
+    def calc_CoM(self):
+        return self.field_parameters[:, :, 0].mean(1)
+
+    def transformRigidScaleRotateAboutP(self, T, P):
+        pass
+
+
+def _fit(kind, callback=None):
+    rng = np.random.default_rng(0)
+    model = Field(rng.normal(0.0, 50.0, (3, 1400)))
+    names = ('pelvis-LASIS', 'pelvis-RASIS', 'pelvis-LPSIS', 'pelvis-RPSIS')
+    landmarks = [(n, rng.normal(0.0, 50.0, 3)) for n in names]
+    config = {'regMode': 2, 'npcs': 1}
+    return registration.align(model, landmarks, None, config, callback=callback, kind=kind)
+
+
+def test_collected_fits_are_recorded_by_the_collector():
+    before = metrics.REGISTRATIONS.value(regMode=2, kind='speculative')
+    with metrics.collectFits() as fits:
+        rmse = _fit('speculative', lambda params: None)[1]
+    assert metrics.REGISTRATIONS.value(regMode=2, kind='speculative') == before
+    assert [(f['status'], f['kind'], f['rmse']) for f in fits] == [('done', 'speculative', rmse)]
+    assert fits[0]['callbacks'] == 2
+
+    metrics.recordFits(fits)
+    assert metrics.REGISTRATIONS.value(regMode=2, kind='speculative') == before + 1
+    assert 'pelvisreg_fit_rmse_count{kind="speculative"}' in metrics.REGISTRY.render()
+
+
+def test_cancelled_fit():
+    def cancel(params):
+        raise registration.FitCancelled()
+
+    failures = metrics.FAILURES.value(regMode=2, kind='fit')
+    cancelled = metrics.CANCELLED.value(regMode=2, kind='fit')
+    with pytest.raises(registration.FitCancelled):
+        _fit('fit', cancel)
+    assert metrics.FAILURES.value(regMode=2, kind='fit') == failures
+    assert metrics.CANCELLED.value(regMode=2, kind='fit') == cancelled + 1
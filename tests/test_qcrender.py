@@ -0,0 +1,55 @@
+import os
+import multiprocessing
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import qcrender
+
+
+class Mesh(object):
+    '''
+    The part of the geometric_field interface the renderer uses.
+    '''
+
+    def triangulate(self, discretisation, merge=True):
+        V = np.array([[0.0, 0.0, 0.0], [100.0, 0.0, 0.0], [0.0, 100.0, 0.0], [0.0, 0.0, 100.0]])
+        T = np.array([[0, 1, 2], [0, 1, 3], [0, 2, 3], [1, 2, 3]])
+        return V, T
+
+
+def test_workers_start_headless(monkeypatch):
+    monkeypatch.setenv('ETS_TOOLKIT', 'qt5')
+    monkeypatch.delenv('QT_QPA_PLATFORM', raising=False)
+    with qcrender.headlessEnvironment(), multiprocessing.get_context('spawn').Pool(1) as pool:
+        assert pool.map(os.getenv, ['ETS_TOOLKIT', 'QT_QPA_PLATFORM']) == ['null', 'offscreen']
+
+    # the parent's environment is restored
+    assert os.environ['ETS_TOOLKIT'] == 'qt5'
+    assert 'QT_QPA_PLATFORM' not in os.environ
+
+
+def test_render_without_display(tmpdir, monkeypatch):
+    pytest.importorskip('mayavi')
+    monkeypatch.delenv('DISPLAY', raising=False)
+    monkeypatch.delenv('WAYLAND_DISPLAY', raising=False)
+    landmarks = {'LASIS': [0.0, 0.0, 0.0], 'RASIS': [100.0, 0.0, 0.0], 'Sacral': [50.0, -80.0, 20.0]}
+    jobs = [(Mesh(), landmarks, str(tmpdir.join('subject{}'.format(i)))) for i in range(2)]
+    filenames = qcrender.renderQCViewsParallel(jobs, processes=2, size=(64, 64))
+    assert len(filenames) == 2
+    for subjectFiles in filenames:
+        assert len(subjectFiles) == len(qcrender.QCVIEWS)
+        for filename in subjectFiles:
+            assert os.path.getsize(filename) > 0
+
+
+def test_render_leaves_process_toolkit_alone(tmpdir, monkeypatch):
+    pytest.importorskip('mayavi')
+    monkeypatch.delenv('DISPLAY', raising=False)
+    monkeypatch.delenv('WAYLAND_DISPLAY', raising=False)
+    monkeypatch.setenv('ETS_TOOLKIT', 'qt5')
+    landmarks = {'LASIS': [0.0, 0.0, 0.0], 'RASIS': [100.0, 0.0, 0.0], 'Sacral': [50.0, -80.0, 20.0]}
+    filenames = qcrender.renderQCViews(Mesh(), landmarks, str(tmpdir.join('subject')), size=(64, 64))
+    assert len(filenames) == len(qcrender.QCVIEWS)
+    assert os.environ['ETS_TOOLKIT'] == 'qt5'
@@ -0,0 +1,56 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import rotations
+
+
+def _angles(rng, n):
+    # ry inside (-pi/2, pi/2), where the Euler angles are unique
+    return rng.uniform([-np.pi, -1.5, -np.pi], [np.pi, 1.5, np.pi], (n, 3))
+
+
+def test_composition_order():
+    rng = np.random.default_rng(0)
+    for rx, ry, rz in _angles(rng, 20):
+        R = rotations.matrixFromEuler([rx, ry, rz])
+        Rx = rotations.matrixFromEuler([rx, 0.0, 0.0])
+        Ry = rotations.matrixFromEuler([0.0, ry, 0.0])
+        Rz = rotations.matrixFromEuler([0.0, 0.0, rz])
+        np.testing.assert_allclose(R, Rx.dot(Ry).dot(Rz), atol=1e-12)
+
+
+def test_elementary_rotations():
+    a = 0.3
+    np.testing.assert_allclose(rotations.matrixFromEuler([a, 0.0, 0.0]).dot([0.0, 1.0, 0.0]),
+                               [0.0, np.cos(a), np.sin(a)], atol=1e-12)
+    np.testing.assert_allclose(rotations.matrixFromEuler([0.0, a, 0.0]).dot([0.0, 0.0, 1.0]),
+                               [np.sin(a), 0.0, np.cos(a)], atol=1e-12)
+    np.testing.assert_allclose(rotations.matrixFromEuler([0.0, 0.0, a]).dot([1.0, 0.0, 0.0]),
+                               [np.cos(a), np.sin(a), 0.0], atol=1e-12)
+
+
+def test_euler_round_trip():
+    rng = np.random.default_rng(1)
+    for r in _angles(rng, 100):
+        np.testing.assert_allclose(rotations.eulerFromMatrix(rotations.matrixFromEuler(r)), r, atol=1e-10)
+
+
+def test_matches_gias3_transform():
+    transform3D = pytest.importorskip('gias3.common.transform3D')
+    rng = np.random.default_rng(2)
+    X = rng.normal(0.0, 50.0, (30, 3))
+    for r in _angles(rng, 20):
+        t = rng.normal(0.0, 10.0, 3)
+        expected = transform3D.transformRigid3D(X, np.hstack([t, r]))
+        np.testing.assert_allclose(X.dot(rotations.matrixFromEuler(r).T) + t, expected, atol=1e-9)
+
+
+def test_kabsch_recovers_pose():
+    rng = np.random.default_rng(3)
+    X = rng.normal(0.0, 50.0, (12, 3))
+    r = np.array([0.4, -0.2, 1.1])
+    t = np.array([3.0, -7.0, 12.0])
+    R, tEst = rotations.kabsch(X, X.dot(rotations.matrixFromEuler(r).T) + t)
+    np.testing.assert_allclose(rotations.eulerFromMatrix(R), r, atol=1e-10)
+    np.testing.assert_allclose(tEst, t, atol=1e-9)
@@ -0,0 +1,43 @@
+'''
+Speculative fits work on their own copy of the landmarks.
+'''
+import threading
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('gias3.musculoskeletal.model_alignment')
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import registration
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep.speculative import SpeculativeFits
+
+
+def test_fits_copy_landmarks():
+    started = threading.Event()
+    release = threading.Event()
+    seen = []
+
+    def fitFunc(config, w0, landmarks):
+        started.set()
+        release.wait(5.0)
+        seen.append(np.array([x for name, x in landmarks]))
+        return None, 0.0, np.zeros(7)
+
+    config = dict({l: l for l in registration.PELVISLANDMARKS}, regMode=2, npcs=1)
+    landmarks = [('pelvis-' + l, np.full(3, float(i))) for i, l in enumerate(registration.PELVISLANDMARKS)]
+    expected = np.array([x.copy() for name, x in landmarks])
+
+    speculative = SpeculativeFits(fitFunc, regModes=(1, 2))
+    try:
+        speculative.schedule(config, np.zeros(7), (1, 10), landmarks)
+        assert started.wait(5.0)
+        # a new registration correcting the landmarks in place
+        for name, x in landmarks:
+            x -= 10.0
+        release.set()
+    finally:
+        speculative.shutdown()
+        speculative._executor.shutdown(wait=True)
+
+    assert len(seen) == 1
+    np.testing.assert_array_equal(seen[0], expected)
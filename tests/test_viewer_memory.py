@@ -0,0 +1,92 @@
+'''
+Process memory and surviving viewers over repeated opening and closing of
+the registration viewer. Needs a display (or a virtual one such as xvfb)
+and the GUI stack.
+'''
+import gc
+import os
+import sys
+import weakref
+
+import pytest
+
+if sys.platform.startswith('linux') and not (os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY')):
+    pytest.skip('needs a display', allow_module_level=True)
+
+np = pytest.importorskip('numpy')
+QtCore = pytest.importorskip('PySide6.QtCore')
+QtWidgets = pytest.importorskip('PySide6.QtWidgets')
+pytest.importorskip('mayavi')
+pcregviewerwidget = pytest.importorskip('mapclientplugins.fieldworkpcregpelvis2landmarksstep.pcregviewerwidget')
+
+from gias3.fieldwork.field import geometric_field
+from gias3.fieldwork.field import template_fields
+
+WARMUP = 3
+CYCLES = 20
+# VTK and Qt allocations are not seen by tracemalloc, so the bound is on the
+# resident set size of the whole process
+MAX_GROWTH_PER_CYCLE = 1e6
+
+CONFIG = {'regMode': 1, 'npcs': 1, 'LASIS': 'LASIS', 'RASIS': 'RASIS', 'LPSIS': 'LPSIS',
+          'RPSIS': 'RPSIS', 'Sacral': 'none', 'LHJC': 'none', 'RHJC': 'none'}
+LANDMARKS = {'LASIS': [0.0, 0.0, 0.0], 'RASIS': [200.0, 0.0, 0.0],
+             'LPSIS': [60.0, -150.0, 40.0], 'RPSIS': [140.0, -150.0, 40.0]}
+
+
+def _rss():
+    '''
+    Resident set size of this process in bytes.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        pytest.skip('resident set size not available')
+
+
+def _model():
+    eff = template_fields.four_tri_patch()
+    gf = geometric_field.GeometricField('pelvis', 3, ensemble_field_function=eff)
+    n = eff.get_number_of_ensemble_points()
+    gf.set_field_parameters(np.random.default_rng(0).uniform(0.0, 200.0, (3, n, 1)))
+    return gf
+
+
+def _cycle(app, model, abort):
+    widget = pcregviewerwidget.MayaviPCRegViewerWidget(dict(LANDMARKS), model, dict(CONFIG),
+                                                       lambda callbackSignal=None: None)
+    widget.show()
+    app.processEvents()
+    if abort:
+        widget._ui.abortButton.click()
+    else:
+        widget._ui.acceptButton.click()
+    widget.close()
+    widget.deleteLater()
+    ref = weakref.ref(widget)
+    del widget
+    app.processEvents()
+    QtCore.QCoreApplication.sendPostedEvents(None, QtCore.QEvent.DeferredDelete)
+    gc.collect()
+    return ref
+
+
+def test_repeated_viewers_are_released():
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    model = _model()
+    for i in range(WARMUP):
+        _cycle(app, model, abort=bool(i % 2))
+
+    viewers = []
+    rss = [_rss()]
+    for i in range(CYCLES):
+        viewers.append(_cycle(app, model, abort=bool(i % 2)))
+        rss.append(_rss())
+
+    # at most the viewer closed last may still wait for its deletion
+    assert sum(1 for v in viewers if v() is not None) <= 1
+
+    # memory levels off once the caches are warm
+    half = CYCLES // 2
+    assert (rss[-1] - rss[half]) / float(CYCLES - half) < MAX_GROWTH_PER_CYCLE
@@ -0,0 +1,57 @@
+'''
+warpPoints dispatches on the transform type, and applyMany matches apply.
+'''
+import pytest
+
+np = pytest.importorskip('numpy')
+transformations = pytest.importorskip('gias3.mapclientpluginutilities.datatypes.transformations')
+transform3D = pytest.importorskip('gias3.common.transform3D')
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import warp
+
+
+class _Warp(warp.PCModeWarp):
+    # random mode displacements instead of ones interpolated from a PC model
+
+    def __init__(self, rng, nPoints, npcs):
+        self.points = rng.normal(0.0, 50.0, (nPoints, 3))
+        self.npcs = npcs
+        self.displacements = rng.normal(0.0, 5.0, (npcs, nPoints, 3))
+        self.c0 = rng.normal(0.0, 10.0, 3)
+        self.dc = rng.normal(0.0, 1.0, (npcs, 3))
+
+
+def test_rigid_transforms():
+    rng = np.random.default_rng(0)
+    X = rng.normal(0.0, 50.0, (10, 3))
+    P = rng.normal(0.0, 10.0, 3)
+    T = np.hstack([rng.normal(0.0, 5.0, 3), rng.uniform(-1.0, 1.0, 3), 1.2])
+
+    cases = [(transformations.RigidScaleTransformAboutPoint(T, P=P), transform3D.transformRigidScale3DAboutP(X, T, P)),
+             (transformations.RigidTransformAboutPoint(T[:6], P=P), transform3D.transformRigid3DAboutP(X, T[:6], P)),
+             (transformations.RigidTransform(T[:6]), transform3D.transformRigid3D(X, T[:6])),
+             ]
+    for transform, expected in cases:
+        np.testing.assert_allclose(warp.warpPoints(transform, X), expected, atol=1e-9)
+        np.testing.assert_allclose(warp.unwarpPoints(transform, expected), X, atol=1e-9)
+
+
+def test_unsupported_transforms():
+    X = np.zeros((2, 3))
+    with pytest.raises(ValueError):
+        warp.warpPoints(transformations.AffineTransform(np.eye(4)), X)
+    with pytest.raises(ValueError):
+        warp.warpPoints(transformations.RigidScaleTransform(np.zeros(7)), X)
+    with pytest.raises(ValueError):
+        warp.unwarpPoints(transformations.RigidPCModesTransform(np.zeros(8)), X)
+    with pytest.raises(ValueError):
+        warp.warpPoints(transformations.RigidPCModesTransform(np.zeros(8)), X)
+
+
+def test_apply_many():
+    rng = np.random.default_rng(1)
+    pcWarp = _Warp(rng, 12, 3)
+    Ts = np.hstack([rng.normal(0.0, 5.0, (5, 3)), rng.uniform(-1.0, 1.0, (5, 3)), rng.normal(0.0, 1.5, (5, 3))])
+    np.testing.assert_allclose(pcWarp.applyMany(Ts), np.array([pcWarp.apply(T) for T in Ts]), atol=1e-9)
+    np.testing.assert_allclose(warp.warpPoints(transformations.RigidPCModesTransform(Ts[0]), pcWarp=pcWarp),
+                               pcWarp.apply(Ts[0]))
@@ -0,0 +1,57 @@
+import os
+import json
+from concurrent.futures import wait
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('gias3.musculoskeletal.model_alignment')
+
+from mapclientplugins.fieldworkpcregpelvis2landmarksstep import watch
+
+
+def _ledger(directory):
+    filename = os.path.join(directory, watch.LEDGER)
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as f:
+        return [json.loads(line) for line in f]
+
+
+def _run(watcher):
+    # settle, then submit
+    watcher.step()
+    watcher.step()
+    return list(watcher._running)
+
+
+def test_dead_worker_is_retried_not_recorded(tmpdir):
+    directory = str(tmpdir)
+    filename = os.path.join(directory, 'subject.json')
+    with open(filename, 'w') as f:
+        json.dump({'LASIS': [0.0, 0.0, 0.0]}, f)
+
+    # regMode 2 leaves the (missing) template alone in the workers, and the
+    # registration itself then fails
+    watcher = watch.WatchFolder(directory, None, None, {'regMode': 2}, workers=1, interval=0.0, threads=1)
+    try:
+        futures = _run(watcher)
+        assert len(futures) == 1
+        executor = watcher._executor
+        for process in list(executor._processes.values()):
+            process.kill()
+        watcher._collect(wait(futures).done)
+
+        assert _ledger(directory) == []
+        assert not os.path.exists(watch.resultFilename(filename))
+        assert watcher._executor is not executor
+
+        # retried in the new pool, where the registration error is recorded
+        futures = _run(watcher)
+        assert len(futures) == 1
+        watcher._collect(wait(futures).done)
+        assert [r['status'] for r in _ledger(directory)] == ['failed']
+        with open(watch.resultFilename(filename)) as f:
+            assert json.load(f)['status'] == 'failed'
+    finally:
+        watcher.shutdown()